@@ -26,6 +26,13 @@ from .main_group import main
     help="Path to the houses SQLite database with the format of divider's output",
     required=True,
 )
+@click.option(
+    "--territory_id",
+    "-t",
+    type=int,
+    help="Identifier of the territory to forecast population of",
+    required=True,
+)
 @click.option(
     "--survivability_coefficients",
     "-s",
@@ -79,6 +86,14 @@ from .main_group import main
     default=38,
     show_default=True,
 )
+@click.option(
+    "--scenario",
+    "-S",
+    type=click.Choice(["NEGATIVE", "NEUTRAL", "POSITIVE"]),
+    help="Forecast scenario name",
+    default="NEUTRAL",
+    show_default=True,
+)
 @click.option(
     "--output_dir",
     "-o",
@@ -87,11 +102,24 @@ from .main_group import main
     default="population_forecasted",
     show_default=True,
 )
+@click.option(
+    "--resume",
+    is_flag=True,
+    help="Continue forecast from the last year with a valid checkpoint in the output directory instead of aborting"
+    " (also used to extend the horizon of an existing forecast)",
+)
+@click.option(
+    "--check-query-plans",
+    is_flag=True,
+    help="Check query plans of the balancing queries on the first forecasted year and abort if any of them performs"
+    " a full table scan",
+)
 @click.option(
     "--verbose", "-v", is_flag=True, help="Increase logger verbosity to DEBUG and print some additional stataments"
 )
 def forecast(  # pylint: disable=too-many-arguments,too-many-locals
     houses_db: str,
+    territory_id: int,
     survivability_coefficients: str,
     year_begin: int | None,
     years: int,
@@ -99,7 +127,10 @@ def forecast(  # pylint: disable=too-many-arguments,too-many-locals
     fertility_coefficient: float,
     fertility_begin: int,
     fertility_end: int,
+    scenario: str,
     output_dir: Path,
+    resume: bool,
+    check_query_plans: bool,
     verbose: bool,
 ) -> None:
     """Forecast population change considering division.
@@ -127,6 +158,7 @@ def forecast(  # pylint: disable=too-many-arguments,too-many-locals
 
     res = prforecast(
         houses_db=houses_db,
+        territory_id=territory_id,
         coeffs=coeffs,
         year_begin=year_begin,
         years=years,
@@ -134,8 +166,11 @@ def forecast(  # pylint: disable=too-many-arguments,too-many-locals
         fertility_coefficient=fertility_coefficient,
         fertility_begin=fertility_begin,
         fertility_end=fertility_end,
-        verbose=verbose
-        # no outputdir
+        scenario=scenario,
+        verbose=verbose,
+        working_dir=f"{output_dir}/",
+        resume=resume,
+        check_query_plans=check_query_plans,
     )
 
     return res # idk
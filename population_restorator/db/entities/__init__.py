@@ -1,5 +1,10 @@
 """Database schema definition are located here."""
+from .forecast_checkpoints import t_forecast_checkpoints
+from .houses_subset import t_houses_subset
 from .houses_tmp import t_houses_tmp
 from .population_divided import t_population_divided
+from .population_forecast import t_population_forecast
+from .population_summary import t_population_summary
 from .social_groups_distribution import t_social_groups_distribution
 from .social_groups_probabilities import t_social_groups_probabilities
+from .social_groups_summary import t_social_groups_summary
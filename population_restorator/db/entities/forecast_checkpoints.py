@@ -0,0 +1,29 @@
+"""Forecast checkpoints table schema is defined here."""
+from sqlalchemy import Column, Integer, String, Table, Text
+
+from population_restorator.db import metadata
+
+
+t_forecast_checkpoints = Table(
+    "forecast_checkpoints",
+    metadata,
+    Column("scenario", String(16), primary_key=True, nullable=False),
+    Column("territory_id", Integer, primary_key=True, nullable=False),
+    Column("year", Integer, primary_key=True, nullable=False),
+    Column("targets_digest", String(64), nullable=False),
+    Column("rng_state", Text, nullable=False),
+    Column("entries", Integer, nullable=False),
+    Column("men", Integer, nullable=False),
+    Column("women", Integer, nullable=False),
+)
+"""Checkpoints of completed forecast years, saved to the year database after the year is balanced.
+
+Columns:
+- scenario - forecast scenario name, varchar(16)
+- territory_id - territory identifier, integer
+- year - year completed, integer
+- targets_digest - SHA-256 hex digest of forecasted numbers of men and women of the year, varchar(64)
+- rng_state - JSON-encoded state of the random generator bit generator after the year is balanced, text
+- entries - number of population_divided entries of the year (integrity marker), integer
+- men - total number of men of the year (integrity marker), integer
+- women - total number of women of the year (integrity marker), integer"""
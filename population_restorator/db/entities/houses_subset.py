@@ -0,0 +1,17 @@
+"""Houses subset temporary table schema is defined here."""
+from sqlalchemy import Column, Integer, Table
+
+from population_restorator.db import metadata
+
+
+t_houses_subset = Table(
+    "houses_subset",
+    metadata,
+    Column("house_id", Integer, primary_key=True, nullable=False),
+    prefixes=["TEMPORARY"],
+)
+"""Connection-local temporary table with identifiers of houses to be processed when only a subset of houses is used.
+
+Columns:
+- `house_id` - house identifier, integer
+"""
@@ -0,0 +1,29 @@
+"""Multi-year forecast store table schema is defined here."""
+from sqlalchemy import Column, ForeignKey, Integer, String, Table
+
+from population_restorator.db import metadata
+
+
+t_population_forecast = Table(
+    "population_forecast",
+    metadata,
+    Column("scenario", String(16), primary_key=True, nullable=False),
+    Column("year", Integer, primary_key=True, nullable=False),
+    Column("territory_id", Integer, primary_key=True, nullable=False),
+    Column("house_id", Integer, ForeignKey("houses_tmp.id"), primary_key=True, nullable=False),
+    Column("age", Integer, primary_key=True, nullable=False),
+    Column("social_group_id", Integer, ForeignKey("social_groups_probabilities.id"), primary_key=True, nullable=False),
+    Column("men", Integer, nullable=False),
+    Column("women", Integer, nullable=False),
+)
+"""Forecasted population division of all years and scenarios, partitioned by (scenario, year, territory_id).
+
+Columns:
+- scenario - forecast scenario name, varchar(16)
+- year - year of division, integer
+- territory_id - territory identifier, integer
+- house_id - house identifier, integer
+- age - age of a person, integer
+- social_group_id - social group identifier, integer
+- men - number of men with the given age and social group in the given house at the given year, integer
+- women - number of women with the given age and social group in the given house at the given year, integer"""
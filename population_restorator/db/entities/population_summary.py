@@ -0,0 +1,27 @@
+"""Forecasted population summary table schema is defined here."""
+from sqlalchemy import Boolean, Column, Integer, String, Table
+
+from population_restorator.db import metadata
+
+
+t_population_summary = Table(
+    "population_summary",
+    metadata,
+    Column("scenario", String(16), primary_key=True, nullable=False),
+    Column("territory_id", Integer, primary_key=True, nullable=False),
+    Column("year", Integer, primary_key=True, nullable=False),
+    Column("age", Integer, primary_key=True, nullable=False),
+    Column("is_primary", Boolean, primary_key=True, nullable=False),
+    Column("men", Integer, nullable=False),
+    Column("women", Integer, nullable=False),
+)
+"""Number of people of forecasted years by age and primary or additional social groups, saved with each year.
+
+Columns:
+- scenario - forecast scenario name, varchar(16)
+- territory_id - territory identifier, integer
+- year - year of forecast, integer
+- age - age of a person, integer
+- is_primary - indicates whether the numbers are of primary or additional social groups, boolean
+- men - number of men of the given age in the social groups, integer
+- women - number of women of the given age in the social groups, integer"""
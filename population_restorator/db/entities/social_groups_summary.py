@@ -0,0 +1,25 @@
+"""Forecasted social groups summary table schema is defined here."""
+from sqlalchemy import Column, ForeignKey, Integer, String, Table
+
+from population_restorator.db import metadata
+
+
+t_social_groups_summary = Table(
+    "social_groups_summary",
+    metadata,
+    Column("scenario", String(16), primary_key=True, nullable=False),
+    Column("territory_id", Integer, primary_key=True, nullable=False),
+    Column("year", Integer, primary_key=True, nullable=False),
+    Column("social_group_id", Integer, ForeignKey("social_groups_probabilities.id"), primary_key=True, nullable=False),
+    Column("men", Integer, nullable=False),
+    Column("women", Integer, nullable=False),
+)
+"""Number of people of forecasted years by social group, saved with each year.
+
+Columns:
+- scenario - forecast scenario name, varchar(16)
+- territory_id - territory identifier, integer
+- year - year of forecast, integer
+- social_group_id - social group identifier, integer
+- men - number of men of the social group, integer
+- women - number of women of the social group, integer"""
@@ -1,2 +1,9 @@
 """Some database operations are located here."""
+from .checkpoints import ForecastCheckpoint, delete_checkpoint, get_valid_checkpoint, save_checkpoint
+from .cloning import clone_population_year
+from .houses_subset import houses_filter, register_houses_subset, use_houses_subset
+from .population_deltas import PopulationDeltas
 from .preparation import prepare_db
+from .query_plans import explain_query_plan, find_full_scans
+from .store import get_stored_years, merge_forecast_store, prepare_store, save_forecast_year
+from .summary import SummaryCells, get_summary_cells, get_year_totals, summary_cells_select, write_year_summary
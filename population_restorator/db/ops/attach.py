@@ -0,0 +1,42 @@
+"""SQLite databases attaching helpers are defined here."""
+from __future__ import annotations
+
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+from sqlalchemy import Connection, MetaData, Table
+
+
+def sqlite_file(conn: Connection) -> Path | None:
+    """Get a resolved path of the SQLite database file of the connection or None if it is not a file-based SQLite."""
+    if conn.dialect.name != "sqlite":
+        return None
+    database = conn.engine.url.database
+    if database is None or database in ("", ":memory:") or database.startswith("file:"):
+        return None
+    return Path(database).resolve()
+
+
+def table_in_schema(table: Table, schema: str | None) -> Table:
+    """Get a copy of the given table bound to the given schema (the table itself if schema is None)."""
+    if schema is None:
+        return table
+    return table.to_metadata(MetaData(), schema=schema)
+
+
+@contextmanager
+def attached_database(conn: Connection, path: Path, schema: str) -> Iterator[str]:
+    """Attach SQLite database file to the connection as a given schema for the time of the context.
+
+    SQLite forbids attaching and detaching databases inside of a transaction, so `conn` is committed on enter and
+    committed (or rolled back on error) on exit.
+    """
+    conn.commit()
+    conn.exec_driver_sql(f"ATTACH DATABASE ? AS {schema}", (str(path),))
+    try:
+        yield schema
+        conn.commit()
+    finally:
+        conn.rollback()
+        conn.exec_driver_sql(f"DETACH DATABASE {schema}")
@@ -0,0 +1,139 @@
+"""Forecast checkpoints operations are defined here."""
+from __future__ import annotations
+
+import json
+from dataclasses import dataclass
+from typing import Any, Callable
+
+from loguru import logger
+from sqlalchemy import Connection, delete, func, insert, inspect, select
+from sqlalchemy.schema import CreateTable
+
+from population_restorator.db.entities import t_forecast_checkpoints, t_population_divided
+from population_restorator.db.ops.houses_subset import houses_filter
+
+
+func: Callable
+
+
+@dataclass
+class ForecastCheckpoint:
+    """Completed forecast year with the random generator state to continue from and integrity markers."""
+
+    year: int
+    targets_digest: str
+    rng_state: dict[str, Any]
+    entries: int
+    men: int
+    women: int
+
+
+def _year_integrity(
+    conn: Connection, territory_id: int, year: int, houses_ids: list[int] | None
+) -> tuple[int, int, int]:
+    """Get number of population_divided entries and total men and women of the given year."""
+    entries, men, women = conn.execute(
+        select(
+            func.count(),
+            func.coalesce(func.sum(t_population_divided.c.men), 0),
+            func.coalesce(func.sum(t_population_divided.c.women), 0),
+        ).where(
+            t_population_divided.c.year == year,
+            t_population_divided.c.territory_id == territory_id,
+            houses_filter(t_population_divided.c.house_id, houses_ids),
+        )
+    ).one()
+    return entries, men, women
+
+
+def save_checkpoint(  # pylint: disable=too-many-arguments
+    conn: Connection,
+    scenario: str,
+    territory_id: int,
+    year: int,
+    targets_digest: str,
+    rng_state: dict[str, Any],
+    houses_ids: list[int] | None = None,
+) -> ForecastCheckpoint:
+    """Record the given year as completed in the year database replacing previous checkpoint of the year.
+
+    Integrity markers (number of entries and totals of men and women) are calculated from the population_divided
+    table, so the year population must be committed already. Connection is not committed.
+    """
+    conn.execute(CreateTable(t_forecast_checkpoints, if_not_exists=True))
+    checkpoint = ForecastCheckpoint(
+        year, targets_digest, rng_state, *_year_integrity(conn, territory_id, year, houses_ids)
+    )
+    conn.execute(
+        delete(t_forecast_checkpoints).where(
+            t_forecast_checkpoints.c.scenario == scenario,
+            t_forecast_checkpoints.c.territory_id == territory_id,
+            t_forecast_checkpoints.c.year == year,
+        )
+    )
+    conn.execute(
+        insert(t_forecast_checkpoints).values(
+            scenario=scenario,
+            territory_id=territory_id,
+            year=year,
+            targets_digest=targets_digest,
+            rng_state=json.dumps(rng_state),
+            entries=checkpoint.entries,
+            men=checkpoint.men,
+            women=checkpoint.women,
+        )
+    )
+    return checkpoint
+
+
+def delete_checkpoint(conn: Connection, scenario: str, territory_id: int, year: int) -> None:
+    """Remove checkpoint of the given year if it is present (before the year is recalculated)."""
+    if inspect(conn).has_table(t_forecast_checkpoints.name):
+        conn.execute(
+            delete(t_forecast_checkpoints).where(
+                t_forecast_checkpoints.c.scenario == scenario,
+                t_forecast_checkpoints.c.territory_id == territory_id,
+                t_forecast_checkpoints.c.year == year,
+            )
+        )
+
+
+def get_valid_checkpoint(  # pylint: disable=too-many-arguments
+    conn: Connection,
+    scenario: str,
+    territory_id: int,
+    year: int,
+    targets_digest: str,
+    houses_ids: list[int] | None = None,
+) -> ForecastCheckpoint | None:
+    """Get checkpoint of the given year if it is present, was made for the same forecasted numbers of people
+    (`targets_digest`) and the year population still matches its integrity markers. Return None otherwise.
+    """
+    if not inspect(conn).has_table(t_forecast_checkpoints.name):
+        return None
+    row = (
+        conn.execute(
+            select(t_forecast_checkpoints).where(
+                t_forecast_checkpoints.c.scenario == scenario,
+                t_forecast_checkpoints.c.territory_id == territory_id,
+                t_forecast_checkpoints.c.year == year,
+            )
+        )
+        .mappings()
+        .one_or_none()
+    )
+    if row is None:
+        return None
+    if row["targets_digest"] != targets_digest:
+        logger.warning("Checkpoint of the year {} was made for different forecast parameters, ignoring it", year)
+        return None
+    integrity = _year_integrity(conn, territory_id, year, houses_ids)
+    if integrity != (row["entries"], row["men"], row["women"]):
+        logger.warning(
+            "Population of the year {} does not match its checkpoint (entries, men, women): {} != {}, ignoring it",
+            year,
+            integrity,
+            (row["entries"], row["men"], row["women"]),
+        )
+        return None
+    return ForecastCheckpoint(year, row["targets_digest"], json.loads(row["rng_state"]), *integrity)
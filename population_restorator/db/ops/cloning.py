@@ -0,0 +1,87 @@
+"""Year-to-year population cloning operations are defined here."""
+from __future__ import annotations
+
+from sqlalchemy import Connection, Select, Table, insert, literal, select
+
+from population_restorator.db.entities import t_population_divided
+from population_restorator.db.ops.attach import attached_database, sqlite_file, table_in_schema
+from population_restorator.db.ops.houses_subset import houses_filter
+
+
+_ATTACHED_SCHEMA = "prev_year"
+
+
+def aged_population_select(
+    source: Table, territory_id: int, year: int, max_age: int, houses_ids: list[int] | None
+) -> Select:
+    """Get people of the `year - 1` from `source` table as they are at the `year` (one year older) statement."""
+    return select(
+        literal(year).label("year"),
+        source.c.house_id,
+        source.c.territory_id,
+        (source.c.age + 1).label("age"),
+        source.c.social_group_id,
+        source.c.men,
+        source.c.women,
+    ).where(
+        source.c.year == year - 1,
+        source.c.age < max_age,
+        source.c.age < 100,
+        source.c.territory_id == territory_id,
+        houses_filter(source.c.house_id, houses_ids),
+    )
+
+
+def _insert_aged_population(source: Table, territory_id: int, year: int, max_age: int, houses_ids: list[int] | None):
+    """Get INSERT ... SELECT statement copying people from `source` table to the population_divided."""
+    statement = aged_population_select(source, territory_id, year, max_age, houses_ids)
+    return insert(t_population_divided).from_select(list(statement.selected_columns.keys()), statement)
+
+
+def _same_database(conn: Connection, prev_conn: Connection) -> bool:
+    """Check if both of the connections are opened to the same database."""
+    if conn.engine is prev_conn.engine:
+        return True
+    if conn.dialect.name == "sqlite":
+        target_file = sqlite_file(conn)
+        return target_file is not None and target_file == sqlite_file(prev_conn)
+    return conn.engine.url == prev_conn.engine.url
+
+
+def clone_population_year(  # pylint: disable=too-many-arguments
+    conn: Connection,
+    prev_conn: Connection,
+    territory_id: int,
+    year: int,
+    max_age: int,
+    houses_ids: list[int] | None = None,
+    batch_size: int = 50_000,
+) -> int:
+    """Copy population of the `year - 1` from `prev_conn` to the `year` of `conn` with every person getting one year
+    older. People of the `max_age` are not copied. Return the number of `population_divided` entries copied.
+
+    When both connections are opened to the same database, a single INSERT ... SELECT statement is executed. When
+    both connections are file-based SQLite databases, previous year database is attached to `conn` and the copy
+    is performed with a single INSERT ... SELECT statement (`conn` is committed before and after the operation, as
+    SQLite forbids attaching inside of a transaction). Otherwise entries are read and inserted in batches of
+    `batch_size` size.
+    """
+    if _same_database(conn, prev_conn):
+        return conn.execute(
+            _insert_aged_population(t_population_divided, territory_id, year, max_age, houses_ids)
+        ).rowcount
+    target_file, source_file = sqlite_file(conn), sqlite_file(prev_conn)
+    if target_file is not None and source_file is not None:
+        with attached_database(conn, source_file, _ATTACHED_SCHEMA) as schema:
+            return conn.execute(
+                _insert_aged_population(
+                    table_in_schema(t_population_divided, schema), territory_id, year, max_age, houses_ids
+                )
+            ).rowcount
+
+    statement = aged_population_select(t_population_divided, territory_id, year, max_age, houses_ids)
+    copied = 0
+    for partition in prev_conn.execution_options(yield_per=batch_size).execute(statement).mappings().partitions():
+        conn.execute(insert(t_population_divided), list(partition))
+        copied += len(partition)
+    return copied
@@ -0,0 +1,66 @@
+"""Houses subset filtering operations are defined here."""
+from __future__ import annotations
+
+import weakref
+from typing import Callable
+
+from sqlalchemy import Column, ColumnElement, Connection, Engine, delete, event, insert, select, true
+from sqlalchemy.schema import CreateTable
+
+from population_restorator.db.entities import t_houses_subset
+
+
+_INFO_KEY = "population_restorator_houses_subset"
+
+_EngineSubset = tuple[list[int], Callable[[Connection], None]]
+"""Houses subset registered on an engine and its connect listener."""
+
+_engines_subsets: weakref.WeakKeyDictionary[Engine, _EngineSubset] = weakref.WeakKeyDictionary()
+
+
+def register_houses_subset(conn: Connection, houses_ids: list[int]) -> None:
+    """Fill connection-local `houses_subset` temporary table with the given houses identifiers, so `houses_filter`
+    can be used in statements executed on this connection. Connection is not committed.
+    """
+    conn.execute(CreateTable(t_houses_subset, if_not_exists=True))
+    conn.execute(delete(t_houses_subset))
+    if len(houses_ids) > 0:
+        conn.execute(insert(t_houses_subset), [{"house_id": house_id} for house_id in set(houses_ids)])
+
+
+def use_houses_subset(engine: Engine, houses_ids: list[int] | None) -> None:
+    """Register the given houses subset on every connection of the engine (replacing other subset registered before),
+    so `houses_filter` can be used in statements executed on any of them. Does nothing if `houses_ids` is None.
+
+    The subset is registered (and committed) once per database connection as soon as it is checked out of the pool,
+    later checkouts of the same database connection do not touch the table.
+    """
+    if houses_ids is None:
+        return
+    subset = sorted(set(houses_ids))
+    previous = _engines_subsets.get(engine)
+    if previous is not None:
+        if previous[0] == subset:
+            return
+        event.remove(engine, "engine_connect", previous[1])
+
+    def register(conn: Connection) -> None:
+        if conn.info.get(_INFO_KEY) is not subset:
+            register_houses_subset(conn, subset)
+            conn.commit()
+            conn.info[_INFO_KEY] = subset
+
+    event.listen(engine, "engine_connect", register)
+    _engines_subsets[engine] = (subset, register)
+
+
+def houses_filter(column: Column, houses_ids: list[int] | None) -> ColumnElement[bool]:
+    """Get a filter of the given house identifier column by houses subset (always true if `houses_ids` is None).
+
+    Instead of a list of literals, the subset is read from the `houses_subset` temporary table, so the statement size
+    does not depend on the number of houses. The subset must be registered on the connection the filter is executed
+    on beforehand (see `register_houses_subset` and `use_houses_subset`).
+    """
+    if houses_ids is None:
+        return true()
+    return column.in_(select(t_houses_subset.c.house_id))
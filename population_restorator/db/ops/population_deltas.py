@@ -0,0 +1,76 @@
+"""Population changes write-behind buffer is defined here."""
+from __future__ import annotations
+
+from typing import Iterator
+
+from sqlalchemy import Connection
+from sqlalchemy.dialects import postgresql, sqlite
+
+from population_restorator.db.entities import t_population_divided
+
+
+class PopulationDeltas:
+    """Unit of work collecting signed changes of men and women numbers of population_divided cells
+    (year, house_id, territory_id, age, social_group_id) in memory.
+
+    Repeated changes of the same cell are merged, and all of the changes are written with a single
+    `INSERT ... ON CONFLICT DO UPDATE` batch on `flush`, so the number of statements does not depend on the number
+    of people moved. Missing cells are inserted with the change as their value.
+    """
+
+    def __init__(self) -> None:
+        self._deltas: dict[tuple[int, int, int, int, int], list[int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._deltas)
+
+    def __iter__(self) -> Iterator[tuple[tuple[int, int, int, int, int], int, int]]:
+        """Iterate over collected ((year, house_id, territory_id, age, social_group_id), men, women) changes."""
+        return ((cell, men, women) for cell, (men, women) in self._deltas.items())
+
+    def add(  # pylint: disable=too-many-arguments
+        self, year: int, house_id: int, territory_id: int, age: int, social_group_id: int, men: int = 0, women: int = 0
+    ) -> None:
+        """Add change of the number of men and women of the given cell."""
+        if men == 0 and women == 0:
+            return
+        delta = self._deltas.setdefault((year, house_id, territory_id, age, social_group_id), [0, 0])
+        delta[0] += men
+        delta[1] += women
+
+    def flush(self, conn: Connection) -> int:
+        """Write collected changes with one upsert batch and clear the buffer. Connection is not committed.
+
+        Return number of cells written.
+        """
+        values = [
+            {
+                "year": year,
+                "house_id": house_id,
+                "territory_id": territory_id,
+                "age": age,
+                "social_group_id": social_group_id,
+                "men": men,
+                "women": women,
+            }
+            for (year, house_id, territory_id, age, social_group_id), (men, women) in self._deltas.items()
+            if men != 0 or women != 0
+        ]
+        self._deltas.clear()
+        if len(values) == 0:
+            return 0
+        if conn.dialect.name == "postgresql":
+            statement = postgresql.insert(t_population_divided)
+        elif conn.dialect.name == "sqlite":
+            statement = sqlite.insert(t_population_divided)
+        else:
+            raise ValueError(f"Population changes can be flushed only to SQLite or PostgreSQL, not {conn.dialect.name}")
+        statement = statement.on_conflict_do_update(
+            index_elements=list(t_population_divided.primary_key.columns),
+            set_={
+                "men": t_population_divided.c.men + statement.excluded.men,
+                "women": t_population_divided.c.women + statement.excluded.women,
+            },
+        )
+        conn.execute(statement, values)
+        return len(values)
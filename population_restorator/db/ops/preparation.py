@@ -1,9 +1,11 @@
 """Database preparation steps are defined here."""
 from __future__ import annotations
 
+import hashlib
 from typing import Callable
 
-from sqlalchemy import Connection, Index, distinct, func, insert, select, update
+from sqlalchemy import Connection, Index, Insert, Table, bindparam, func, select, true, update
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.schema import CreateIndex, CreateTable
 
 from population_restorator.db.entities import (
@@ -12,53 +14,148 @@ from population_restorator.db.entities import (
     t_social_groups_distribution,
     t_social_groups_probabilities,
 )
+from population_restorator.db.ops.attach import attached_database, sqlite_file, table_in_schema
 
 
 func: Callable
 
+_REFERENCE_TABLES = (t_social_groups_probabilities, t_social_groups_distribution, t_houses_tmp)
+_ATTACHED_SCHEMA = "prev_reference"
+
+_HOT_INDEXES = (
+    Index(
+        "population_divided_territory_year_age",
+        t_population_divided.c.territory_id,
+        t_population_divided.c.year,
+        t_population_divided.c.age,
+    ),
+)
+"""Indexes for the balancing queries: (territory_id, year, age) population lookups."""
+
 
 def update_sgs_distribution(conn: Connection) -> None:
-    """Perform a men_sg and women_sg recalculation"""
-    sgd_inner = t_social_groups_distribution.alias("sgd_inner")
-    sgs_inner = t_social_groups_probabilities.alias("sgs_inner")
-    to_update = t_social_groups_distribution.alias("sgd_to_update")
-    conn.execute(
-        update(to_update)
-        .values(
-            men_sg=to_update.c.men_probability
-            / select(func.sum(sgd_inner.c.men_probability))
-            .select_from(sgd_inner)
-            .join(t_social_groups_probabilities, sgd_inner.c.social_group_id == t_social_groups_probabilities.c.id)
-            .join(sgs_inner, to_update.c.social_group_id == sgs_inner.c.id)
-            .where(
-                sgd_inner.c.age == to_update.c.age, t_social_groups_probabilities.c.is_primary == sgs_inner.c.is_primary
+    """Perform a men_sg and women_sg recalculation.
+
+    Sums of men and women probabilities are obtained in a single grouped (age, is_primary) query, and then all of the
+    social groups distribution entries are updated with a single executemany statement."""
+    totals = {
+        (age, is_primary): (men_total, women_total)
+        for age, is_primary, men_total, women_total in conn.execute(
+            select(
+                t_social_groups_distribution.c.age,
+                t_social_groups_probabilities.c.is_primary,
+                func.sum(t_social_groups_distribution.c.men_probability),
+                func.sum(t_social_groups_distribution.c.women_probability),
             )
-            .scalar_subquery()
-        )
-        .where(to_update.c.men_probability != 0)
-    )
-    conn.execute(
-        update(to_update)
-        .values(
-            women_sg=to_update.c.women_probability
-            / select(func.sum(sgd_inner.c.women_probability))
-            .select_from(sgd_inner)
-            .join(t_social_groups_probabilities, sgd_inner.c.social_group_id == t_social_groups_probabilities.c.id)
-            .join(sgs_inner, to_update.c.social_group_id == sgs_inner.c.id)
-            .where(
-                sgd_inner.c.age == to_update.c.age, t_social_groups_probabilities.c.is_primary == sgs_inner.c.is_primary
+            .select_from(t_social_groups_distribution)
+            .join(
+                t_social_groups_probabilities,
+                t_social_groups_distribution.c.social_group_id == t_social_groups_probabilities.c.id,
             )
-            .scalar_subquery()
+            .group_by(t_social_groups_distribution.c.age, t_social_groups_probabilities.c.is_primary)
+        )
+    }
+    values = []
+    for sg_id, age, is_primary, men_prob, women_prob, men_sg, women_sg in conn.execute(
+        select(
+            t_social_groups_distribution.c.social_group_id,
+            t_social_groups_distribution.c.age,
+            t_social_groups_probabilities.c.is_primary,
+            t_social_groups_distribution.c.men_probability,
+            t_social_groups_distribution.c.women_probability,
+            t_social_groups_distribution.c.men_sg,
+            t_social_groups_distribution.c.women_sg,
+        )
+        .select_from(t_social_groups_distribution)
+        .join(
+            t_social_groups_probabilities,
+            t_social_groups_distribution.c.social_group_id == t_social_groups_probabilities.c.id,
+        )
+    ):
+        men_total, women_total = totals[(age, is_primary)]
+        values.append(
+            {
+                "b_sg_id": sg_id,
+                "b_age": age,
+                "men_sg": men_prob / men_total if men_prob != 0 else men_sg,
+                "women_sg": women_prob / women_total if women_prob != 0 else women_sg,
+            }
+        )
+    if len(values) > 0:
+        conn.execute(
+            update(t_social_groups_distribution).where(
+                t_social_groups_distribution.c.social_group_id == bindparam("b_sg_id"),
+                t_social_groups_distribution.c.age == bindparam("b_age"),
+            ),
+            values,
         )
-        .where(to_update.c.women_probability != 0)
+
+
+def _table_fingerprint(conn: Connection, table: Table, batch_size: int = 50_000) -> str:
+    """Get a content hash of the table: digest of all of its entries (values included) ordered by the primary key.
+    Entries are streamed in batches of `batch_size` size, so the table is never loaded in memory as a whole."""
+    digest = hashlib.blake2b(digest_size=16)
+    rows = conn.execution_options(yield_per=batch_size).execute(select(table).order_by(*table.primary_key.columns))
+    for partition in rows.partitions():
+        digest.update(repr([tuple(row) for row in partition]).encode())
+    return digest.hexdigest()
+
+
+def _upsert_statement(conn: Connection, table: Table) -> Insert:
+    """Get `INSERT ... ON CONFLICT DO UPDATE` statement of the given table replacing values of present entries."""
+    if conn.dialect.name == "postgresql":
+        statement = postgresql.insert(table)
+    elif conn.dialect.name == "sqlite":
+        statement = sqlite.insert(table)
+    else:
+        raise ValueError(f"Reference tables can be copied only to SQLite or PostgreSQL, not {conn.dialect.name}")
+    return statement.on_conflict_do_update(
+        index_elements=list(table.primary_key.columns),
+        set_={column.name: statement.excluded[column.name] for column in table.columns if not column.primary_key},
     )
 
 
+def _copy_differing_entries(conn: Connection, prev_conn: Connection, tables: list[Table]) -> dict[str, int]:
+    """Copy entries of the given tables from `prev_conn` to `conn` which are missing in `conn` or have different values
+    there (those are updated), so the tables contents of `conn` match the ones of `prev_conn` afterwards (except for
+    entries present only in `conn`, which are kept).
+
+    For two SQLite database files previous one is attached and a single `INSERT ... SELECT ... EXCEPT ... ON CONFLICT
+    DO UPDATE` statement is used per table, for other databases differing entries are found in memory and upserted
+    with a single executemany statement per table.
+
+    Return number of copied entries for each of the tables names.
+    """
+    copied = {}
+    prev_file = sqlite_file(prev_conn)
+    if sqlite_file(conn) is not None and prev_file is not None:
+        with attached_database(conn, prev_file, _ATTACHED_SCHEMA) as schema:
+            for table in tables:
+                source = table_in_schema(table, schema)
+                differing = select(*source.columns).except_(select(*table.columns).where(true()))
+                copied[table.name] = conn.execute(
+                    _upsert_statement(conn, table).from_select(list(table.columns.keys()), differing)
+                ).rowcount
+        return copied
+
+    for table in tables:
+        present = {tuple(row) for row in conn.execute(select(table))}
+        differing = [
+            dict(row) for row in prev_conn.execute(select(table)).mappings() if tuple(row.values()) not in present
+        ]
+        if len(differing) > 0:
+            conn.execute(_upsert_statement(conn, table), differing)
+        copied[table.name] = len(differing)
+    return copied
+
+
 def prepare_db(conn: Connection, prev_conn: Connection | None = None) -> None:
     """Create tables required for population_restorator to work with.
 
-    If `prev_conn` is set, ensures that social_groups and houses data is copied (check is performed only by
-    identifiers)."""
+    If `prev_conn` is set, ensures that social_groups and houses data is copied: entries which are missing or differ
+    are copied in bulk and only if the tables contents hashes differ, so the hashes match afterwards. men_sg and
+    women_sg values are recalculated only when the distribution still differs after copying (it has entries of its
+    own, which were merged with the copied ones)."""
     conn.execute(CreateTable(t_social_groups_probabilities, if_not_exists=True))
     conn.execute(CreateTable(t_social_groups_distribution, if_not_exists=True))
     conn.execute(CreateTable(t_houses_tmp, if_not_exists=True))
@@ -77,49 +174,18 @@ def prepare_db(conn: Connection, prev_conn: Connection | None = None) -> None:
             if_not_exists=True,
         ),
     )
+    for index in _HOT_INDEXES:
+        conn.execute(CreateIndex(index, if_not_exists=True))
 
+    if prev_conn is None:
+        return
 
+    fingerprints = {table.name: _table_fingerprint(prev_conn, table) for table in _REFERENCE_TABLES}
+    changed = [table for table in _REFERENCE_TABLES if _table_fingerprint(conn, table) != fingerprints[table.name]]
+    if len(changed) == 0:
+        return
 
-    if prev_conn is not None:
-        social_groups_present = set(conn.execute(select(distinct(t_social_groups_probabilities.c.id))).scalars())
-        for sg_id, name, probability, is_primary in prev_conn.execute(
-            select(
-                t_social_groups_probabilities.c.id,
-                t_social_groups_probabilities.c.name,
-                t_social_groups_probabilities.c.probability,
-                t_social_groups_probabilities.c.is_primary,
-            )
-        ):
-            if sg_id not in social_groups_present:
-                conn.execute(
-                    insert(t_social_groups_probabilities).values(
-                        id=sg_id, name=name, probability=probability, is_primary=is_primary
-                    )
-                )
-
-        sgs_distribution_present = set(
-            conn.execute(select(t_social_groups_distribution.c.social_group_id, t_social_groups_distribution.c.age))
-        )
-        sgd_edited = False
-        for sg_id, age, men_prob, women_prob in prev_conn.execute(
-            select(
-                t_social_groups_distribution.c.social_group_id,
-                t_social_groups_distribution.c.age,
-                t_social_groups_distribution.c.men_probability,
-                t_social_groups_distribution.c.women_probability,
-            )
-        ):
-            if (sg_id, age) not in sgs_distribution_present:
-                conn.execute(
-                    insert(t_social_groups_distribution).values(
-                        social_group_id=sg_id, age=age, men_probability=men_prob, women_probability=women_prob
-                    )
-                )
-                sgd_edited = True
-        if sgd_edited:
-            update_sgs_distribution(conn)
-
-        houses_present = set(conn.execute(select(distinct(t_houses_tmp.c.id))).scalars())
-        for house_id, capacity in prev_conn.execute(select(t_houses_tmp.c.id, t_houses_tmp.c.capacity)):
-            if house_id not in houses_present:
-                conn.execute(insert(t_houses_tmp).values(id=house_id, capacity=capacity))
+    copied = _copy_differing_entries(conn, prev_conn, changed)
+    sgd_name = t_social_groups_distribution.name
+    if copied.get(sgd_name, 0) > 0 and _table_fingerprint(conn, t_social_groups_distribution) != fingerprints[sgd_name]:
+        update_sgs_distribution(conn)
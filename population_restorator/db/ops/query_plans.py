@@ -0,0 +1,29 @@
+"""Query plans inspection operations are defined here."""
+from __future__ import annotations
+
+import re
+
+from sqlalchemy import Connection, Executable
+
+
+_SCAN_STEP = re.compile(r"^SCAN (?P<table>\w+)(?: USING (?:COVERING )?INDEX (?P<index>\w+))?")
+
+
+def explain_query_plan(conn: Connection, statement: Executable) -> list[str]:
+    """Get SQLite query plan steps details of the given statement (parameters are bound with their given values)."""
+    if conn.dialect.name != "sqlite":
+        raise ValueError(f"Query plans can be inspected only for SQLite databases, not {conn.dialect.name}")
+    compiled = statement.compile(dialect=conn.dialect, compile_kwargs={"render_postcompile": True})
+    params = compiled.construct_params()
+    positional = tuple(params[name] for name in compiled.positiontup) if compiled.positiontup is not None else params
+    return [row[3] for row in conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled.string}", positional)]
+
+
+def find_full_scans(conn: Connection, statement: Executable) -> list[str]:
+    """Get query plan steps of the given statement which scan a whole table or index."""
+    scans = []
+    for step in explain_query_plan(conn, statement):
+        match = _SCAN_STEP.match(step)
+        if match is not None:
+            scans.append(step)
+    return scans
@@ -0,0 +1,146 @@
+"""Multi-year forecast store operations are defined here."""
+from __future__ import annotations
+
+from pathlib import Path
+
+from sqlalchemy import Connection, Select, Table, delete, insert, literal, select
+from sqlalchemy.schema import CreateTable
+
+from population_restorator.db.entities import (
+    t_population_divided,
+    t_population_forecast,
+    t_population_summary,
+    t_social_groups_summary,
+)
+from population_restorator.db.ops.attach import attached_database, sqlite_file, table_in_schema
+from population_restorator.db.ops.houses_subset import houses_filter
+from population_restorator.db.ops.preparation import prepare_db
+
+
+_ATTACHED_SCHEMA = "forecast_store"
+_MERGED_SCHEMA = "merged_store"
+
+
+def _partition_filter(table: Table, scenario: str, territory_id: int, year: int, houses_ids: list[int] | None) -> list:
+    """Get filters for a forecast store partition."""
+    return [
+        table.c.scenario == scenario,
+        table.c.year == year,
+        table.c.territory_id == territory_id,
+        houses_filter(table.c.house_id, houses_ids),
+    ]
+
+
+def _year_select(scenario: str, territory_id: int, year: int, houses_ids: list[int] | None) -> Select:
+    """Get population_divided entries of the given year in the forecast store table columns order statement."""
+    return select(
+        literal(scenario).label("scenario"),
+        t_population_divided.c.year,
+        t_population_divided.c.territory_id,
+        t_population_divided.c.house_id,
+        t_population_divided.c.age,
+        t_population_divided.c.social_group_id,
+        t_population_divided.c.men,
+        t_population_divided.c.women,
+    ).where(
+        t_population_divided.c.year == year,
+        t_population_divided.c.territory_id == territory_id,
+        houses_filter(t_population_divided.c.house_id, houses_ids),
+    )
+
+
+def prepare_store(conn: Connection, base_conn: Connection) -> None:
+    """Create tables of the forecast store and ensure that reference tables (social groups and houses) of the base
+    year database are present in it. Reference tables are shared between all of the scenarios, years and territories.
+    """
+    prepare_db(conn, base_conn)
+    conn.execute(CreateTable(t_population_forecast, if_not_exists=True))
+
+
+def get_stored_years(conn: Connection, scenario: str, territory_id: int) -> list[int]:
+    """Get list of years present in the forecast store for the given scenario and territory."""
+    return list(
+        conn.execute(
+            select(t_population_forecast.c.year)
+            .where(
+                t_population_forecast.c.scenario == scenario,
+                t_population_forecast.c.territory_id == territory_id,
+            )
+            .distinct()
+            .order_by(t_population_forecast.c.year)
+        ).scalars()
+    )
+
+
+def save_forecast_year(  # pylint: disable=too-many-arguments
+    store_conn: Connection,
+    year_conn: Connection,
+    scenario: str,
+    territory_id: int,
+    year: int,
+    houses_ids: list[int] | None = None,
+    batch_size: int = 50_000,
+) -> int:
+    """Move population division of the given year and territory from `year_conn` population_divided table to the
+    (scenario, year, territory_id) partition of the forecast store replacing previously saved one. Return the number of
+    entries saved.
+
+    When the store is a SQLite database file and `year_conn` is a SQLite database, the store is attached to `year_conn`
+    and the data is moved by a single INSERT ... SELECT statement (both connections are committed). Otherwise entries
+    are read and inserted in batches of `batch_size` size.
+    """
+    store_file = sqlite_file(store_conn)
+    if store_file is not None and year_conn.dialect.name == "sqlite":
+        store_conn.commit()
+        with attached_database(year_conn, store_file, _ATTACHED_SCHEMA) as schema:
+            target = table_in_schema(t_population_forecast, schema)
+            year_conn.execute(
+                delete(target).where(*_partition_filter(target, scenario, territory_id, year, houses_ids))
+            )
+            return year_conn.execute(
+                insert(target).from_select(
+                    list(target.columns.keys()), _year_select(scenario, territory_id, year, houses_ids)
+                )
+            ).rowcount
+
+    store_conn.execute(
+        delete(t_population_forecast).where(
+            *_partition_filter(t_population_forecast, scenario, territory_id, year, houses_ids)
+        )
+    )
+    saved = 0
+    result = year_conn.execution_options(yield_per=batch_size).execute(
+        _year_select(scenario, territory_id, year, houses_ids)
+    )
+    for partition in result.mappings().partitions():
+        store_conn.execute(insert(t_population_forecast), list(partition))
+        saved += len(partition)
+    return saved
+
+
+def merge_forecast_store(conn: Connection, path: Path, scenario: str, territory_id: int) -> int:
+    """Move forecast store partitions (forecast and summary tables) of the given scenario and territory from the
+    SQLite forecast store file at `path` to the forecast store of the connection, replacing previously saved ones.
+    Return the number of population_forecast entries moved.
+
+    The other store is attached to the connection, so the data is moved by INSERT ... SELECT statements and the
+    connection is committed.
+    """
+    for table in (t_population_forecast, t_population_summary, t_social_groups_summary):
+        conn.execute(CreateTable(table, if_not_exists=True))
+    moved = 0
+    with attached_database(conn, path, _MERGED_SCHEMA) as schema:
+        for table in (t_population_forecast, t_population_summary, t_social_groups_summary):
+            source = table_in_schema(table, schema)
+            conn.execute(delete(table).where(table.c.scenario == scenario, table.c.territory_id == territory_id))
+            rowcount = conn.execute(
+                insert(table).from_select(
+                    list(table.columns.keys()),
+                    select(*(source.c[column] for column in table.columns.keys())).where(
+                        source.c.scenario == scenario, source.c.territory_id == territory_id
+                    ),
+                )
+            ).rowcount
+            if table is t_population_forecast:
+                moved = rowcount
+    return moved
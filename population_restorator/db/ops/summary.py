@@ -0,0 +1,119 @@
+"""Forecasted years summary operations are defined here."""
+from __future__ import annotations
+
+from typing import Callable
+
+from sqlalchemy import Connection, Select, delete, false, func, insert, select, true
+from sqlalchemy.schema import CreateTable
+
+from population_restorator.db.entities import (
+    t_population_divided,
+    t_population_summary,
+    t_social_groups_probabilities,
+    t_social_groups_summary,
+)
+from population_restorator.db.ops.houses_subset import houses_filter
+
+
+func: Callable
+
+SummaryCells = dict[tuple[int, int, bool], tuple[int, int]]
+"""Numbers of (men, women) by (age, social_group_id, is_primary)."""
+
+
+def summary_cells_select(territory_id: int, year: int, houses_ids: list[int] | None) -> Select:
+    """Get (age, social_group_id, is_primary, men, women) totals of the given year statement."""
+    return (
+        select(
+            t_population_divided.c.age,
+            t_population_divided.c.social_group_id,
+            t_social_groups_probabilities.c.is_primary,
+            func.sum(t_population_divided.c.men),
+            func.sum(t_population_divided.c.women),
+        )
+        .select_from(t_population_divided)
+        .join(
+            t_social_groups_probabilities,
+            t_population_divided.c.social_group_id == t_social_groups_probabilities.c.id,
+        )
+        .where(
+            t_population_divided.c.year == year,
+            t_population_divided.c.territory_id == territory_id,
+            houses_filter(t_population_divided.c.house_id, houses_ids),
+        )
+        .group_by(
+            t_population_divided.c.age,
+            t_population_divided.c.social_group_id,
+            t_social_groups_probabilities.c.is_primary,
+        )
+    )
+
+
+def get_summary_cells(
+    conn: Connection, territory_id: int, year: int, houses_ids: list[int] | None = None
+) -> SummaryCells:
+    """Aggregate population_divided of the given year by age and social group in a single query."""
+    return {
+        (age, sg_id, is_primary): (men, women)
+        for age, sg_id, is_primary, men, women in conn.execute(summary_cells_select(territory_id, year, houses_ids))
+    }
+
+
+def write_year_summary(conn: Connection, scenario: str, territory_id: int, year: int, cells: SummaryCells) -> None:
+    """Replace summary of the given year (population_summary and social_groups_summary tables) with the one rolled up
+    from the given cells. Connection is not committed."""
+    ages: dict[tuple[int, bool], list[int]] = {}
+    sgs: dict[int, list[int]] = {}
+    for (age, sg_id, is_primary), (men, women) in cells.items():
+        for totals in (ages.setdefault((age, bool(is_primary)), [0, 0]), sgs.setdefault(sg_id, [0, 0])):
+            totals[0] += men
+            totals[1] += women
+
+    for table in (t_population_summary, t_social_groups_summary):
+        conn.execute(CreateTable(table, if_not_exists=True))
+        conn.execute(
+            delete(table).where(
+                table.c.scenario == scenario, table.c.territory_id == territory_id, table.c.year == year
+            )
+        )
+    key = {"scenario": scenario, "territory_id": territory_id, "year": year}
+    if len(ages) > 0:
+        conn.execute(
+            insert(t_population_summary),
+            [
+                key | {"age": age, "is_primary": is_primary, "men": men, "women": women}
+                for (age, is_primary), (men, women) in sorted(ages.items())
+            ],
+        )
+    if len(sgs) > 0:
+        conn.execute(
+            insert(t_social_groups_summary),
+            [
+                key | {"social_group_id": sg_id, "men": men, "women": women}
+                for sg_id, (men, women) in sorted(sgs.items())
+            ],
+        )
+
+
+def get_year_totals(conn: Connection, scenario: str, territory_id: int, year: int) -> tuple[int, int, int]:
+    """Get total numbers of men and women of primary social groups and total number of people of additional social
+    groups of the given year from its summary."""
+    men, women, additionals = conn.execute(
+        select(
+            func.coalesce(func.sum(t_population_summary.c.men).filter(t_population_summary.c.is_primary == true()), 0),
+            func.coalesce(
+                func.sum(t_population_summary.c.women).filter(t_population_summary.c.is_primary == true()), 0
+            ),
+            func.coalesce(
+                func.sum(t_population_summary.c.men + t_population_summary.c.women).filter(
+                    t_population_summary.c.is_primary == false()
+                ),
+                0,
+            ),
+        ).where(
+            t_population_summary.c.scenario == scenario,
+            t_population_summary.c.territory_id == territory_id,
+            t_population_summary.c.year == year,
+        )
+    ).one()
+    return men, women, additionals
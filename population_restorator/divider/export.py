@@ -15,7 +15,7 @@ from population_restorator.db.entities import (
     t_social_groups_distribution,
     t_social_groups_probabilities,
 )
-from population_restorator.db.ops import prepare_db
+from population_restorator.db.ops import houses_filter, prepare_db, register_houses_subset
 from population_restorator.db.ops.preparation import update_sgs_distribution
 from population_restorator.models.social_groups import SocialGroupsDistribution
 
@@ -93,10 +93,11 @@ def save_houses_distribution_to_db(  # pylint: disable=too-many-locals,too-many-
             if verbose
             else iter(distribution.items())
         )
+        register_houses_subset(conn, distribution.index.to_list())
         deleted_buildings = conn.execute(
             delete(t_population_divided).where(
                 t_population_divided.c.year == year,
-                t_population_divided.c.house_id.in_(distribution.index.to_list()),
+                houses_filter(t_population_divided.c.house_id, distribution.index.to_list()),
                 t_population_divided.c.territory_id == territory_id
             )
         ).rowcount
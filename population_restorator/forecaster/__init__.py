@@ -1,4 +1,18 @@
 """Forecaster logic is located here."""
-from .ages import forecast_ages
-from .people import forecast_people
+from .ages import forecast_ages, forecast_ages_scenarios, forecast_ages_territories
+from .cohorts import forecast_ages_batch
+from .ensemble import EnsembleForecast, forecast_ensemble
 from .export import export_year_age_values
+from .lazy import LazyForecast
+from .parallel import ScenarioRun, forecast_people_wavefront, forecast_scenarios_wavefront
+from .people import ForecastYear, YearPeople, forecast_people, forecast_people_to_store, iter_forecast_people
+from .pipeline import (
+    ParquetSink,
+    SummarySink,
+    YearDatabasesSink,
+    YearSink,
+    forecast_people_write_behind,
+    write_behind,
+)
+from .query_plans import check_query_plans
+from .territories import TerritoryForecast, forecast_territories
@@ -7,10 +7,13 @@ from typing import Callable
 import numpy as np
 import pandas as pd
 from loguru import logger
-from sqlalchemy import Engine, func, select, true
+from sqlalchemy import Connection, Engine, Select, func, select, true
 
 from population_restorator.db.entities import t_population_divided, t_social_groups_probabilities
-from population_restorator.models import SurvivabilityCoefficients
+from population_restorator.db.ops import houses_filter, use_houses_subset
+from population_restorator.models import ScenarioParameters, SurvivabilityCoefficients
+
+from .cohorts import ForecastedAgesBatch, ForecastParameters, forecast_ages_batch
 
 
 func: Callable
@@ -24,7 +27,86 @@ class ForecastedAges:
     women: pd.DataFrame
 
 
-def forecast_ages(  # pylint: disable=too-many-arguments,too-many-locals
+def base_population_select(territory_id: int, houses_ids: list[int] | None) -> Select:
+    """Get numbers of men and women of primary social groups by age statement."""
+    return (
+        select(t_population_divided.c.age, func.sum(t_population_divided.c.men), func.sum(t_population_divided.c.women))
+        .select_from(t_population_divided)
+        .join(
+            t_social_groups_probabilities,
+            t_population_divided.c.social_group_id == t_social_groups_probabilities.c.id,
+        )
+        .where(
+            t_social_groups_probabilities.c.is_primary == true(),
+            t_population_divided.c.territory_id == territory_id,
+            houses_filter(t_population_divided.c.house_id, houses_ids),
+        )
+        .group_by(t_population_divided.c.age)
+    )
+
+
+def _territories_population_select(territories_ids: list[int] | None, houses_ids: list[int] | None) -> Select:
+    """Get numbers of men and women of primary social groups by territory and age statement. All of the territories
+    are selected if `territories_ids` is None."""
+    return (
+        select(
+            t_population_divided.c.territory_id,
+            t_population_divided.c.age,
+            func.sum(t_population_divided.c.men),
+            func.sum(t_population_divided.c.women),
+        )
+        .select_from(t_population_divided)
+        .join(
+            t_social_groups_probabilities,
+            t_population_divided.c.social_group_id == t_social_groups_probabilities.c.id,
+        )
+        .where(
+            t_social_groups_probabilities.c.is_primary == true(),
+            (t_population_divided.c.territory_id.in_(territories_ids) if territories_ids is not None else true()),
+            houses_filter(t_population_divided.c.house_id, houses_ids),
+        )
+        .group_by(t_population_divided.c.territory_id, t_population_divided.c.age)
+    )
+
+
+def _read_base_population(
+    conn: Connection, territory_id: int, survivability_ages: int, houses_ids: list[int] | None
+) -> tuple[np.ndarray, np.ndarray]:
+    """Get numbers of men and women of primary social groups by age. Max age is taken from the survivability
+    coefficients length (`survivability_ages`), warning is issued if it differs from the one in the database.
+    """
+    max_age: int = conn.execute(
+        select(func.max(t_population_divided.c.age)).where(t_population_divided.c.territory_id == territory_id)
+    ).scalar_one()
+
+    if max_age != survivability_ages:
+        logger.warning(
+            "Survivability coefficients age given for max age {}, but max age in the database is {}."
+            " Using coefficients",
+            survivability_ages,
+            max_age,
+        )
+        max_age = survivability_ages
+
+    current_men, current_women = np.array([0] * (max_age + 1)), np.array([0] * (max_age + 1))
+    cur = conn.execute(base_population_select(territory_id, houses_ids))
+    for age, men, women in cur:
+        current_men[age] = men
+        current_women[age] = women
+    return current_men, current_women
+
+
+def _to_forecasted_ages(forecasted: ForecastedAgesBatch, parameter_set: int) -> ForecastedAges:
+    """Get forecasted ages of the given parameter set as integer dataframes."""
+    years = range(forecasted.years[0], forecasted.years[-1] + 1)
+    ages = range(len(forecasted.ages))
+    return ForecastedAges(
+        pd.DataFrame(forecasted.values[parameter_set, :, 0].astype(int), index=years, columns=ages),
+        pd.DataFrame(forecasted.values[parameter_set, :, 1].astype(int), index=years, columns=ages),
+    )
+
+
+def forecast_ages(  # pylint: disable=too-many-arguments
     database: Engine,
     territory_id,
     year_begin: int,
@@ -41,61 +123,156 @@ def forecast_ages(  # pylint: disable=too-many-arguments,too-many-locals
     If `houses_ids` is given, only houses with given ids will be used."""
 
     logger.debug("Obtaining number of people from the database")
+    use_houses_subset(database, houses_ids)
     with database.connect() as conn:
-        max_age: int = conn.execute(select(func.max(t_population_divided.c.age)).where(t_population_divided.c.territory_id == territory_id)).scalar_one()
-
-        if max_age != len(survivability_coefficients.men):
-            logger.warning(
-                "Survivability coefficients age given for max age {}, but max age in the database is {}."
-                " Using coefficients",
-                len(survivability_coefficients.men),
-                max_age,
-            )
-            max_age = len(survivability_coefficients.men)
-
-        current_men, current_women = np.array([0] * (max_age + 1)), np.array([0] * (max_age + 1))
-        cur = conn.execute(
-            select(
-                t_population_divided.c.age, func.sum(t_population_divided.c.men), func.sum(t_population_divided.c.women)
-            )
-            .select_from(t_population_divided)
-            .join(
-                t_social_groups_probabilities,
-                t_population_divided.c.social_group_id == t_social_groups_probabilities.c.id,
-            )
-            .where(
-                t_social_groups_probabilities.c.is_primary == true(),
-                t_population_divided.c.territory_id == territory_id,
-                (t_population_divided.c.house_id.in_(houses_ids) if houses_ids is not None else true()),
-            )
-            .group_by(t_population_divided.c.age)
+        current_men, current_women = _read_base_population(
+            conn, territory_id, len(survivability_coefficients.men), houses_ids
         )
-        for age, men, women in cur:
-            current_men[age] = men
-            current_women[age] = women
 
     logger.debug("Forecasting people divided by sex and age")
 
-    res_men = [current_men.copy()]
-    res_women = [current_women.copy()]
+    forecasted = forecast_ages_batch(
+        current_men,
+        current_women,
+        year_begin,
+        year_end,
+        ForecastParameters(
+            boys_to_girls,
+            fertility_coefficient,
+            fertility_begin,
+            fertility_end,
+            survivability_coefficients.men,
+            survivability_coefficients.women,
+        ),
+    )
+
+    return _to_forecasted_ages(forecasted, 0)
+
+
+def forecast_ages_scenarios(  # pylint: disable=too-many-arguments
+    database: Engine,
+    territory_id: int,
+    year_begin: int,
+    year_end: int,
+    scenarios: dict[str, ScenarioParameters],
+    houses_ids: list[int] | None = None,
+) -> dict[str, ForecastedAges]:
+    """Get modeled number of people for each of the given scenarios. Base population is read from the database once
+    and all of the scenarios are projected in a single batched pass.
 
-    for _ in range(year_begin, year_end):
-        fertil_women = current_women[fertility_begin : fertility_end + 1].sum()
+    Survivability coefficients of all scenarios must be given for the same number of ages.
+    """
+    names = list(scenarios)
+    parameters = [scenarios[name] for name in names]
 
-        current_men: np.ndarray[int] = np.concatenate(
-            [[0], (current_men[:-1] * survivability_coefficients.men).round().astype(int)]
+    logger.debug("Obtaining number of people from the database")
+    use_houses_subset(database, houses_ids)
+    with database.connect() as conn:
+        current_men, current_women = _read_base_population(
+            conn, territory_id, len(parameters[0].survivability_coefficients.men), houses_ids
         )
-        current_women: np.ndarray[int] = np.concatenate(
-            [[0], (current_women[:-1] * survivability_coefficients.women).round().astype(int)]
+
+    logger.debug("Forecasting people divided by sex and age for scenarios: {}", ", ".join(names))
+
+    forecasted = forecast_ages_batch(
+        current_men,
+        current_women,
+        year_begin,
+        year_end,
+        ForecastParameters(
+            [params.boys_to_girls for params in parameters],
+            [params.fertility_coefficient for params in parameters],
+            [params.fertility_begin for params in parameters],
+            [params.fertility_end for params in parameters],
+            [params.survivability_coefficients.men for params in parameters],
+            [params.survivability_coefficients.women for params in parameters],
+        ),
+    )
+
+    return {name: _to_forecasted_ages(forecasted, idx) for idx, name in enumerate(names)}
+
+
+def forecast_ages_territories(  # pylint: disable=too-many-arguments,too-many-locals
+    database: Engine,
+    territories_ids: list[int] | None,
+    year_begin: int,
+    year_end: int,
+    parameters: ScenarioParameters | dict[int, ScenarioParameters],
+    houses_ids: list[int] | None = None,
+) -> pd.DataFrame:
+    """Get modeled number of people of many territories at once (all of the territories of the database if
+    `territories_ids` is None).
+
+    Base population of all territories is read with a single grouped query and projected in one batched pass with
+    territories as a parameter sets axis. `parameters` are either shared by all of the territories or given for each
+    of them (survivability coefficients must be given for the same number of ages then).
+
+    Returns a tidy dataframe indexed by (territory_id, year, age) with 'men' and 'women' columns.
+    """
+    logger.debug("Obtaining number of people of territories from the database")
+    use_houses_subset(database, houses_ids)
+    with database.connect() as conn:
+        rows = conn.execute(_territories_population_select(territories_ids, houses_ids)).all()
+    territories = sorted(set(territories_ids) if territories_ids is not None else {row[0] for row in rows})
+    if len(territories) == 0:
+        raise ValueError("No territories to forecast are given or found in the database")
+
+    if isinstance(parameters, dict):
+        missing = [territory_id for territory_id in territories if territory_id not in parameters]
+        if len(missing) > 0:
+            raise ValueError(f"Forecast parameters are not given for territories: {missing}")
+        territories_parameters = [parameters[territory_id] for territory_id in territories]
+    else:
+        territories_parameters = [parameters]
+    ages = len(territories_parameters[0].survivability_coefficients.men) + 1
+
+    territories_idx = {territory_id: idx for idx, territory_id in enumerate(territories)}
+    rows_territories = np.array([territories_idx[row[0]] for row in rows], dtype=np.int64)
+    rows_ages = np.array([row[1] for row in rows], dtype=np.int64)
+    if len(rows) > 0 and rows_ages.max() != ages - 1:
+        logger.warning(
+            "Survivability coefficients age given for max age {}, but max age in the database is {}."
+            " Using coefficients",
+            ages - 1,
+            rows_ages.max(),
         )
+    in_range = rows_ages < ages
+    current_men = np.zeros((len(territories), ages), dtype=np.int64)
+    current_women = np.zeros((len(territories), ages), dtype=np.int64)
+    np.add.at(
+        current_men,
+        (rows_territories[in_range], rows_ages[in_range]),
+        np.array([row[2] for row in rows], dtype=np.int64)[in_range],
+    )
+    np.add.at(
+        current_women,
+        (rows_territories[in_range], rows_ages[in_range]),
+        np.array([row[3] for row in rows], dtype=np.int64)[in_range],
+    )
 
-        current_men[0] = fertil_women * fertility_coefficient / 2 * boys_to_girls
-        current_women[0] = fertil_women * fertility_coefficient / 2 * (1 / boys_to_girls)
+    logger.debug("Forecasting people divided by sex and age for {} territories", len(territories))
 
-        res_men.append(current_men.copy())
-        res_women.append(current_women.copy())
+    forecasted = forecast_ages_batch(
+        current_men,
+        current_women,
+        year_begin,
+        year_end,
+        ForecastParameters(
+            [params.boys_to_girls for params in territories_parameters],
+            [params.fertility_coefficient for params in territories_parameters],
+            [params.fertility_begin for params in territories_parameters],
+            [params.fertility_end for params in territories_parameters],
+            [params.survivability_coefficients.men for params in territories_parameters],
+            [params.survivability_coefficients.women for params in territories_parameters],
+        ),
+    )
 
-    return ForecastedAges(
-        pd.DataFrame(res_men, index=range(year_begin, year_end + 1), columns=range(max_age + 1)),
-        pd.DataFrame(res_women, index=range(year_begin, year_end + 1), columns=range(max_age + 1)),
+    return pd.DataFrame(
+        {
+            "men": forecasted.values[:, :, 0].reshape(-1),
+            "women": forecasted.values[:, :, 1].reshape(-1),
+        },
+        index=pd.MultiIndex.from_product(
+            [territories, forecasted.years, forecasted.ages], names=["territory_id", "year", "age"]
+        ),
     )
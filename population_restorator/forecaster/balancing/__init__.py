@@ -1,4 +1,6 @@
 """Each year people balancing methods are located here."""
 from .additional_sgs import balance_year_additional_social_groups
 from .age_sex import balance_year_age
+from .ipf import age_shares, fit_social_groups, fit_table, round_controlled, round_rows
 from .primary_sgs import balance_year_age_primary_social_groups
+from .totals import PopulationTotals
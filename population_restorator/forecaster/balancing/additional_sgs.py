@@ -1,86 +1,67 @@
 """Additional social_groups balancing methods are defined here."""
 from __future__ import annotations
 
-from math import ceil, floor
-from typing import Callable
-
 import numpy as np
-from sqlalchemy import Connection, select, true, update
-
-from population_restorator.db.entities import (
-    t_population_divided,
-    t_social_groups_distribution,
-    t_social_groups_probabilities,
-)
+from sqlalchemy import Connection
 
+from population_restorator.db.ops import PopulationDeltas
 
-func: Callable
+from .ipf import add_tables_changes, age_shares, fit_social_groups, read_social_groups_tables, round_rows
+from .totals import PopulationTotals
 
 
-def balance_year_additional_social_groups(  # pylint: disable=too-many-locals
-    conn: Connection, year: int, age: int, houses_ids: list[int] | None, rng: np.random.Generator
+def balance_year_additional_social_groups(  # pylint: disable=too-many-arguments,too-many-locals
+    conn: Connection,
+    territory_id: int,
+    year: int,
+    age: int,
+    houses_ids: list[int] | None,
+    rng: np.random.Generator,
+    totals: PopulationTotals | None = None,
+    tolerance: float = 1e-3,
+    max_iterations: int = 100,
 ) -> None:
-    """Find houses with the number of social groups highly different from the statistical
-    distribution and balance them.
+    """Distribute additional social groups memberships of people of the given age between houses and additional social
+    groups, so that each house has the number of memberships proportional to the number of its people (of primary
+    social groups) and totals of the social groups match `men_sg` and `women_sg` shares of the age.
 
-    `houses_ids` is not used for now.
+    The number of memberships of each sex is kept, so people forecasted into the age get the additional social groups
+    rate of the ones already present. Houses totals are rounded with `round_rows`, and house x social group tables of
+    both sexes are fitted by iterative proportional fitting and rounded keeping both margins (see
+    `fit_social_groups`). The changes are written back with one upsert batch (see `PopulationDeltas`). If running
+    `totals` of the year are given, they are updated with the changes.
     """
-    _probable_men = (t_population_divided.c.men * t_social_groups_distribution.c.men_sg).label("probable_men")
-    _probable_women = (t_population_divided.c.women * t_social_groups_distribution.c.women_sg).label("probable_women")
-    statement = (
-        select(
-            t_population_divided.c.house_id,
-            t_population_divided.c.social_group_id,
-            t_population_divided.c.men,
-            t_population_divided.c.women,
-            _probable_men,
-            _probable_women,
-        )
-        .select_from(t_population_divided)
-        .join(
-            t_social_groups_probabilities, t_population_divided.c.social_group_id == t_social_groups_probabilities.c.id
-        )
-        .join(
-            t_social_groups_distribution,
-            (t_social_groups_distribution.c.social_group_id == t_social_groups_probabilities.c.id)
-            & (t_social_groups_distribution.c.age == t_population_divided.c.age),
+    primary_ids = list(age_shares(conn, age))
+    shares = age_shares(conn, age, is_primary=False)
+    if len(primary_ids) == 0 or len(shares) == 0:
+        return
+    sgs_ids = list(shares)
+    houses, men, women = read_social_groups_tables(conn, territory_id, year, age, primary_ids + sgs_ids, houses_ids)
+    if len(houses) == 0:
+        return
+
+    def fit(table: np.ndarray, sex_idx: int) -> np.ndarray:
+        people, current = table[:, : len(primary_ids)].sum(axis=1), table[:, len(primary_ids) :]
+        memberships = current.sum()
+        houses_totals = (
+            round_rows((people * memberships / people.sum())[None, :], memberships[None], rng)[0]
+            if people.sum() > 0
+            else np.zeros_like(people)
         )
-        .where(
-            t_social_groups_probabilities.c.is_primary == true(),
-            t_population_divided.c.year == year,
-            t_population_divided.c.age == age,
-            (t_population_divided.c.men > _probable_men * 2)
-            | (t_population_divided.c.men + 2 < _probable_men / 2)
-            | (t_population_divided.c.women > _probable_women * 2)
-            | (t_population_divided.c.women + 2 < _probable_women / 2),
+        fitted = fit_social_groups(
+            current,
+            houses_totals,
+            np.array([shares[sg_id][sex_idx] for sg_id in sgs_ids], dtype=float),
+            rng,
+            tolerance,
+            max_iterations,
         )
-        .order_by(t_population_divided.c.house_id, t_population_divided.c.social_group_id)
-    )
-
-    for house_id, sg_id, men, women, probable_men, probable_women in conn.execute(statement).all():
-        if men > probable_men * 2:
-            needed_men = probable_men * 1.5
-        elif men < probable_men / 2:
-            needed_men = probable_men / 1.5
-        else:
-            needed_men = men
-        needed_men = ceil(needed_men) if rng.integers(0, 1, 1, endpoint=True)[0] else floor(needed_men)
+        return fitted - current
 
-        if women > probable_women * 2:
-            needed_women = probable_women * 1.5
-        elif women < probable_women / 2:
-            needed_women = probable_women / 1.5
-        else:
-            needed_women = women
-        needed_women = ceil(needed_women) if rng.integers(0, 1, 1, endpoint=True)[0] else floor(needed_women)
+    men_changes, women_changes = fit(men, 0), fit(women, 1)
 
-        conn.execute(
-            update(t_population_divided)
-            .values(men=needed_men, women=needed_women)
-            .where(
-                t_population_divided.c.year == year,
-                t_population_divided.c.house_id == house_id,
-                t_population_divided.c.age == age,
-                t_population_divided.c.social_group_id == sg_id,
-            )
-        )
+    deltas = PopulationDeltas()
+    add_tables_changes(deltas, year, territory_id, age, houses, sgs_ids, men_changes, women_changes)
+    if totals is not None:
+        totals.apply(deltas)
+    deltas.flush(conn)
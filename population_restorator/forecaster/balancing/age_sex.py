@@ -1,11 +1,12 @@
 """Age-sex balancing methods are defined here."""
 from __future__ import annotations
 
+from dataclasses import dataclass
 from typing import Callable
 
 import numpy as np
 from loguru import logger
-from sqlalchemy import Connection, func, insert, select, text, true, update
+from sqlalchemy import Connection, Select, func, select, text, true
 
 from population_restorator.db.entities import (
     t_houses_tmp,
@@ -13,23 +14,34 @@ from population_restorator.db.entities import (
     t_social_groups_distribution,
     t_social_groups_probabilities,
 )
+from population_restorator.db.ops import PopulationDeltas, houses_filter
+
+from .totals import PopulationTotals
 
 
 func: Callable
 
 
-def _increase_population(  # pylint: disable=too-many-arguments,too-many-locals
-    conn: Connection, territory_id, age: int, increase_needed: int, is_male: bool, year: int, rng: np.random.Generator
-) -> None:
-    """Add people of the given age and sex to the houses."""
+@dataclass
+class HousesLoads:
+    """Houses loads (number of people of primary social groups of the given sex divided by house capacity) for houses
+    with load higher than zero."""
+
+    men: dict[int, float]
+    women: dict[int, float]
+
+
+def houses_loads_select(territory_id: int, year: int, is_male: bool) -> Select:
+    """Get houses loads statement. Houses without people of primary social groups have zero load and are skipped, so
+    population is joined to houses directly and houses table is never scanned as a whole."""
     _load = (
         func.coalesce(func.sum(t_population_divided.c.men if is_male else t_population_divided.c.women), text("0"))
         / t_houses_tmp.c.capacity
     ).label("load")
-    statement = (
+    return (
         select(t_houses_tmp.c.id, _load)
-        .select_from(t_houses_tmp)
-        .join(t_population_divided, t_population_divided.c.house_id == t_houses_tmp.c.id, isouter=True)
+        .select_from(t_population_divided)
+        .join(t_houses_tmp, t_population_divided.c.house_id == t_houses_tmp.c.id)
         .join(
             t_social_groups_probabilities, t_population_divided.c.social_group_id == t_social_groups_probabilities.c.id
         )
@@ -40,12 +52,81 @@ def _increase_population(  # pylint: disable=too-many-arguments,too-many-locals
         )
         .group_by(t_houses_tmp.c.id, t_houses_tmp.c.capacity)
         .having(_load > 0)
+        .order_by(t_houses_tmp.c.id)
     )
-    # pylint: disable=unnecessary-direct-lambda-call
-    houses_ids, houses_probs = (lambda loads: (list(loads.keys()), np.array(list(loads.values()))))(
-        dict(conn.execute(statement).all())
+
+
+def primary_people_select(
+    territory_id: int, year: int, age: int, is_male: bool, houses_ids: list[int] | None
+) -> Select:
+    """Get (house_id, social_group_id, people number) of primary social groups of the given age and sex statement."""
+    return (
+        select(
+            t_population_divided.c.house_id,
+            t_social_groups_probabilities.c.id,
+            (t_population_divided.c.men if is_male else t_population_divided.c.women),
+        )
+        .select_from(t_population_divided)
+        .join(
+            t_social_groups_probabilities, t_population_divided.c.social_group_id == t_social_groups_probabilities.c.id
+        )
+        .where(
+            t_population_divided.c.year == year,
+            t_population_divided.c.age == age,
+            t_population_divided.c.territory_id == territory_id,
+            houses_filter(t_population_divided.c.house_id, houses_ids),
+            t_social_groups_probabilities.c.is_primary == true(),
+        )
+    )
+
+
+def primary_totals_select(territory_id: int, year: int, age: int, houses_ids: list[int] | None) -> Select:
+    """Get total number of men and women of primary social groups of the given age statement."""
+    return (
+        select(func.sum(t_population_divided.c.men), func.sum(t_population_divided.c.women))
+        .select_from(t_population_divided)
+        .join(
+            t_social_groups_probabilities,
+            t_population_divided.c.social_group_id == t_social_groups_probabilities.c.id,
+        )
+        .where(
+            t_population_divided.c.year == year,
+            t_population_divided.c.age == age,
+            t_population_divided.c.territory_id == territory_id,
+            houses_filter(t_population_divided.c.house_id, houses_ids),
+            t_social_groups_probabilities.c.is_primary == true(),
+        )
     )
 
+
+def get_houses_loads(conn: Connection, territory_id: int, year: int, is_male: bool) -> dict[int, float]:
+    """Get loads of the houses of a given territory and year for people of the given sex."""
+    return dict(conn.execute(houses_loads_select(territory_id, year, is_male)).all())
+
+
+def _increase_population(  # pylint: disable=too-many-arguments,too-many-locals
+    conn: Connection,
+    territory_id,
+    age: int,
+    increase_needed: int,
+    is_male: bool,
+    year: int,
+    rng: np.random.Generator,
+    deltas: PopulationDeltas,
+    houses_loads: dict[int, float] | None = None,
+) -> None:
+    """Add people of the given age and sex to the houses.
+
+    Probability of a person to be added to a house and a social group is proportional to the product of the house
+    load and the social group probability. As the joint distribution is separable, houses are sampled first and then
+    social groups are sampled for each of the chosen houses, so memory used is O(houses + social groups). Changes are
+    added to `deltas`.
+
+    If `houses_loads` is not given, they are calculated from the current year population."""
+    if houses_loads is None:
+        houses_loads = get_houses_loads(conn, territory_id, year, is_male)
+    houses_ids, houses_probs = list(houses_loads.keys()), np.array(list(houses_loads.values()))
+
     _prob = (
         t_social_groups_probabilities.c.probability
         * (
@@ -71,151 +152,60 @@ def _increase_population(  # pylint: disable=too-many-arguments,too-many-locals
         dict(conn.execute(statement).all())
     )
 
-    total_probs = np.array((np.mat(houses_probs).T * sgs_probs).flat)
-    total_probs /= total_probs.sum()
+    if len(houses_ids) == 0 or len(sgs_ids) == 0:
+        logger.warning(
+            "Could not add {} {} of the age {}: no {} to settle them found",
+            increase_needed,
+            ("men" if is_male else "women"),
+            age,
+            ("houses" if len(houses_ids) == 0 else "social groups"),
+        )
+        return
 
-    change_values = np.unique(
-        rng.choice(list(range(len(houses_ids) * len(sgs_ids))), increase_needed, replace=True, p=total_probs),
-        return_counts=True,
-    )
-    for idx, change in zip(change_values[0], change_values[1]):
-        house_id = houses_ids[idx // len(sgs_ids)]
-        sg_id = sgs_ids[idx % len(sgs_ids)]
-        updated = conn.execute(
-            update(t_population_divided)
-            .values(
-                **{
-                    ("men" if is_male else "women"): (
-                        t_population_divided.c.men if is_male else t_population_divided.c.women
-                    )
-                    + int(change)
-                }
-            )
-            .where(
-                t_population_divided.c.year == year,
-                t_population_divided.c.house_id == house_id,
-                t_population_divided.c.social_group_id == sg_id,
-                t_population_divided.c.territory_id == territory_id,
-                t_population_divided.c.age == age,
-            )
-        ).rowcount
-        if updated == 0:
-            conn.execute(
-                insert(t_population_divided).values(
-                    year=year,
-                    house_id=house_id,
-                    territory_id=territory_id,
-                    social_group_id=sg_id,
-                    age=age,
-                    **{("men" if is_male else "women"): int(change), ("women" if is_male else "men"): 0},
-                )
-            )
+    houses_changes = rng.multinomial(increase_needed, houses_probs / houses_probs.sum())
+    changed_houses = np.flatnonzero(houses_changes)
+    sgs_changes = rng.multinomial(houses_changes[changed_houses], sgs_probs / sgs_probs.sum())
+    for house_idx, sg_idx in zip(*np.nonzero(sgs_changes)):
+        change = int(sgs_changes[house_idx, sg_idx])
+        deltas.add(
+            year,
+            houses_ids[changed_houses[house_idx]],
+            territory_id,
+            age,
+            sgs_ids[sg_idx],
+            **{("men" if is_male else "women"): change},
+        )
 
 
 def _decrease_population(  # pylint: disable=too-many-arguments
-    conn: Connection, territory_id: int, age: int, decrease_needed: int, is_male: bool, year: int, rng: np.random.Generator
+    conn: Connection,
+    territory_id: int,
+    age: int,
+    decrease_needed: int,
+    is_male: bool,
+    year: int,
+    rng: np.random.Generator,
+    deltas: PopulationDeltas,
+    houses_ids: list[int] | None = None,
 ) -> None:
-    """Remove people of the given age and sex from houses."""
-    statement = (
-        select(
-            t_population_divided.c.house_id,
-            t_social_groups_probabilities.c.id,
-            (t_population_divided.c.men if is_male else t_population_divided.c.women)
-            #* (1 - t_social_groups_probabilities.c.probability), #here goes 0
-        )
-        .select_from(t_population_divided)
-        .join(
-            t_social_groups_probabilities, t_population_divided.c.social_group_id == t_social_groups_probabilities.c.id
-        )
-        .where(
-            t_population_divided.c.year == year,
-            t_population_divided.c.age == age,
-            t_population_divided.c.territory_id == territory_id,
-            t_social_groups_probabilities.c.is_primary == true(),
-        )
-        .order_by(t_population_divided.c.house_id, t_social_groups_probabilities.c.id)
-    )
-    houses_sgs_ids = []
-    houses_sgs_probs = []
-    for house_id, sg_id, load in conn.execute(statement):
-        houses_sgs_ids.append((house_id, sg_id))
-        houses_sgs_probs.append(float(load))
-
-    houses_sgs_probs = np.array(houses_sgs_probs)
-    houses_sgs_probs /= houses_sgs_probs.sum()
-
-    change_values = np.unique(
-        rng.choice(list(range(len(houses_sgs_ids))), decrease_needed, replace=True, p=houses_sgs_probs),
-        return_counts=True,
-    )
-    for h_s_id, change in zip(change_values[0], change_values[1]):
-        house_id, sg_id = houses_sgs_ids[h_s_id]
-        conn.execute(
-            update(t_population_divided)
-            .values(
-                **{
-                    ("men" if is_male else "women"): (
-                        t_population_divided.c.men if is_male else t_population_divided.c.women
-                    )
-                    - int(change)
-                }
-            )
-            .where(
-                t_population_divided.c.year == year,
-                t_population_divided.c.house_id == house_id,
-                t_population_divided.c.social_group_id == sg_id,
-                t_population_divided.c.age == age,
-                t_population_divided.c.territory_id == territory_id
-            )
-        )
-    conn.execute(
-        update(t_population_divided)
-        .values(**{("men" if is_male else "women"): 0})
-        .where((t_population_divided.c.men if is_male else t_population_divided.c.women) < 0)
-    )
+    """Remove exactly `decrease_needed` people of the given age and sex from houses.
 
-
-def _decrease_population_roughly(  # pylint: disable=too-many-arguments
-    conn: Connection, territory_id: int, age: int, decrease_needed: int, is_male: bool, year: int, rng: np.random.Generator
-) -> None:
-    """Remove people of the given age and sex from houses without taking houses probabilities into account (used in
-    the last step after the number of tries is exceeded)."""
-    statement = (
-        select(
-            t_population_divided.c.house_id,
-            t_social_groups_probabilities.c.id,
-            (t_population_divided.c.men if is_male else t_population_divided.c.women),
-        )
-        .select_from(t_population_divided)
-        .join(
-            t_social_groups_probabilities, t_population_divided.c.social_group_id == t_social_groups_probabilities.c.id
-        )
-        .where(
-            t_population_divided.c.year == year,
-            t_population_divided.c.age == age,
-            t_population_divided.c.territory_id == territory_id,
-            t_social_groups_probabilities.c.is_primary == true(),
-        )
-    )
-    houses_info = conn.execute(statement).fetchall()
-    rng.shuffle(houses_info)
-
-    each_house_change = max(1, decrease_needed / len(houses_info))
-    for house_id, sg_id, house_population in houses_info:
-        if decrease_needed == 0:
-            break
-        new_house_population = max(0, house_population - each_house_change)
-        decrease_needed -= house_population - new_house_population
-        conn.execute(
-            update(t_population_divided)
-            .values(**{("men" if is_male else "women"): new_house_population})
-            .where(
-                t_population_divided.c.year == year,
-                t_population_divided.c.house_id == house_id,
-                t_population_divided.c.social_group_id == sg_id,
-                t_population_divided.c.age == age,
-            )
+    Every person of a primary social group has the same chance to be removed, so the number of people removed from
+    each (house, social group) cell is taken from a single multivariate hypergeometric draw over the current cells
+    numbers. Cells never get below zero. Changes are added to `deltas`."""
+    cells = conn.execute(
+        primary_people_select(territory_id, year, age, is_male, houses_ids).order_by(
+            t_population_divided.c.house_id, t_population_divided.c.social_group_id
         )
+    ).all()
+    if len(cells) == 0:
+        return
+
+    counts = np.array([number for _, _, number in cells], dtype=np.int64)
+    removed = rng.multivariate_hypergeometric(counts, min(decrease_needed, int(counts.sum())))
+    for idx in np.flatnonzero(removed):
+        house_id, sg_id, _ = cells[idx]
+        deltas.add(year, house_id, territory_id, age, sg_id, **{("men" if is_male else "women"): -int(removed[idx])})
 
 
 def balance_year_age(  # pylint: disable=too-many-arguments
@@ -227,10 +217,14 @@ def balance_year_age(  # pylint: disable=too-many-arguments
     year: int,
     houses_ids: list[int] | None,
     rng: np.random.Generator,
-    max_tries_per_year: int = 20,
+    houses_loads: HousesLoads | None = None,
+    totals: PopulationTotals | None = None,
 ) -> None:
     """Increase or decrease population of houses to get needed summary number of people of the given age and sex.
 
+    Both increase and decrease change the population by exactly the needed number of people, so balancing is done
+    in a single pass. Changes of men and women are written together with one upsert batch (see `PopulationDeltas`).
+
     Args:
         conn (sqlalchemy.Connection): database connection
         age (int): age of people to be balanced
@@ -239,52 +233,52 @@ def balance_year_age(  # pylint: disable=too-many-arguments
         year (int): year of balancing
         houses_ids (list[int] | None): identifier of houses to use
         rng (numpy.random.Generator): generator to keep the same resutls between launches
-        max_tries_per_year (int, optional): number of attempts to balance accurately (used when population decrease
-        is needed and wrong houses were used too many times). Defaults to 15.
+        houses_loads (HousesLoads | None, optional): houses loads to use when adding people instead of calculating
+        them from the current year population on each addition. Defaults to None.
+        totals (PopulationTotals | None, optional): running totals of the year to take current numbers of people and
+        houses loads from instead of aggregating the table. They are updated with the changes made. Defaults to None.
     """
-    for _ in range(max_tries_per_year):
-        statement = (
-            select(func.sum(t_population_divided.c.men), func.sum(t_population_divided.c.women))
-            .select_from(t_population_divided)
-            .join(
-                t_social_groups_probabilities,
-                t_population_divided.c.social_group_id == t_social_groups_probabilities.c.id,
-            )
-            .where(
-                t_population_divided.c.year == year,
-                t_population_divided.c.age == age,
-                t_population_divided.c.territory_id == territory_id,
-                (t_population_divided.c.house_id.in_(houses_ids) if houses_ids is not None else true()),
-                t_social_groups_probabilities.c.is_primary == true(),
-            )
-        )
+    if totals is not None:
+        men_in_db, women_in_db = totals.age_totals(age)
+        if houses_loads is None:
+            houses_loads = HousesLoads(totals.houses_loads(True), totals.houses_loads(False))
+    else:
+        statement = primary_totals_select(territory_id, year, age, houses_ids)
         men_in_db, women_in_db = map(lambda x: x or 0, conn.execute(statement).one())
-        if men_in_db == men_needed and women_in_db == women_needed:
-            return
-
-        logger.trace("Age {}: men {} -> {}, women {} -> {}", age, men_in_db, men_needed, women_in_db, women_needed)
-        if men_in_db < men_needed:
-            _increase_population(conn, territory_id, age, men_needed - men_in_db, True, year, rng)
-        elif men_in_db > men_needed:
-            _decrease_population(conn, territory_id, age, men_in_db - men_needed, True, year, rng)
-
-        if women_in_db < women_needed:
-            _increase_population(conn, territory_id, age, women_needed - women_in_db, False, year, rng)
-        elif women_in_db > women_needed:
-            _decrease_population(conn, territory_id, age, women_in_db - women_needed, False, year, rng)
-
-    logger.warning(
-        "Could not balance people of age {} (men {} -> {}, women {} -> {}) by {} tries - using rough method",
-        age,
-        men_in_db,
-        men_needed,
-        women_in_db,
-        women_needed,
-        max_tries_per_year,
-    )
+    if men_in_db == men_needed and women_in_db == women_needed:
+        return
 
-    if men_in_db > men_needed:
-        _decrease_population_roughly(conn, territory_id, age, men_in_db - men_needed, True, year, rng)
+    deltas = PopulationDeltas()
+    logger.trace("Age {}: men {} -> {}, women {} -> {}", age, men_in_db, men_needed, women_in_db, women_needed)
+    if men_in_db < men_needed:
+        _increase_population(
+            conn,
+            territory_id,
+            age,
+            men_needed - men_in_db,
+            True,
+            year,
+            rng,
+            deltas,
+            houses_loads.men if houses_loads is not None else None,
+        )
+    elif men_in_db > men_needed:
+        _decrease_population(conn, territory_id, age, men_in_db - men_needed, True, year, rng, deltas, houses_ids)
 
-    if women_in_db > women_needed:
-        _decrease_population_roughly(conn, territory_id, age, women_in_db - women_needed, False, year, rng)
+    if women_in_db < women_needed:
+        _increase_population(
+            conn,
+            territory_id,
+            age,
+            women_needed - women_in_db,
+            False,
+            year,
+            rng,
+            deltas,
+            houses_loads.women if houses_loads is not None else None,
+        )
+    elif women_in_db > women_needed:
+        _decrease_population(conn, territory_id, age, women_in_db - women_needed, False, year, rng, deltas, houses_ids)
+    if totals is not None:
+        totals.apply(deltas)
+    deltas.flush(conn)
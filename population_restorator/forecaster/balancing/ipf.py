@@ -0,0 +1,259 @@
+"""Iterative proportional fitting of houses and social groups tables is defined here."""
+from __future__ import annotations
+
+import numpy as np
+from loguru import logger
+from sqlalchemy import Connection, Select, false, select, true
+
+from population_restorator.db.entities import (
+    t_population_divided,
+    t_social_groups_distribution,
+    t_social_groups_probabilities,
+)
+from population_restorator.db.ops import PopulationDeltas, houses_filter
+
+
+SEED_PRIOR_WEIGHT = 0.01
+"""Weight of the independent (house total x social group share) table added to the current one to get the fitting
+seed, so social groups absent in a house can still get people."""
+
+
+def age_shares(conn: Connection, age: int, is_primary: bool = True) -> dict[int, tuple[float, float]]:
+    """Get (men_sg, women_sg) shares of primary (or additional) social groups of the given age ordered by social group
+    identifier."""
+    return {
+        sg_id: (men_sg, women_sg)
+        for sg_id, men_sg, women_sg in conn.execute(
+            select(
+                t_social_groups_distribution.c.social_group_id,
+                t_social_groups_distribution.c.men_sg,
+                t_social_groups_distribution.c.women_sg,
+            )
+            .select_from(t_social_groups_distribution)
+            .join(
+                t_social_groups_probabilities,
+                t_social_groups_distribution.c.social_group_id == t_social_groups_probabilities.c.id,
+            )
+            .where(
+                t_social_groups_distribution.c.age == age,
+                t_social_groups_probabilities.c.is_primary == (true() if is_primary else false()),
+            )
+            .order_by(t_social_groups_distribution.c.social_group_id)
+        )
+    }
+
+
+def social_groups_people_select(
+    territory_id: int, year: int, age: int, sgs_ids: list[int], houses_ids: list[int] | None
+) -> Select:
+    """Get (house_id, social_group_id, men, women) of the given social groups and age statement."""
+    return (
+        select(
+            t_population_divided.c.house_id,
+            t_population_divided.c.social_group_id,
+            t_population_divided.c.men,
+            t_population_divided.c.women,
+        )
+        .where(
+            t_population_divided.c.year == year,
+            t_population_divided.c.age == age,
+            t_population_divided.c.territory_id == territory_id,
+            houses_filter(t_population_divided.c.house_id, houses_ids),
+            t_population_divided.c.social_group_id.in_(sgs_ids),
+        )
+        .order_by(t_population_divided.c.house_id, t_population_divided.c.social_group_id)
+    )
+
+
+def fit_table(  # pylint: disable=too-many-arguments
+    seed: np.ndarray,
+    rows_totals: np.ndarray,
+    columns_totals: np.ndarray,
+    tolerance: float = 1e-3,
+    max_iterations: int = 100,
+) -> tuple[np.ndarray, int, float]:
+    """Fit non-negative [rows, columns] `seed` table to the given rows and columns totals by iterative proportional
+    fitting (raking). Columns totals are rescaled to the sum of rows totals first.
+
+    Iterations stop when the maximum absolute deviation of rows sums from their totals (columns sums are exact after
+    each iteration) is not higher than `tolerance`. Return fitted table, number of iterations done and the deviation.
+    """
+    fitted = seed.astype(float)
+    if columns_totals.sum() > 0:
+        columns_totals = columns_totals * (rows_totals.sum() / columns_totals.sum())
+    error = np.inf
+    iteration = 0
+    for iteration in range(1, max_iterations + 1):
+        rows_sums = fitted.sum(axis=1)
+        fitted *= np.divide(rows_totals, rows_sums, out=np.zeros_like(rows_sums), where=rows_sums > 0)[:, None]
+        columns_sums = fitted.sum(axis=0)
+        fitted *= np.divide(columns_totals, columns_sums, out=np.zeros_like(columns_sums), where=columns_sums > 0)
+        error = float(np.abs(fitted.sum(axis=1) - rows_totals).max(initial=0.0))
+        if error <= tolerance:
+            break
+    return fitted, iteration, error
+
+
+def round_rows(table: np.ndarray, rows_totals: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    """Round non-negative table to integers with sums of its rows equal to the given integer `rows_totals`.
+
+    Rows are scaled to their totals exactly and rounded down, and the remaining people are given to the cells by
+    systematic sampling over fractional parts with a single random offset per row, so every cell is rounded up with
+    probability of its fractional part.
+    """
+    rows_sums = table.sum(axis=1)
+    table = table * np.divide(rows_totals, rows_sums, out=np.zeros_like(rows_sums), where=rows_sums > 0)[:, None]
+    floors = np.floor(table)
+    remainders = rows_totals - floors.sum(axis=1)
+    fractions = table - floors
+    fractions_sums = fractions.sum(axis=1)
+    cumulative = (
+        np.cumsum(fractions, axis=1)
+        * np.divide(remainders, fractions_sums, out=np.zeros_like(fractions_sums), where=fractions_sums > 0)[:, None]
+    )
+    cumulative = np.minimum(cumulative, remainders[:, None])
+    cumulative[:, -1] = remainders
+    offsets = rng.random((table.shape[0], 1))
+    ups = np.diff(np.floor(np.hstack([np.zeros((table.shape[0], 1)), cumulative]) + offsets), axis=1)
+    return (floors + ups).astype(np.int64)
+
+
+def _move_to_column(ups: np.ndarray, rows_left: np.ndarray, column: int) -> None:
+    """Add one rounded up cell to the given column of `ups` [rows, columns] keeping its rows sums, except for one of the
+    rows with people left, which sum is increased.
+
+    Rounded up cells are moved between columns along the shortest path: a row which is not rounded up in the column
+    takes it in place of another column, which then needs a rounded up cell, and so on until a row with people left
+    is reached. If there is no such path, the cell of a row with people left is rounded up once more.
+    """
+    free = ups == 0
+    parents: dict[int, tuple[int, int] | None] = {column: None}
+    queue = [column]
+    while len(queue) > 0:
+        current = queue.pop(0)
+        ends = np.flatnonzero(free[:, current] & (rows_left > 0))
+        if len(ends) > 0:
+            row = ends[0]
+            ups[row, current] += 1
+            rows_left[row] -= 1
+            while parents[current] is not None:
+                previous, via = parents[current]
+                ups[via, current] -= 1
+                ups[via, previous] += 1
+                current = previous
+            return
+        for following in range(ups.shape[1]):
+            if following not in parents:
+                vias = np.flatnonzero(free[:, current] & (ups[:, following] > 0))
+                if len(vias) > 0:
+                    parents[following] = (current, vias[0])
+                    queue.append(following)
+    row = np.flatnonzero(rows_left > 0)[0]
+    ups[row, column] += 1
+    rows_left[row] -= 1
+
+
+def round_controlled(
+    table: np.ndarray, rows_totals: np.ndarray, columns_totals: np.ndarray, rng: np.random.Generator
+) -> np.ndarray:
+    """Round non-negative [rows, columns] table fitted to the given integer rows and columns totals (with equal sums) to
+    integers keeping both of the totals (controlled rounding).
+
+    Cells are rounded down, and the people left in every column are given to its cells with the largest random keys
+    weighted by their fractional parts (cells without a fractional part go last), at most one person per cell and not
+    more than people left in each row. Columns are filled from the one with the most people left. People the columns
+    could not place this way are placed by moving rounded up cells between columns (see `_move_to_column`), so every
+    cell stays within one person of its fitted value.
+    """
+    floors = np.floor(table)
+    fractions = table - floors
+    rows_left = (rows_totals - floors.sum(axis=1)).astype(np.int64)
+    columns_left = (columns_totals - floors.sum(axis=0)).astype(np.int64)
+    keys = np.where(
+        fractions > 0,
+        rng.random(table.shape) ** np.divide(1.0, fractions, out=np.ones_like(fractions), where=fractions > 0),
+        -rng.random(table.shape),
+    )
+    ups = np.zeros(table.shape, dtype=np.int64)
+    for column in np.argsort(-columns_left, kind="stable"):
+        candidates = np.flatnonzero(rows_left > 0)
+        chosen = candidates[np.argsort(-keys[candidates, column], kind="stable")[: columns_left[column]]]
+        ups[chosen, column] = 1
+        rows_left[chosen] -= 1
+        columns_left[column] -= len(chosen)
+    for column in np.flatnonzero(columns_left > 0):
+        for _ in range(columns_left[column]):
+            _move_to_column(ups, rows_left, column)
+    return floors.astype(np.int64) + ups
+
+
+def read_social_groups_tables(  # pylint: disable=too-many-arguments
+    conn: Connection, territory_id: int, year: int, age: int, sgs_ids: list[int], houses_ids: list[int] | None
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Get identifiers of the houses having people of the given social groups and age, and [houses, social groups]
+    tables of men and women of them (social groups are ordered as `sgs_ids`)."""
+    rows = conn.execute(social_groups_people_select(territory_id, year, age, sgs_ids, houses_ids)).all()
+    sgs_idx = {sg_id: idx for idx, sg_id in enumerate(sgs_ids)}
+    houses, houses_idx = np.unique(np.array([row[0] for row in rows], dtype=np.int64), return_inverse=True)
+    rows_sgs_idx = np.array([sgs_idx[row[1]] for row in rows], dtype=np.int64)
+    men = np.zeros((len(houses), len(sgs_ids)), dtype=np.int64)
+    women = np.zeros((len(houses), len(sgs_ids)), dtype=np.int64)
+    men[houses_idx, rows_sgs_idx] = [row[2] for row in rows]
+    women[houses_idx, rows_sgs_idx] = [row[3] for row in rows]
+    return houses, men, women
+
+
+def fit_social_groups(  # pylint: disable=too-many-arguments
+    current: np.ndarray,
+    houses_totals: np.ndarray,
+    sgs_shares: np.ndarray,
+    rng: np.random.Generator,
+    tolerance: float = 1e-3,
+    max_iterations: int = 100,
+) -> np.ndarray:
+    """Get [houses, social groups] table of people of one sex fitted to the given integer `houses_totals` and social
+    groups shares of their sum.
+
+    The table is fitted with `fit_table` starting from the `current` one (see `SEED_PRIOR_WEIGHT`) to the social
+    groups totals rounded with `round_rows`, and rounded with `round_controlled`, so both houses and social groups
+    totals are exact. If none of the social groups has a positive share, `current` table is returned unchanged.
+    """
+    if houses_totals.sum() == 0:
+        return np.zeros_like(current)
+    if sgs_shares.sum() <= 0:
+        return current
+    sgs_shares = sgs_shares / sgs_shares.sum()
+    sgs_totals = round_rows((houses_totals.sum() * sgs_shares)[None, :], houses_totals.sum()[None], rng)[0]
+    fitted, iterations, error = fit_table(
+        current + SEED_PRIOR_WEIGHT * np.outer(houses_totals, sgs_shares),
+        houses_totals.astype(float),
+        sgs_totals.astype(float),
+        tolerance,
+        max_iterations,
+    )
+    if error > tolerance:
+        logger.debug("Social groups fitting did not converge in {} iterations (deviation {:.4f})", iterations, error)
+    return round_controlled(fitted, houses_totals, sgs_totals, rng)
+
+
+def add_tables_changes(  # pylint: disable=too-many-arguments
+    deltas: PopulationDeltas,
+    year: int,
+    territory_id: int,
+    age: int,
+    houses: np.ndarray,
+    sgs_ids: list[int],
+    men_changes: np.ndarray,
+    women_changes: np.ndarray,
+) -> None:
+    """Add changes of [houses, social groups] tables of men and women of the given age to `deltas`."""
+    for house_idx, sg_idx in zip(*np.nonzero((men_changes != 0) | (women_changes != 0))):
+        deltas.add(
+            year,
+            int(houses[house_idx]),
+            territory_id,
+            age,
+            sgs_ids[sg_idx],
+            int(men_changes[house_idx, sg_idx]),
+            int(women_changes[house_idx, sg_idx]),
+        )
@@ -0,0 +1,119 @@
+"""Running totals of the balanced year population are defined here."""
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Callable
+
+import numpy as np
+from sqlalchemy import Connection, Select, func, select, true
+
+from population_restorator.db.entities import t_houses_tmp, t_population_divided, t_social_groups_probabilities
+from population_restorator.db.ops import PopulationDeltas, SummaryCells, get_summary_cells
+
+
+func: Callable
+
+
+def houses_totals_select(territory_id: int, year: int) -> Select:
+    """Get (house_id, capacity, men, women) totals of primary social groups of the given year statement."""
+    return (
+        select(
+            t_houses_tmp.c.id,
+            t_houses_tmp.c.capacity,
+            func.sum(t_population_divided.c.men),
+            func.sum(t_population_divided.c.women),
+        )
+        .select_from(t_population_divided)
+        .join(t_houses_tmp, t_population_divided.c.house_id == t_houses_tmp.c.id)
+        .join(
+            t_social_groups_probabilities, t_population_divided.c.social_group_id == t_social_groups_probabilities.c.id
+        )
+        .where(
+            t_population_divided.c.year == year,
+            t_population_divided.c.territory_id == territory_id,
+            t_social_groups_probabilities.c.is_primary == true(),
+        )
+        .group_by(t_houses_tmp.c.id, t_houses_tmp.c.capacity)
+        .order_by(t_houses_tmp.c.id)
+    )
+
+
+@dataclass
+class PopulationTotals:  # pylint: disable=too-many-instance-attributes
+    """Numbers of men and women of the balanced year by age and social group (for the houses subset), of primary
+    social groups by age and by house (for every house of the territory) with houses capacities. Houses numbers are
+    kept as vectors indexed by `houses`, so loads are calculated without aggregating the table.
+
+    Totals are read from the database once per year and then kept up to date with `apply` from the changes made by
+    balancing, so neither age totals, houses loads nor the year summary need to be aggregated from the table again.
+    """
+
+    year: int
+    houses_ids: set[int] | None
+    primary_sgs: set[int]
+    summary: SummaryCells
+    ages_men: dict[int, int]
+    ages_women: dict[int, int]
+    houses: dict[int, int]
+    """House identifier -> index in houses vectors."""
+    capacities: np.ndarray
+    houses_men: np.ndarray
+    houses_women: np.ndarray
+
+    @classmethod
+    def load(cls, conn: Connection, territory_id: int, year: int, houses_ids: list[int] | None) -> "PopulationTotals":
+        """Read totals of the given year from the database."""
+        summary = get_summary_cells(conn, territory_id, year, houses_ids)
+        ages_men: dict[int, int] = {}
+        ages_women: dict[int, int] = {}
+        for (age, _, is_primary), (men, women) in summary.items():
+            if is_primary:
+                ages_men[age] = ages_men.get(age, 0) + men
+                ages_women[age] = ages_women.get(age, 0) + women
+        houses = conn.execute(houses_totals_select(territory_id, year)).all()
+        return cls(
+            year,
+            set(houses_ids) if houses_ids is not None else None,
+            set(
+                conn.execute(
+                    select(t_social_groups_probabilities.c.id).where(
+                        t_social_groups_probabilities.c.is_primary == true()
+                    )
+                ).scalars()
+            ),
+            summary,
+            ages_men,
+            ages_women,
+            {house_id: idx for idx, (house_id, *_) in enumerate(houses)},
+            np.array([capacity for _, capacity, _, _ in houses], dtype=float),
+            np.array([men or 0 for _, _, men, _ in houses], dtype=np.int64),
+            np.array([women or 0 for _, _, _, women in houses], dtype=np.int64),
+        )
+
+    def age_totals(self, age: int) -> tuple[int, int]:
+        """Get current numbers of men and women of the given age."""
+        return self.ages_men.get(age, 0), self.ages_women.get(age, 0)
+
+    def houses_loads(self, is_male: bool) -> dict[int, float]:
+        """Get current loads of the houses with load higher than zero ordered by house identifier, the same as
+        `get_houses_loads` would return for the year."""
+        loads = (self.houses_men if is_male else self.houses_women) / self.capacities
+        return {house_id: float(loads[idx]) for house_id, idx in self.houses.items() if loads[idx] > 0}
+
+    def apply(self, deltas: PopulationDeltas) -> None:
+        """Update totals with the changes collected in `deltas` (must be called before they are flushed)."""
+        for (year, house_id, _, age, social_group_id), men, women in deltas:
+            if year != self.year or (men == 0 and women == 0):
+                continue
+            is_primary = social_group_id in self.primary_sgs
+            if self.houses_ids is None or house_id in self.houses_ids:
+                cell_men, cell_women = self.summary.get((age, social_group_id, is_primary), (0, 0))
+                self.summary[(age, social_group_id, is_primary)] = (cell_men + men, cell_women + women)
+                if is_primary:
+                    self.ages_men[age] = self.ages_men.get(age, 0) + men
+                    self.ages_women[age] = self.ages_women.get(age, 0) + women
+            if not is_primary:
+                continue
+            if (idx := self.houses.get(house_id)) is not None:
+                self.houses_men[idx] += men
+                self.houses_women[idx] += women
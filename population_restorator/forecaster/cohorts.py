@@ -0,0 +1,194 @@
+"""Batched cohort-component (Leslie model) ages forecasting engine is defined here.
+
+The engine projects a single base population with many parameter sets at once by broadcasting over a parameter set
+axis, so calibration sweeps of thousands of parameters combinations take one vectorized pass per year.
+"""
+from __future__ import annotations
+
+import itertools
+from dataclasses import dataclass
+from typing import Iterable
+
+import numpy as np
+import pandas as pd
+
+from population_restorator.models import SurvivabilityCoefficients
+
+
+@dataclass
+class ForecastParameters:
+    """Arrays of forecast parameter sets, first dimension of each array is a parameter set.
+
+    Survivability arrays have shape [<parameter sets>, <ages> - 1], but a single [<ages> - 1] vector is broadcasted to
+    all of the parameter sets.
+    """
+
+    boys_to_girls: np.ndarray
+    fertility_coefficient: np.ndarray
+    fertility_begin: np.ndarray
+    fertility_end: np.ndarray
+    survivability_men: np.ndarray
+    survivability_women: np.ndarray
+
+    def __post_init__(self) -> None:
+        """Convert values to numpy arrays and check that their shapes are consistent."""
+        self.boys_to_girls = np.atleast_1d(np.asarray(self.boys_to_girls, dtype=float))
+        self.fertility_coefficient = np.atleast_1d(np.asarray(self.fertility_coefficient, dtype=float))
+        self.fertility_begin = np.atleast_1d(np.asarray(self.fertility_begin, dtype=int))
+        self.fertility_end = np.atleast_1d(np.asarray(self.fertility_end, dtype=int))
+        self.survivability_men = np.atleast_2d(np.asarray(self.survivability_men, dtype=float))
+        self.survivability_women = np.atleast_2d(np.asarray(self.survivability_women, dtype=float))
+        sizes = {
+            len(self.boys_to_girls),
+            len(self.fertility_coefficient),
+            len(self.fertility_begin),
+            len(self.fertility_end),
+        } | {len(arr) for arr in (self.survivability_men, self.survivability_women) if len(arr) != 1}
+        if len(sizes - {1}) > 1:
+            raise ValueError(f"Parameters arrays have different number of parameter sets: {sorted(sizes)}")
+        if self.survivability_men.shape[1] != self.survivability_women.shape[1]:
+            raise ValueError(
+                f"Length of men ({self.survivability_men.shape[1]}) and women ({self.survivability_women.shape[1]})"
+                " survivability coefficients must be the same"
+            )
+
+    def __len__(self) -> int:
+        return max(
+            len(self.boys_to_girls),
+            len(self.fertility_coefficient),
+            len(self.fertility_begin),
+            len(self.fertility_end),
+            len(self.survivability_men),
+            len(self.survivability_women),
+        )
+
+    @classmethod
+    def grid(  # pylint: disable=too-many-arguments
+        cls,
+        boys_to_girls: Iterable[float],
+        fertility_coefficient: Iterable[float],
+        fertility_begin: Iterable[int],
+        fertility_end: Iterable[int],
+        survivability_coefficients: Iterable[SurvivabilityCoefficients],
+    ) -> ForecastParameters:
+        """Construct parameter sets as a cartesian product of the given values."""
+        survivability_coefficients = list(survivability_coefficients)
+        product = list(
+            itertools.product(
+                boys_to_girls,
+                fertility_coefficient,
+                fertility_begin,
+                fertility_end,
+                range(len(survivability_coefficients)),
+            )
+        )
+        btg, f_coef, f_begin, f_end, surv_idx = (np.array(values) for values in zip(*product))
+        return cls(
+            btg,
+            f_coef,
+            f_begin,
+            f_end,
+            np.array([survivability_coefficients[idx].men for idx in surv_idx]),
+            np.array([survivability_coefficients[idx].women for idx in surv_idx]),
+        )
+
+    def to_frame(self) -> pd.DataFrame:
+        """Represent scalar parameters as a DataFrame with index of parameter set."""
+        size = len(self)
+        return pd.DataFrame(
+            {
+                "boys_to_girls": np.broadcast_to(self.boys_to_girls, size),
+                "fertility_coefficient": np.broadcast_to(self.fertility_coefficient, size),
+                "fertility_begin": np.broadcast_to(self.fertility_begin, size),
+                "fertility_end": np.broadcast_to(self.fertility_end, size),
+            },
+            index=pd.RangeIndex(size, name="parameter_set"),
+        )
+
+
+@dataclass
+class ForecastedAgesBatch:
+    """Forecasted number of people as a tensor of shape [<parameter sets>, <years>, 2, <ages>] labelled with
+    parameters, years and ages. Third dimension is sex (0 - man, 1 - woman)."""
+
+    values: np.ndarray
+    parameters: ForecastParameters
+    years: pd.Index
+    ages: pd.Index
+
+    def men(self, parameter_set: int) -> pd.DataFrame:
+        """Get men forecast of the given parameter set with index as year and columns as ages."""
+        return pd.DataFrame(self.values[parameter_set, :, 0], index=self.years, columns=self.ages)
+
+    def women(self, parameter_set: int) -> pd.DataFrame:
+        """Get women forecast of the given parameter set with index as year and columns as ages."""
+        return pd.DataFrame(self.values[parameter_set, :, 1], index=self.years, columns=self.ages)
+
+    def totals(self) -> pd.DataFrame:
+        """Get total population with index as parameter set and columns as years."""
+        return pd.DataFrame(
+            self.values.sum(axis=(2, 3)),
+            index=pd.RangeIndex(self.values.shape[0], name="parameter_set"),
+            columns=self.years,
+        )
+
+
+def forecast_ages_batch(
+    men: np.ndarray,
+    women: np.ndarray,
+    year_begin: int,
+    year_end: int,
+    parameters: ForecastParameters,
+) -> ForecastedAgesBatch:
+    """Project base population (`men` and `women` numbers by age) from `year_begin` to `year_end` with each of the
+    given parameter sets.
+
+    Base population can also be given per parameter set as [<parameter sets>, <ages>] arrays (e.g. one row for each
+    territory), then a single parameter set is broadcasted to all of them.
+
+    For every year people of each age are moved to the next one with survivability coefficients applied (and rounded),
+    and newborns number is calculated from fertile women of the previous year, the same way as in `forecast_ages`.
+    """
+    men, women = np.atleast_2d(np.asarray(men)), np.atleast_2d(np.asarray(women))
+    if men.shape != women.shape:
+        raise ValueError(f"Men {men.shape} and women {women.shape} base population shapes must be the same")
+    if len(men) not in (1, len(parameters)) and len(parameters) != 1:
+        raise ValueError(
+            f"Base population is given for {len(men)} sets, but there are {len(parameters)} parameter sets"
+        )
+    sets, ages_number = max(len(parameters), len(men)), men.shape[1]
+    if parameters.survivability_men.shape[1] != ages_number - 1:
+        raise ValueError(
+            f"Survivability coefficients are given for {parameters.survivability_men.shape[1] + 1} ages,"
+            f" but population is given for {ages_number}"
+        )
+
+    ages = np.arange(ages_number)
+    fertile_ages = (
+        (ages >= np.broadcast_to(parameters.fertility_begin, sets)[:, None])
+        & (ages <= np.broadcast_to(parameters.fertility_end, sets)[:, None])
+    ).astype(float)
+
+    # state is kept in contiguous float arrays (values are integers, so calculations are exact) and copied to the
+    # resulting tensor every year
+    current = np.empty((2, sets, ages_number))
+    current[0], current[1] = men, women
+    survivability = np.stack(np.broadcast_arrays(parameters.survivability_men, parameters.survivability_women))
+    values = np.empty((sets, year_end - year_begin + 1, 2, ages_number), dtype=np.int64)
+    values[:, 0] = current.transpose(1, 0, 2)
+    for year_idx in range(1, year_end - year_begin + 1):
+        fertil_women = np.einsum("pa,pa->p", current[1], fertile_ages)
+
+        current[:, :, 1:] = np.rint(current[:, :, :-1] * survivability)
+        newborns = fertil_women * parameters.fertility_coefficient / 2
+        current[0, :, 0] = np.trunc(newborns * parameters.boys_to_girls)
+        current[1, :, 0] = np.trunc(newborns * (1 / parameters.boys_to_girls))
+
+        values[:, year_idx] = current.transpose(1, 0, 2)
+
+    return ForecastedAgesBatch(
+        values,
+        parameters,
+        pd.RangeIndex(year_begin, year_end + 1, name="year"),
+        pd.RangeIndex(ages_number, name="age"),
+    )
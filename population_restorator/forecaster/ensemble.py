@@ -0,0 +1,182 @@
+"""Monte Carlo ensemble forecasting of houses population is defined here."""
+from __future__ import annotations
+
+import time
+from dataclasses import dataclass
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+from sqlalchemy import Connection, Engine, func, select, true
+
+from population_restorator.db.entities import t_houses_tmp, t_population_divided, t_social_groups_probabilities
+from population_restorator.db.ops import houses_filter, use_houses_subset
+
+from .ages import ForecastedAges
+
+
+func: Callable
+
+
+@dataclass
+class EnsembleForecast:
+    """Quantile bands of the forecasted houses population over the ensemble replicates.
+
+    `houses` is indexed by (year, house_id) and has ("men" | "women", quantile) columns with quantiles of the total
+    number of people of primary social groups of the house. Territory totals have no spread, as every replicate is
+    balanced to the same forecasted numbers of people, and are not reported.
+    """
+
+    replicates: int
+    quantiles: tuple[float, ...]
+    houses: pd.DataFrame
+
+
+def _read_base_houses(
+    conn: Connection, territory_id: int, year: int, ages: int, houses_ids: list[int] | None
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Get identifiers and capacities of the houses with people of primary social groups of the given year and
+    [houses, ages] numbers of men and women of them."""
+    rows = conn.execute(
+        select(
+            t_population_divided.c.house_id,
+            t_houses_tmp.c.capacity,
+            t_population_divided.c.age,
+            func.sum(t_population_divided.c.men),
+            func.sum(t_population_divided.c.women),
+        )
+        .select_from(t_population_divided)
+        .join(t_houses_tmp, t_population_divided.c.house_id == t_houses_tmp.c.id)
+        .join(
+            t_social_groups_probabilities, t_population_divided.c.social_group_id == t_social_groups_probabilities.c.id
+        )
+        .where(
+            t_population_divided.c.territory_id == territory_id,
+            t_population_divided.c.year == year,
+            t_population_divided.c.age < ages,
+            houses_filter(t_population_divided.c.house_id, houses_ids),
+            t_social_groups_probabilities.c.is_primary == true(),
+        )
+        .group_by(t_population_divided.c.house_id, t_houses_tmp.c.capacity, t_population_divided.c.age)
+        .order_by(t_population_divided.c.house_id)
+    ).all()
+    houses, houses_idx = np.unique(np.array([row[0] for row in rows], dtype=np.int64), return_inverse=True)
+    capacities = np.zeros(len(houses))
+    capacities[houses_idx] = [row[1] for row in rows]
+    men, women = np.zeros((len(houses), ages), dtype=np.int64), np.zeros((len(houses), ages), dtype=np.int64)
+    rows_ages = np.array([row[2] for row in rows], dtype=np.int64)
+    np.add.at(men, (houses_idx, rows_ages), [row[3] for row in rows])
+    np.add.at(women, (houses_idx, rows_ages), [row[4] for row in rows])
+    return houses, capacities, men, women
+
+
+def remove_uniformly(counts: np.ndarray, removed: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    """Get numbers of people to remove from each of the last axis cells of `counts` [..., cells] so that `removed`
+    [...] people are removed in total and every person has the same chance to be removed (multivariate
+    hypergeometric draw for every leading index).
+
+    Cells are split in halves recursively and the removed people are divided between the halves with a single
+    vectorized hypergeometric draw per level, so all of the leading indexes (replicates, ages) are drawn together in
+    log2(cells) numpy calls. Numbers of people of the halves of every level are summed once bottom-up beforehand.
+    """
+    cells = counts.shape[-1]
+    size = 1 << max(0, (cells - 1).bit_length())
+    padded = np.zeros(counts.shape[:-1] + (size,), dtype=np.int64)
+    padded[..., :cells] = counts
+    levels = [padded]
+    while levels[-1].shape[-1] > 1:
+        levels.append(levels[-1].reshape(levels[-1].shape[:-1] + (-1, 2)).sum(axis=-1))
+    nodes = removed[..., None].astype(np.int64)
+    for level in reversed(levels[:-1]):
+        halves = level.reshape(level.shape[:-1] + (-1, 2))
+        left = rng.hypergeometric(halves[..., 0], halves[..., 1], nodes)
+        nodes = np.stack([left, nodes - left], axis=-1).reshape(level.shape)
+    return nodes[..., :cells]
+
+
+def _balance_sex(
+    people: np.ndarray, needed: np.ndarray, capacities: np.ndarray, rng: np.random.Generator
+) -> np.ndarray:
+    """Balance [replicates, houses, ages] numbers of people of one sex to the `needed` [ages] totals.
+
+    New people are settled to houses with probabilities proportional to the houses loads at the year start, and
+    surplus people are removed uniformly, the same way as `balance_year_age` does it (only ages having surplus in any
+    of the replicates are drawn).
+    """
+    current = people.sum(axis=1)
+    increase, decrease = np.maximum(needed - current, 0), np.maximum(current - needed, 0)
+    surplus_ages = decrease.any(axis=0)
+    if surplus_ages.any():
+        people = people.copy()
+        people[..., surplus_ages] -= remove_uniformly(
+            people[..., surplus_ages].transpose(0, 2, 1), decrease[:, surplus_ages], rng
+        ).transpose(0, 2, 1)
+    if increase.any():
+        loads = people.sum(axis=2) / capacities
+        totals = loads.sum(axis=1, keepdims=True)
+        if (totals == 0).any():
+            logger.warning("Could not add people to some of the ensemble replicates: no houses to settle them found")
+        probabilities = np.divide(loads, totals, out=np.zeros_like(loads), where=totals > 0)
+        increase = np.where(totals > 0, increase, 0)
+        people = people + rng.multinomial(increase, probabilities[:, None, :]).transpose(0, 2, 1)
+    return people
+
+
+def _quantile_frame(values: np.ndarray, quantiles: tuple[float, ...], sex: str) -> pd.DataFrame:
+    """Get [..., quantiles] frame of the quantiles of [replicates, ...] values."""
+    bands = np.quantile(values, quantiles, axis=0).reshape(len(quantiles), -1).T
+    return pd.DataFrame(bands, columns=pd.MultiIndex.from_product([[sex], quantiles]))
+
+
+def forecast_ensemble(  # pylint: disable=too-many-arguments,too-many-locals
+    start_engine: Engine,
+    territory_id: int,
+    forecasted_ages: ForecastedAges,
+    base_year: int,
+    replicates: int = 100,
+    houses_ids: list[int] | None = None,
+    rng: np.random.Generator | None = None,
+    quantiles: tuple[float, ...] = (0.05, 0.5, 0.95),
+) -> EnsembleForecast:
+    """Forecast houses population `replicates` times at once and get quantile bands of houses totals for every
+    forecasted year.
+
+    The base year is read once, and the replicates share it together with `forecasted_ages`: population is kept as
+    [replicates, houses, ages] arrays of men and women of primary social groups, which are aged and balanced with a
+    fixed number of vectorized draws per year for all of the replicates and ages together (see `remove_uniformly`), so
+    there is no per-replicate overhead of database access or python loops, but the time is still linear in the number
+    of replicates. Nothing is written to the database. Social groups are not modeled, as their fitting keeps numbers of
+    people of each house, age and sex unchanged. Houses loads are taken at the year start, as with age-parallel
+    balancing.
+    """
+    if rng is None:
+        rng = np.random.default_rng(seed=int(time.time()))
+    ages = forecasted_ages.men.shape[1]
+
+    use_houses_subset(start_engine, houses_ids)
+    with start_engine.connect() as conn:
+        houses, capacities, base_men, base_women = _read_base_houses(conn, territory_id, base_year, ages, houses_ids)
+    logger.debug("Forecasting ensemble of {} replicates of {} houses", replicates, len(houses))
+
+    men = np.broadcast_to(base_men, (replicates,) + base_men.shape).copy()
+    women = np.broadcast_to(base_women, (replicates,) + base_women.shape).copy()
+    years = [base_year + i for i in range(1, forecasted_ages.men.shape[0])]
+    houses_frames = []
+    for year_idx, year in enumerate(years, 1):
+        men = np.concatenate([np.zeros_like(men[..., :1]), men[..., :-1]], axis=2)
+        women = np.concatenate([np.zeros_like(women[..., :1]), women[..., :-1]], axis=2)
+        men = _balance_sex(men, forecasted_ages.men.iloc[year_idx].to_numpy(dtype=np.int64), capacities, rng)
+        women = _balance_sex(women, forecasted_ages.women.iloc[year_idx].to_numpy(dtype=np.int64), capacities, rng)
+
+        houses_frames.append(
+            pd.concat(
+                [
+                    _quantile_frame(men.sum(axis=2), quantiles, "men"),
+                    _quantile_frame(women.sum(axis=2), quantiles, "women"),
+                ],
+                axis=1,
+            ).set_axis(pd.MultiIndex.from_product([[year], houses], names=["year", "house_id"]))
+        )
+
+    return EnsembleForecast(replicates, quantiles, pd.concat(houses_frames))
@@ -0,0 +1,95 @@
+"""Lazy house-level forecast of a territory is defined here."""
+from __future__ import annotations
+
+from typing import Literal
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+from sqlalchemy import Engine, create_engine
+
+from .ages import ForecastedAges
+from .people import forecast_people
+
+
+class LazyForecast:  # pylint: disable=too-many-instance-attributes
+    """Territory forecast which keeps only the forecasted ages trajectory and materializes house-level population of a
+    year (and all of the years before it which are not materialized yet) when it is first requested.
+
+    Materialized years are saved to their databases from `years_dsns` with forecast checkpoints, so they are reused by
+    the later requests (and by other `LazyForecast` instances over the same databases) instead of being forecasted
+    again. As the forecast continues from the random generator state saved in the last checkpoint, the result is the
+    same as the one of `forecast_people` run for all of the years with the generator seeded by `seed`.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        start_engine: Engine,
+        territory_id: int,
+        scenario: Literal["NEGATIVE", "NEUTRAL", "POSITIVE"],
+        forecasted_ages: ForecastedAges,
+        years_dsns: list[str],
+        base_year: int,
+        houses_ids: list[int] | None = None,
+        seed: int | None = None,
+    ):
+        if len(years_dsns) != forecasted_ages.men.shape[0] - 1:
+            raise ValueError(
+                f"Expected {forecasted_ages.men.shape[0] - 1} years databases, got {len(years_dsns)} of them"
+            )
+        self.start_engine = start_engine
+        self.territory_id = territory_id
+        self.scenario = scenario
+        self.forecasted_ages = forecasted_ages
+        self.years_dsns = years_dsns
+        self.base_year = base_year
+        self.houses_ids = houses_ids
+        self.seed = seed if seed is not None else int(np.random.default_rng().integers(0, 2**63))
+        self._engines: dict[int, Engine] = {}
+
+    @property
+    def years(self) -> list[int]:
+        """Forecasted years."""
+        return list(range(self.base_year + 1, self.base_year + len(self.years_dsns) + 1))
+
+    def pyramid(self, year: int) -> pd.DataFrame:
+        """Get forecasted numbers of men and women by age of the given year (or of the base year) without
+        materializing house-level population."""
+        year_idx = self._year_idx(year, allow_base=True)
+        return pd.DataFrame(
+            {"men": self.forecasted_ages.men.iloc[year_idx], "women": self.forecasted_ages.women.iloc[year_idx]}
+        )
+
+    def is_materialized(self, year: int) -> bool:
+        """Check if house-level population of the given year was materialized by this instance."""
+        return year in self._engines
+
+    def materialize(self, year: int) -> Engine:
+        """Get engine of the database with house-level population of the given year, forecasting it (and the years
+        before it) if needed."""
+        if year in self._engines:
+            return self._engines[year]
+        year_idx = self._year_idx(year)
+        logger.info("Materializing house-level forecast of territory_id {} for the year {}", self.territory_id, year)
+        forecast_people(
+            self.start_engine,
+            self.territory_id,
+            self.scenario,
+            self.forecasted_ages,
+            self.years_dsns[:year_idx],
+            self.base_year,
+            houses_ids=self.houses_ids,
+            rng=np.random.default_rng(self.seed),
+            resume=True,
+        )
+        for materialized_year, year_dsn in zip(self.years[:year_idx], self.years_dsns):
+            if materialized_year not in self._engines:
+                self._engines[materialized_year] = create_engine(year_dsn)
+        return self._engines[year]
+
+    def _year_idx(self, year: int, allow_base: bool = False) -> int:
+        """Get index of the given year in the forecasted ages."""
+        year_idx = year - self.base_year
+        if not (0 if allow_base else 1) <= year_idx <= len(self.years_dsns):
+            raise ValueError(f"Year {year} is out of the forecasted years ({self.years[0]}-{self.years[-1]})")
+        return year_idx
@@ -0,0 +1,540 @@
+"""Age-sharded parallel balancing of a forecast year is defined here.
+
+People of a given age are balanced independently of other ages, so a forecast year is split into age partitions each
+of them being balanced by a worker process in its own private in-memory SQLite database. Workers get houses loads
+snapshot of the year start and a random stream spawned for the given age, so results do not depend on the number of
+workers. Balanced partitions are merged back into the year database in one bulk write.
+
+The same cells can also be scheduled across the years boundaries in a dependency-aware wavefront, see
+`forecast_people_wavefront`, and several scenarios can share one wavefront, see `forecast_scenarios_wavefront`.
+"""
+from __future__ import annotations
+
+import heapq
+import multiprocessing as mp
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable
+
+import numpy as np
+from loguru import logger
+from sqlalchemy import Connection, Engine, Select, create_engine, delete, insert, select
+
+from population_restorator.db.entities import (
+    t_houses_tmp,
+    t_population_divided,
+    t_social_groups_distribution,
+    t_social_groups_probabilities,
+)
+from population_restorator.db.ops import SummaryCells, houses_filter, prepare_db, use_houses_subset, write_year_summary
+
+from .ages import ForecastedAges
+from .balancing import (
+    balance_year_additional_social_groups,
+    balance_year_age,
+    balance_year_age_primary_social_groups,
+)
+from .balancing.age_sex import HousesLoads, get_houses_loads
+
+
+_PARTITION_COLUMNS = (
+    t_population_divided.c.house_id,
+    t_population_divided.c.social_group_id,
+    t_population_divided.c.men,
+    t_population_divided.c.women,
+)
+
+_worker_engine: Engine | None = None
+_worker_loads: HousesLoads | None = None
+
+
+@dataclass
+class _AgeTask:  # pylint: disable=too-many-instance-attributes
+    """Balancing task of a single (year, age) partition."""
+
+    territory_id: int
+    year: int
+    age: int
+    men_needed: int
+    women_needed: int
+    houses_ids: list[int] | None
+    seed: np.random.SeedSequence
+    rows: list[tuple[int, int, int, int]]
+    houses_loads: HousesLoads | None = None
+
+
+def _init_worker(
+    reference: dict[str, list[dict[str, Any]]], houses_loads: HousesLoads, houses_ids: list[int] | None
+) -> None:
+    """Create worker private in-memory database with reference tables filled and houses subset registered."""
+    global _worker_engine, _worker_loads  # pylint: disable=global-statement
+    _worker_engine = create_engine("sqlite://")
+    _worker_loads = houses_loads
+    use_houses_subset(_worker_engine, houses_ids)
+    with _worker_engine.connect() as conn:
+        prepare_db(conn)
+        for table in (t_social_groups_probabilities, t_social_groups_distribution):
+            if len(reference[table.name]) > 0:
+                conn.execute(insert(table), reference[table.name])
+        conn.commit()
+
+
+def _balance_age_partition(task: _AgeTask) -> tuple[int, list[tuple[int, int, int, int]]]:
+    """Balance people of the given age in the worker private database and return balanced partition."""
+    logger.debug("Forecasting year {} - age {}", task.year, task.age)
+    rng = np.random.default_rng(task.seed)
+    with _worker_engine.connect() as conn:
+        conn.execute(delete(t_population_divided))
+        if len(task.rows) > 0:
+            conn.execute(
+                insert(t_population_divided),
+                [
+                    {
+                        "year": task.year,
+                        "territory_id": task.territory_id,
+                        "age": task.age,
+                        "house_id": house_id,
+                        "social_group_id": sg_id,
+                        "men": men,
+                        "women": women,
+                    }
+                    for house_id, sg_id, men, women in task.rows
+                ],
+            )
+        balance_year_age(
+            conn,
+            task.territory_id,
+            task.age,
+            task.men_needed,
+            task.women_needed,
+            task.year,
+            task.houses_ids,
+            rng,
+            houses_loads=(task.houses_loads if task.houses_loads is not None else _worker_loads),
+        )
+        balance_year_age_primary_social_groups(conn, task.territory_id, task.year, task.age, task.houses_ids, rng)
+        balance_year_additional_social_groups(conn, task.territory_id, task.year, task.age, task.houses_ids, rng)
+        rows = [
+            tuple(row)
+            for row in conn.execute(
+                select(*_PARTITION_COLUMNS).order_by(
+                    t_population_divided.c.house_id, t_population_divided.c.social_group_id
+                )
+            )
+        ]
+        conn.rollback()
+    return task.age, rows
+
+
+def _read_reference(conn: Connection) -> dict[str, list[dict[str, Any]]]:
+    """Read social groups tables needed by balancing methods."""
+    return {
+        table.name: [dict(row) for row in conn.execute(select(table)).mappings()]
+        for table in (t_social_groups_probabilities, t_social_groups_distribution)
+    }
+
+
+def year_partitions_select(territory_id: int, year: int, houses_ids: list[int] | None) -> Select:
+    """Get population of the given year ordered by age, house and social group statement."""
+    return (
+        select(t_population_divided.c.age, *_PARTITION_COLUMNS)
+        .where(
+            t_population_divided.c.year == year,
+            t_population_divided.c.territory_id == territory_id,
+            houses_filter(t_population_divided.c.house_id, houses_ids),
+        )
+        .order_by(t_population_divided.c.age, t_population_divided.c.house_id, t_population_divided.c.social_group_id)
+    )
+
+
+def _read_year_partitions(
+    conn: Connection, territory_id: int, year: int, houses_ids: list[int] | None
+) -> dict[int, list[tuple[int, int, int, int]]]:
+    """Read population of the given year split by age."""
+    partitions: dict[int, list[tuple[int, int, int, int]]] = {}
+    for age, house_id, sg_id, men, women in conn.execute(year_partitions_select(territory_id, year, houses_ids)):
+        partitions.setdefault(age, []).append((house_id, sg_id, men, women))
+    return partitions
+
+
+def _write_year_partitions(
+    conn: Connection,
+    territory_id: int,
+    year: int,
+    houses_ids: list[int] | None,
+    partitions: dict[int, list[tuple[int, int, int, int]]],
+) -> None:
+    """Replace population of the given year with the given age partitions in one bulk write."""
+    conn.execute(
+        delete(t_population_divided).where(
+            t_population_divided.c.year == year,
+            t_population_divided.c.territory_id == territory_id,
+            houses_filter(t_population_divided.c.house_id, houses_ids),
+        )
+    )
+    values = [
+        {
+            "year": year,
+            "territory_id": territory_id,
+            "age": age,
+            "house_id": house_id,
+            "social_group_id": sg_id,
+            "men": men,
+            "women": women,
+        }
+        for age in sorted(partitions)
+        for house_id, sg_id, men, women in partitions[age]
+    ]
+    if len(values) > 0:
+        conn.execute(insert(t_population_divided), values)
+
+
+def balance_year_parallel(  # pylint: disable=too-many-arguments,too-many-locals
+    year_engine: Engine,
+    territory_id: int,
+    year: int,
+    year_idx: int,
+    forecasted_ages: ForecastedAges,
+    houses_ids: list[int] | None,
+    rng: np.random.Generator,
+    workers: int,
+) -> SummaryCells:
+    """Balance people of every age of the given year with age partitions distributed between `workers` processes.
+
+    A single seed is drawn from `rng` for the year, and every age gets its own random stream spawned from it, so
+    the result is the same for any number of workers. Houses loads used to settle new people are taken at the moment
+    of the year start for every age.
+
+    Returns summary cells of the balanced year aggregated from the partitions written.
+    """
+    use_houses_subset(year_engine, houses_ids)
+    with year_engine.connect() as conn:
+        reference = _read_reference(conn)
+        partitions = _read_year_partitions(conn, territory_id, year, houses_ids)
+        houses_loads = HousesLoads(
+            get_houses_loads(conn, territory_id, year, True), get_houses_loads(conn, territory_id, year, False)
+        )
+
+    ages = list(forecasted_ages.men.columns)
+    seeds = np.random.SeedSequence(int(rng.integers(0, 2**63))).spawn(len(ages))
+    tasks = [
+        _AgeTask(
+            territory_id,
+            year,
+            age,
+            int(forecasted_ages.men.iat[year_idx, j]),
+            int(forecasted_ages.women.iat[year_idx, j]),
+            houses_ids,
+            seed,
+            partitions.get(age, []),
+        )
+        for j, (age, seed) in enumerate(zip(ages, seeds))
+    ]
+    tasks.sort(key=lambda task: len(task.rows), reverse=True)
+
+    balanced = dict(partitions)
+    if workers == 1:
+        _init_worker(reference, houses_loads, houses_ids)
+        balanced.update(map(_balance_age_partition, tasks))
+    else:
+        with mp.Pool(workers, initializer=_init_worker, initargs=(reference, houses_loads, houses_ids)) as pool:
+            balanced.update(pool.imap_unordered(_balance_age_partition, tasks))
+
+    with year_engine.connect() as conn:
+        _write_year_partitions(conn, territory_id, year, houses_ids, balanced)
+        conn.commit()
+    return _partitions_summary_cells(
+        balanced, {sg["id"] for sg in reference[t_social_groups_probabilities.name] if sg["is_primary"]}
+    )
+
+
+def _fertile_women_loads(
+    partitions: dict[int, list[tuple[int, int, int, int]]],
+    fertility_ages: range,
+    primary_sgs: set[int],
+    capacities: dict[int, float],
+) -> dict[int, float]:
+    """Get houses loads by fertile women of primary social groups (used to settle newborns)."""
+    women: dict[int, int] = {}
+    for age in fertility_ages:
+        for house_id, sg_id, _, house_women in partitions.get(age, []):
+            if sg_id in primary_sgs:
+                women[house_id] = women.get(house_id, 0) + house_women
+    return {
+        house_id: number / capacities[house_id]
+        for house_id, number in women.items()
+        if number > 0 and capacities.get(house_id, 0) > 0
+    }
+
+
+@dataclass
+class ScenarioRun:
+    """Forecast of a single scenario in a wavefront: forecasted ages, databases DSNs to save forecasted years to and
+    fertility ages range used to settle newborns."""
+
+    scenario: str
+    forecasted_ages: ForecastedAges
+    years_dsns: list[str]
+    fertility_begin: int
+    fertility_end: int
+
+
+@dataclass
+class _BaseYear:
+    """Snapshot of the base year population and reference data shared read-only between scenario runs."""
+
+    year: int
+    reference: dict[str, list[dict[str, Any]]]
+    partitions: dict[int, list[tuple[int, int, int, int]]]
+    houses_loads: HousesLoads
+    capacities: dict[int, float]
+    primary_sgs: set[int]
+
+
+def _load_base_year(conn: Connection, territory_id: int, base_year: int, houses_ids: list[int] | None) -> _BaseYear:
+    """Read base year population split by age along with reference tables, houses loads and capacities."""
+    reference = _read_reference(conn)
+    return _BaseYear(
+        base_year,
+        reference,
+        _read_year_partitions(conn, territory_id, base_year, houses_ids),
+        HousesLoads(
+            get_houses_loads(conn, territory_id, base_year, True),
+            get_houses_loads(conn, territory_id, base_year, False),
+        ),
+        dict(conn.execute(select(t_houses_tmp.c.id, t_houses_tmp.c.capacity)).all()),
+        {sg["id"] for sg in reference[t_social_groups_probabilities.name] if sg["is_primary"]},
+    )
+
+
+class _ScenarioWavefront:  # pylint: disable=too-many-instance-attributes
+    """Wavefront state of a single scenario run: balanced cells by year, number of unmet dependencies of every cell
+    and index of the next year to be saved."""
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self, run: ScenarioRun, base: _BaseYear, territory_id: int, houses_ids: list[int] | None, root_entropy: int
+    ):
+        self.run = run
+        self.base = base
+        self.territory_id = territory_id
+        self.houses_ids = houses_ids
+        self.root_entropy = root_entropy
+        self.ages = list(run.forecasted_ages.men.columns)
+        self.fertility_ages = range(max(run.fertility_begin, self.ages[0]), min(run.fertility_end, self.ages[-1]) + 1)
+        self.years_dsns = list(run.years_dsns)[: run.forecasted_ages.men.shape[0] - 1]
+        self.years = [base.year + i for i in range(1, len(self.years_dsns) + 1)]
+        self.balanced: dict[int, dict[int, list[tuple[int, int, int, int]]]] = {base.year: base.partitions}
+        for year in self.years:
+            self.balanced[year] = {}
+        self.unmet = {
+            (year, age): (len(self.fertility_ages) if age == 0 else 1) if year != self.years[0] else 0
+            for year in self.years
+            for age in self.ages
+        }
+        self.next_year_idx = 0
+
+    def initial_cells(self) -> list[tuple[int, int]]:
+        """Get cells which do not depend on other cells."""
+        return [cell for cell, deps in self.unmet.items() if deps == 0]
+
+    def make_task(self, year: int, age: int) -> _AgeTask:
+        """Get balancing task of the given cell, its predecessors must be balanced already."""
+        forecasted_ages = self.run.forecasted_ages
+        year_idx = year - self.base.year
+        previous = self.balanced[year - 1]
+        houses_loads = None
+        if age == 0:
+            newborns_loads = _fertile_women_loads(
+                previous, self.fertility_ages, self.base.primary_sgs, self.base.capacities
+            )
+            if len(newborns_loads) > 0:
+                houses_loads = HousesLoads(newborns_loads, newborns_loads)
+        return _AgeTask(
+            self.territory_id,
+            year,
+            age,
+            int(forecasted_ages.men.iat[year_idx, self.ages.index(age)]),
+            int(forecasted_ages.women.iat[year_idx, self.ages.index(age)]),
+            self.houses_ids,
+            np.random.SeedSequence(self.root_entropy, spawn_key=(year, age)),
+            list(previous.get(age - 1, [])) if age > 0 else [],
+            houses_loads,
+        )
+
+    def complete(self, year: int, age: int, rows: list[tuple[int, int, int, int]]) -> list[tuple[int, int]]:
+        """Save balanced cell and return cells which became ready to be balanced."""
+        self.balanced[year][age] = rows
+        if year + 1 not in self.balanced:
+            return []
+        ready = []
+        for successor in [(year + 1, age + 1)] + ([(year + 1, 0)] if age in self.fertility_ages else []):
+            if successor in self.unmet:
+                self.unmet[successor] -= 1
+                if self.unmet[successor] == 0:
+                    ready.append(successor)
+        return ready
+
+    def save_finished_years(self, start_engine: Engine, callback: Callable[[int, int, str, Engine]] | None) -> None:
+        """Save all of the fully balanced years in order and forget the population of the years before them."""
+        while self.next_year_idx < len(self.years) and len(self.balanced[self.years[self.next_year_idx]]) == len(
+            self.ages
+        ):
+            year, year_dsn = self.years[self.next_year_idx], self.years_dsns[self.next_year_idx]
+            year_engine = create_engine(year_dsn)
+            use_houses_subset(year_engine, self.houses_ids)
+            with year_engine.connect() as year_conn, start_engine.connect() as start_conn:
+                prepare_db(year_conn, start_conn)
+                _write_year_partitions(year_conn, self.territory_id, year, self.houses_ids, self.balanced[year])
+                cells = _partitions_summary_cells(self.balanced[year], self.base.primary_sgs)
+                write_year_summary(year_conn, self.run.scenario, self.territory_id, year, cells)
+                year_conn.commit()
+            _log_partitions_totals(self.territory_id, year, cells)
+            if callback is not None:
+                callback(year, self.territory_id, self.run.scenario, year_engine)
+            year_engine.dispose()
+            self.balanced.pop(year - 1, None)
+            self.next_year_idx += 1
+
+
+def forecast_scenarios_wavefront(  # pylint: disable=too-many-arguments,too-many-locals
+    start_engine: Engine,
+    territory_id: int,
+    runs: Iterable[ScenarioRun],
+    base_year: int,
+    houses_ids: list[int] | None = None,
+    rng: np.random.Generator | None = None,
+    callback: Callable[[int, int, str, Engine]] | None = None,
+    workers: int = 2,
+) -> None:
+    """Forecast people of several scenarios at once with (scenario, year, age) balancing cells of all of them
+    scheduled in a single diagonal wavefront on a shared pool of `workers` processes.
+
+    The base year is read from `start_engine` once and its snapshot is shared read-only between the scenario runs.
+    Cells are dispatched in years order, so scenarios move forward together and total time is close to the time of a
+    single scenario given enough workers. All of the scenarios use the same random streams for the same (year, age)
+    cell (common random numbers), so differences between them come from the scenario parameters and not from sampling.
+
+    See `forecast_people_wavefront` for the description of a single scenario run.
+    """
+    if rng is None:
+        rng = np.random.default_rng(seed=int(time.time()))
+
+    use_houses_subset(start_engine, houses_ids)
+    with start_engine.connect() as conn:
+        base = _load_base_year(conn, territory_id, base_year, houses_ids)
+
+    root_entropy = int(rng.integers(0, 2**63))
+    wavefronts = [_ScenarioWavefront(run, base, territory_id, houses_ids, root_entropy) for run in runs]
+    ready: list[tuple[int, int, int]] = [
+        (year, age, run_idx) for run_idx, wavefront in enumerate(wavefronts) for year, age in wavefront.initial_cells()
+    ]
+    heapq.heapify(ready)
+
+    def submit_next() -> tuple[int, _AgeTask]:
+        year, age, run_idx = heapq.heappop(ready)
+        return run_idx, wavefronts[run_idx].make_task(year, age)
+
+    def complete(run_idx: int, year: int, age: int, rows: list[tuple[int, int, int, int]]) -> None:
+        for next_year, next_age in wavefronts[run_idx].complete(year, age, rows):
+            heapq.heappush(ready, (next_year, next_age, run_idx))
+
+    def save_finished_years() -> None:
+        for wavefront in wavefronts:
+            wavefront.save_finished_years(start_engine, callback)
+
+    if workers == 1:
+        _init_worker(base.reference, base.houses_loads, houses_ids)
+        while len(ready) > 0:
+            complete(*_run_cell(*submit_next()))
+            save_finished_years()
+        return
+
+    with ProcessPoolExecutor(
+        workers, initializer=_init_worker, initargs=(base.reference, base.houses_loads, houses_ids)
+    ) as executor:
+        running: set[Future] = set()
+        while len(ready) > 0 or len(running) > 0:
+            while len(ready) > 0 and len(running) < workers * 2:
+                running.add(executor.submit(_run_cell, *submit_next()))
+            finished, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                complete(*future.result())
+            save_finished_years()
+
+
+def forecast_people_wavefront(  # pylint: disable=too-many-arguments
+    start_engine: Engine,
+    territory_id: int,
+    scenario: str,
+    forecasted_ages: ForecastedAges,
+    years_dsns: Iterable[str],
+    base_year: int,
+    fertility_begin: int,
+    fertility_end: int,
+    houses_ids: list[int] | None = None,
+    rng: np.random.Generator | None = None,
+    callback: Callable[[int, int, str, Engine]] | None = None,
+    workers: int = 2,
+) -> None:
+    """Forecast people with (year, age) balancing cells scheduled in a diagonal wavefront across the years.
+
+    People of the age `a` in the year `y` are the people of the age `a - 1` of the year `y - 1` got older, so the cell
+    is balanced as soon as its predecessor is done, without waiting for the whole previous year. Newborns cell of the
+    year `y` depends on the cells of fertile ages (from `fertility_begin` to `fertility_end`) of the year `y - 1` and
+    babies are settled to houses proportionally to their fertile women load. Other cells settle new people using
+    houses loads of the base year. Every cell has its own random stream derived from a single seed drawn from `rng`, so
+    the result does not depend on the number of workers.
+
+    Years are saved to the databases opened by `years_dsns` in order as soon as all of their cells are balanced, then
+    the callback (if given) is called the same way as in `forecast_people`.
+    """
+    forecast_scenarios_wavefront(
+        start_engine,
+        territory_id,
+        [ScenarioRun(scenario, forecasted_ages, list(years_dsns), fertility_begin, fertility_end)],
+        base_year,
+        houses_ids,
+        rng,
+        callback,
+        workers,
+    )
+
+
+def _run_cell(run_idx: int, task: _AgeTask) -> tuple[int, int, int, list[tuple[int, int, int, int]]]:
+    """Balance a single (year, age) cell of the given scenario run returning run index, year, age and balanced
+    partition."""
+    age, rows = _balance_age_partition(task)
+    return run_idx, task.year, age, rows
+
+
+def _partitions_summary_cells(
+    partitions: dict[int, list[tuple[int, int, int, int]]], primary_sgs: set[int]
+) -> SummaryCells:
+    """Aggregate balanced age partitions by age and social group without reading the year database."""
+    cells: dict[tuple[int, int, bool], tuple[int, int]] = {}
+    for age, rows in partitions.items():
+        for _, sg_id, house_men, house_women in rows:
+            men, women = cells.get((age, sg_id, sg_id in primary_sgs), (0, 0))
+            cells[(age, sg_id, sg_id in primary_sgs)] = (men + house_men, women + house_women)
+    return cells
+
+
+def _log_partitions_totals(territory_id: int, year: int, cells: SummaryCells) -> None:
+    """Send balanced year population totals in the logger info sink."""
+    men = women = additionals = 0
+    for (_, _, is_primary), (cell_men, cell_women) in cells.items():
+        if is_primary:
+            men += cell_men
+            women += cell_women
+        else:
+            additionals += cell_men + cell_women
+    logger.info(
+        "Year {}, forecast for territory_id {}, men population: {}, female: {}."
+        " Total additional social groups count: {}",
+        year,
+        territory_id,
+        men,
+        women,
+        additionals,
+    )
@@ -1,90 +1,96 @@
 """Methods to forecast people are defined here."""
 from __future__ import annotations
 
-import multiprocessing as mp
+import hashlib
+import itertools
 import time
-from typing import Callable, Iterable, Literal
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable, Iterator, Literal
 
 import numpy as np
+import pandas as pd
 from loguru import logger
-from sqlalchemy import Connection, Engine, create_engine, delete, false, func, insert, select, true
+from sqlalchemy import Connection, Engine, create_engine, delete, func, select
 
-from population_restorator.db.entities import t_population_divided, t_social_groups_probabilities
-from population_restorator.db.ops import prepare_db
+from population_restorator.db.entities import t_population_divided
+from population_restorator.db.ops import (
+    SummaryCells,
+    clone_population_year,
+    delete_checkpoint,
+    get_valid_checkpoint,
+    get_year_totals,
+    houses_filter,
+    prepare_db,
+    prepare_store,
+    save_checkpoint,
+    save_forecast_year,
+    use_houses_subset,
+    write_year_summary,
+)
 from population_restorator.forecaster.ages import ForecastedAges
 
-from .balancing import balance_year_additional_social_groups, balance_year_age, balance_year_age_primary_social_groups
+from .parallel import balance_year_parallel
+from .query_plans import check_query_plans
 
 
 func: Callable
 
 
-def _balance_year_age(  # pylint: disable=too-many-arguments
-    engine: Engine,
-    territory_id: int,
-    year: int,
-    age: int,
-    men_needed: int,
-    women_needed: int,
-    houses_ids: list[int] | None,
-    rng: np.random.Generator,
-) -> None:
-    """Perform forecasting people balancing of a given year and age in a temporary database"""
-    logger.debug("Forecasting year {} - age {}", year, age)
+@dataclass
+class YearPeople:
+    """Population division of a forecasted year as columnar arrays of equal length."""
 
-    with engine.connect() as conn:
-        balance_year_age(conn, territory_id, age, men_needed, women_needed, year, houses_ids, rng)
-        balance_year_age_primary_social_groups(conn, year, age, houses_ids, rng)
-        balance_year_additional_social_groups(conn, year, age, houses_ids, rng)
-        conn.commit()
+    house_id: np.ndarray
+    social_group_id: np.ndarray
+    age: np.ndarray
+    men: np.ndarray
+    women: np.ndarray
 
+    def __len__(self) -> int:
+        return len(self.house_id)
 
-def _balance_year_age_mp(  # pylint: disable=too-many-arguments
-    conn_dsn: str,
-    year: int,
-    age: int,
-    men_needed: int,
-    women_needed: int,
-    houses_ids: list[int] | None,
-    rng: np.random.Generator,
-) -> None:
-    """Perform forecasting people balancing of a given year and age in a temporary database"""
-    logger.debug("Forecasting year {} - age {}", year, age)
+    def to_frame(self) -> pd.DataFrame:
+        """Get population division as a dataframe with house_id, social_group_id, age, men and women columns."""
+        return pd.DataFrame(
+            {
+                "house_id": self.house_id,
+                "social_group_id": self.social_group_id,
+                "age": self.age,
+                "men": self.men,
+                "women": self.women,
+            }
+        )
 
-    engine = create_engine(conn_dsn)
 
-    with engine.connect() as conn:
-        balance_year_age(conn, age, men_needed, women_needed, year, houses_ids, rng)
-        balance_year_age_primary_social_groups(conn, year, age, houses_ids, rng)
-        balance_year_additional_social_groups(conn, year, age, houses_ids, rng)
-        conn.commit()
-
-    engine.dispose()
-
-
-def _log_year_results(conn: Connection, territory_id: int, year: int) -> None:
-    """Send current year population in the logger debug sink."""
-    men_year, women_year = conn.execute(
-        select(func.sum(t_population_divided.c.men), func.sum(t_population_divided.c.women))
-        .select_from(t_population_divided)
-        .join(
-            t_social_groups_probabilities, t_population_divided.c.social_group_id == t_social_groups_probabilities.c.id
-        ).where(t_population_divided.c.year == year,
-               t_population_divided.c.territory_id == territory_id,
-               t_social_groups_probabilities.c.is_primary == true())
-    ).fetchone()
-
-    additionals = conn.execute(
-        select(func.sum(t_population_divided.c.men + t_population_divided.c.women))
-        .select_from(t_population_divided)
-        .join(
-            t_social_groups_probabilities, t_population_divided.c.social_group_id == t_social_groups_probabilities.c.id
-        )
-        .where(t_population_divided.c.year == year,
-               t_population_divided.c.territory_id == territory_id, 
-               t_social_groups_probabilities.c.is_primary == false())
-    ).scalar_one()
+@dataclass
+class ForecastYear:
+    """Finished forecast year yielded by `iter_forecast_people`: its summary cells, population division (if it was
+    requested) and the random generator state after the year was balanced."""
+
+    year: int
+    territory_id: int
+    scenario: str
+    summary: SummaryCells
+    people: YearPeople | None
+    rng_state: dict[str, Any]
 
+    @property
+    def totals(self) -> tuple[int, int, int]:
+        """Total numbers of men and women of primary social groups and total number of people of additional social
+        groups."""
+        men = women = additionals = 0
+        for (_, _, is_primary), (cell_men, cell_women) in self.summary.items():
+            if is_primary:
+                men += cell_men
+                women += cell_women
+            else:
+                additionals += cell_men + cell_women
+        return men, women, additionals
+
+
+def _log_year_results(conn: Connection, scenario: str, territory_id: int, year: int) -> None:
+    """Send current year population totals read from the year summary in the logger info sink."""
+    men_year, women_year, additionals = get_year_totals(conn, scenario, territory_id, year)
     logger.info(
         "Year {}, forecast for territory_id {}, men population: {}, female: {}. Total additional social groups count: {}",
         year,
@@ -95,6 +101,101 @@ def _log_year_results(conn: Connection, territory_id: int, year: int) -> None:
     )
 
 
+def _get_max_age(engine: Engine, territory_id: int) -> int:
+    """Get maximum age of people of the given territory."""
+    with engine.connect() as conn:
+        return conn.execute(
+            select(func.max(t_population_divided.c.age)).where(t_population_divided.c.territory_id == territory_id)
+        ).scalar_one()
+
+
+def _clone_year(  # pylint: disable=too-many-arguments
+    year_engine: Engine,
+    previous_engine: Engine,
+    territory_id: int,
+    year: int,
+    max_age: int,
+    houses_ids: list[int] | None,
+) -> None:
+    """Prepare year database and fill it with the previous year people who got one year older."""
+    with year_engine.connect() as year_conn, previous_engine.connect() as prev_conn:
+        prepare_db(year_conn, prev_conn)
+        logger.debug(
+            "Cloning year {} -> {} database",
+            year - 1,
+            year,
+        )
+        year_conn.execute(
+            delete(t_population_divided).where(
+                t_population_divided.c.year == year,
+                t_population_divided.c.territory_id == territory_id,
+                houses_filter(t_population_divided.c.house_id, houses_ids),
+            )
+        )
+        year_conn.commit()
+        copied = clone_population_year(year_conn, prev_conn, territory_id, year, max_age, houses_ids)
+        year_conn.commit()
+    if copied == 0:
+        raise RuntimeError(f"Could not clone database of the year {year} - no population_divided entries found")
+
+
+def _balance_year(  # pylint: disable=too-many-arguments
+    year_engine: Engine,
+    territory_id: int,
+    year: int,
+    year_idx: int,
+    forecasted_ages: ForecastedAges,
+    houses_ids: list[int] | None,
+    rng: np.random.Generator,
+    threads: int,
+) -> SummaryCells:
+    """Balance people of every age of the given year to match forecasted number of men and women and return summary
+    cells of the balanced year.
+
+    Every age is balanced with its own random stream spawned from a single seed drawn from `rng` (see
+    `balance_year_parallel`), in the current process if `threads` is 1, so the result does not depend on the number of
+    threads. Summary cells are aggregated from the balanced age partitions in memory, the year table is not aggregated
+    again after balancing.
+    """
+    return balance_year_parallel(year_engine, territory_id, year, year_idx, forecasted_ages, houses_ids, rng, threads)
+
+
+def year_targets_digest(forecasted_ages: ForecastedAges, year_idx: int) -> str:
+    """Get digest of forecasted numbers of men and women of the given year index used to validate checkpoints."""
+    return hashlib.sha256(
+        repr((forecasted_ages.men.iloc[year_idx].tolist(), forecasted_ages.women.iloc[year_idx].tolist())).encode()
+    ).hexdigest()
+
+
+def find_resume_point(  # pylint: disable=too-many-arguments
+    years_dsns: list[str],
+    territory_id: int,
+    scenario: str,
+    forecasted_ages: ForecastedAges,
+    base_year: int,
+    houses_ids: list[int] | None,
+) -> tuple[int, dict | None]:
+    """Get number of leading years with valid checkpoints and the random generator state of the last of them."""
+    done, rng_state = 0, None
+    for i, year_dsn in enumerate(years_dsns, 1):
+        year_engine = create_engine(year_dsn)
+        use_houses_subset(year_engine, houses_ids)
+        with year_engine.connect() as year_conn:
+            checkpoint = get_valid_checkpoint(
+                year_conn,
+                scenario,
+                territory_id,
+                base_year + i,
+                year_targets_digest(forecasted_ages, i),
+                houses_ids,
+            )
+        year_engine.dispose()
+        if checkpoint is None:
+            break
+        done, rng_state = i, checkpoint.rng_state
+    return done, rng_state
+
+
 def forecast_people(  # pylint: disable=too-many-locals,too-many-arguments
     start_engine: Engine,
     territory_id: int,
@@ -106,6 +207,8 @@ def forecast_people(  # pylint: disable=too-many-locals,too-many-arguments
     rng: np.random.Generator | None = None,
     callback: Callable[[int, int, str, Engine]] | None = None,
     threads: int = 1,
+    resume: bool = False,
+    check_plans: bool = False,
 ) -> None:
     """Forecast people based on a people division on the start_year, saving each year in its own database connection
     opened by the given iterable `years_databases`.
@@ -116,91 +219,64 @@ def forecast_people(  # pylint: disable=too-many-locals,too-many-arguments
     If `houses_ids` is set, only houses with given ids will be forecasted (useful when the database already contains
     data for other cities for example).
 
-    Threads parameter higher than 1 should only be used with temporary databases supporting simultanious access from
-    multiple workers (not SQLite).
+    Age partitions of each year are balanced in private in-memory databases, each age with its own random stream, and
+    merged back with one bulk write (see `balance_year_parallel`). Threads parameter higher than 1 distributes them
+    between the given number of worker processes, the result does not depend on the number of them.
+
+    After each year is completed, a checkpoint with the random generator state and integrity markers is saved to the
+    year database. With `resume` set, leading years with valid checkpoints (made for the same forecasted numbers of
+    people and with population unchanged since) are reused without calling the callback, and the forecast continues
+    from the last of them with the saved random generator state, giving the same result as an uninterrupted run.
+    This also allows to extend the forecast horizon reusing already forecasted years.
+
+    With `check_plans` set, query plans of the balancing queries are checked on the first forecasted year database
+    before it is balanced, and RuntimeError is raised if any of them performs a full scan (see `check_query_plans`).
     """
     if rng is None:
         rng = np.random.default_rng(seed=int(time.time()))
 
-    with start_engine.connect() as year_conn:
-        max_age = year_conn.execute(
-            select(func.max(t_population_divided.c.age)).where(t_population_divided.c.territory_id == territory_id)
-        ).scalar_one()
+    max_age = _get_max_age(start_engine, territory_id)
+    use_houses_subset(start_engine, houses_ids)
 
-    previous_engine = start_engine
-    for i, year_dsn in enumerate(years_dsns, 1):
+    years_dsns = list(years_dsns)
+    done = 0
+    if resume:
+        done, rng_state = find_resume_point(years_dsns, territory_id, scenario, forecasted_ages, base_year, houses_ids)
+        if done > 0:
+            logger.info("Resuming forecast of territory_id {} after the year {}", territory_id, base_year + done)
+            rng.bit_generator.state = rng_state
+
+    previous_engine = start_engine if done == 0 else create_engine(years_dsns[done - 1])
+    use_houses_subset(previous_engine, houses_ids)
+    for i, year_dsn in enumerate(years_dsns[done:], done + 1):
         year = base_year + i
         year_engine = create_engine(year_dsn)
-        with year_engine.connect() as year_conn, previous_engine.connect() as prev_conn:
-            prepare_db(year_conn, prev_conn)
-            logger.debug(
-                "Cloning year {} -> {} database",
-                year - 1,
-                year,
-            )
-            year_conn.execute(
-                delete(t_population_divided).where(
-                    t_population_divided.c.year == year,
-                    t_population_divided.c.territory_id == territory_id,
-                    (t_population_divided.c.house_id.in_(houses_ids) if houses_ids is not None else true()),
-                )
-            )
-            statement = select(
-                t_population_divided.c.house_id,
-                t_population_divided.c.age,
-                t_population_divided.c.social_group_id,
-                t_population_divided.c.men,
-                t_population_divided.c.women,
-            ).where(
-                t_population_divided.c.year == year - 1,
-                t_population_divided.c.age != max_age,
-                t_population_divided.c.age != 100,
-                t_population_divided.c.territory_id == territory_id,
-                (t_population_divided.c.house_id.in_(houses_ids) if houses_ids is not None else true()),
-            )
-            copied = False
-            for house_id, age, social_group_id, men, women in prev_conn.execute(statement):
-                copied = True
-                year_conn.execute(
-                    insert(t_population_divided).values(
-                        year=year,
-                        age=age + 1,
-                        house_id=house_id,
-                        social_group_id=social_group_id,
-                        territory_id=territory_id,
-                        men=men,
-                        women=women,
-                    )
-                )
+        use_houses_subset(year_engine, houses_ids)
+        with year_engine.connect() as year_conn:
+            delete_checkpoint(year_conn, scenario, territory_id, year)
             year_conn.commit()
-        if not copied:
-            raise RuntimeError(f"Could not clone database of the year {year} - no population_divided entries found")
-
-        if threads == 1:
-            for j, age in enumerate(forecasted_ages.men.columns):
-                men_needed = forecasted_ages.men.iat[i, j]
-                women_needed = forecasted_ages.women.iat[i, j]
-                _balance_year_age(year_engine, territory_id, year, age, men_needed, women_needed, houses_ids, rng) #??
-        else:
-            with mp.Pool(threads) as pool:
-                pool.starmap(
-                    _balance_year_age_mp,
-                    [
-                        (
-                            year_dsn,
-                            year,
-                            age,
-                            forecasted_ages.men.iat[i, j],
-                            forecasted_ages.women.iat[i, j],
-                            houses_ids,
-                            rng,
-                        )
-                        for j, age in enumerate(forecasted_ages.men.columns)
-                    ],
-                )
+        _clone_year(year_engine, previous_engine, territory_id, year, max_age, houses_ids)
+
+        if check_plans and i == done + 1:
+            with year_engine.connect() as year_conn:
+                check_query_plans(year_conn, territory_id, year, houses_ids=houses_ids)
+            logger.info("Query plans of the balancing queries are checked, no full scans found")
+
+        summary = _balance_year(year_engine, territory_id, year, i, forecasted_ages, houses_ids, rng, threads)
 
         with year_engine.connect() as year_conn:
-            _log_year_results(year_conn, territory_id, year)
+            write_year_summary(year_conn, scenario, territory_id, year, summary)
+            _log_year_results(year_conn, scenario, territory_id, year)
+            save_checkpoint(
+                year_conn,
+                scenario,
+                territory_id,
+                year,
+                year_targets_digest(forecasted_ages, i),
+                rng.bit_generator.state,
+                houses_ids,
+            )
+            year_conn.commit()
 
         if callback is not None:
             callback(year, territory_id, scenario, year_engine)
@@ -208,3 +284,165 @@ def forecast_people(  # pylint: disable=too-many-locals,too-many-arguments
         year_engine.dispose()
 
         previous_engine = year_engine
+
+
+def forecast_people_to_store(  # pylint: disable=too-many-locals,too-many-arguments
+    start_engine: Engine,
+    store_engine: Engine,
+    territory_id: int,
+    scenario: Literal["NEGATIVE", "NEUTRAL", "POSITIVE"],
+    forecasted_ages: ForecastedAges,
+    base_year: int,
+    houses_ids: list[int] | None = None,
+    rng: np.random.Generator | None = None,
+    callback: Callable[[int, int, str, Engine]] | None = None,
+    threads: int = 1,
+    scratch_dsn: str = "sqlite://",
+) -> None:
+    """Forecast people based on a people division on the start_year, saving all of the years forecasted in a single
+    forecast store database (`population_forecast` table partitioned by scenario, year and territory_id) with reference
+    tables shared between them. Each of the years from `forecasted_ages` following the `base_year` is forecasted.
+
+    Years are balanced in a scratch database opened by `scratch_dsn` (in-memory SQLite by default) which keeps only the
+    current and the previous years, so the per-year setup is a single INSERT ... SELECT inside of it.
+
+    If the callback is given, after another year calculations are done and saved, calls a given function with the year,
+    territory_id, scenario and the forecast store engine.
+
+    `houses_ids` and `threads` parameters have the same meaning as in `forecast_people`.
+    """
+    if rng is None:
+        rng = np.random.default_rng(seed=int(time.time()))
+
+    max_age = _get_max_age(start_engine, territory_id)
+
+    with store_engine.connect() as store_conn, start_engine.connect() as start_conn:
+        prepare_store(store_conn, start_conn)
+        store_conn.commit()
+
+    scratch_engine = create_engine(scratch_dsn)
+    for engine in (start_engine, store_engine, scratch_engine):
+        use_houses_subset(engine, houses_ids)
+    previous_engine = start_engine
+    for i in range(1, forecasted_ages.men.shape[0]):
+        year = base_year + i
+        _clone_year(scratch_engine, previous_engine, territory_id, year, max_age, houses_ids)
+
+        summary = _balance_year(scratch_engine, territory_id, year, i, forecasted_ages, houses_ids, rng, threads)
+
+        with scratch_engine.connect() as scratch_conn, store_engine.connect() as store_conn:
+            save_forecast_year(store_conn, scratch_conn, scenario, territory_id, year, houses_ids)
+            write_year_summary(store_conn, scenario, territory_id, year, summary)
+            _log_year_results(store_conn, scenario, territory_id, year)
+            store_conn.commit()
+            scratch_conn.execute(
+                delete(t_population_divided).where(
+                    t_population_divided.c.year == year - 1,
+                    t_population_divided.c.territory_id == territory_id,
+                )
+            )
+            scratch_conn.commit()
+
+        if callback is not None:
+            callback(year, territory_id, scenario, store_engine)
+
+        previous_engine = scratch_engine
+
+    scratch_engine.dispose()
+
+
+def _read_year_people(conn: Connection, territory_id: int, year: int, houses_ids: list[int] | None) -> YearPeople:
+    """Read population division of the given year to columnar arrays ordered by house, age and social group."""
+    rows = conn.execute(
+        select(
+            t_population_divided.c.house_id,
+            t_population_divided.c.social_group_id,
+            t_population_divided.c.age,
+            t_population_divided.c.men,
+            t_population_divided.c.women,
+        )
+        .where(
+            t_population_divided.c.year == year,
+            t_population_divided.c.territory_id == territory_id,
+            houses_filter(t_population_divided.c.house_id, houses_ids),
+        )
+        .order_by(t_population_divided.c.house_id, t_population_divided.c.age, t_population_divided.c.social_group_id)
+    ).all()
+    columns = np.fromiter(itertools.chain.from_iterable(rows), dtype=np.int64, count=len(rows) * 5).reshape(-1, 5).T
+    return YearPeople(*columns)
+
+
+def iter_forecast_people(  # pylint: disable=too-many-arguments,too-many-locals
+    start_engine: Engine,
+    territory_id: int,
+    scenario: Literal["NEGATIVE", "NEUTRAL", "POSITIVE"],
+    forecasted_ages: ForecastedAges,
+    base_year: int,
+    houses_ids: list[int] | None = None,
+    rng: np.random.Generator | None = None,
+    threads: int = 1,
+    with_people: bool = True,
+    scratch_dsn: str = "sqlite://",
+    max_age: int | None = None,
+) -> Iterator[ForecastYear]:
+    """Forecast people based on a people division on the start_year yielding each of the years as soon as it is
+    balanced, without saving them anywhere.
+
+    Years are balanced in a scratch database opened by `scratch_dsn` (in-memory SQLite by default) which keeps only the
+    current and the previous years, and the next year is balanced only when it is requested from the generator. Every
+    yielded year contains its summary cells, and with `with_people` set also its whole population division as
+    columnar arrays.
+
+    `houses_ids` and `threads` parameters have the same meaning as in `forecast_people`, and the result is the same as
+    the one of `forecast_people` run with the same random generator.
+
+    `max_age` (people of this age are not carried to the next year) is read from `start_engine` if not given, it must
+    be set when `start_engine` is not the base year database (e.g. when a forecast is resumed from one of the
+    forecasted years).
+    """
+    if rng is None:
+        rng = np.random.default_rng(seed=int(time.time()))
+
+    if max_age is None:
+        max_age = _get_max_age(start_engine, territory_id)
+
+    scratch_engine = create_engine(scratch_dsn)
+    for engine in (start_engine, scratch_engine):
+        use_houses_subset(engine, houses_ids)
+    previous_engine = start_engine
+    try:
+        for i in range(1, forecasted_ages.men.shape[0]):
+            year = base_year + i
+            _clone_year(scratch_engine, previous_engine, territory_id, year, max_age, houses_ids)
+
+            summary = _balance_year(scratch_engine, territory_id, year, i, forecasted_ages, houses_ids, rng, threads)
+
+            with scratch_engine.connect() as scratch_conn:
+                forecasted_year = ForecastYear(
+                    year,
+                    territory_id,
+                    scenario,
+                    summary,
+                    _read_year_people(scratch_conn, territory_id, year, houses_ids) if with_people else None,
+                    rng.bit_generator.state,
+                )
+                scratch_conn.execute(
+                    delete(t_population_divided).where(
+                        t_population_divided.c.year == year - 1,
+                        t_population_divided.c.territory_id == territory_id,
+                    )
+                )
+                scratch_conn.commit()
+            logger.info(
+                "Year {}, forecast for territory_id {}, men population: {}, female: {}."
+                " Total additional social groups count: {}",
+                year,
+                territory_id,
+                *forecasted_year.totals,
+            )
+
+            yield forecasted_year
+
+            previous_engine = scratch_engine
+    finally:
+        scratch_engine.dispose()
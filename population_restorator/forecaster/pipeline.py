@@ -0,0 +1,250 @@
+"""Pipelined (write-behind) forecast saving is defined here.
+
+Finished years are handed to a background writer thread through a bounded queue, so the year `N` is written to its
+sinks (year databases, Parquet files, summary tables) while the year `N + 1` is balanced in memory. The queue size
+limits the number of finished years kept in memory waiting to be written.
+"""
+from __future__ import annotations
+
+import queue
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, Literal
+
+import numpy as np
+from loguru import logger
+from sqlalchemy import Engine, create_engine, delete, insert
+
+from population_restorator.db.entities import t_population_divided
+from population_restorator.db.ops import (
+    delete_checkpoint,
+    houses_filter,
+    prepare_db,
+    save_checkpoint,
+    use_houses_subset,
+    write_year_summary,
+)
+
+from .ages import ForecastedAges
+from .people import ForecastYear, _get_max_age, find_resume_point, iter_forecast_people, year_targets_digest
+
+
+YearSink = Callable[[ForecastYear], None]
+"""Function saving a finished forecast year."""
+
+
+class YearDatabasesSink:  # pylint: disable=too-few-public-methods
+    """Save each of the years to its own database the same way as `forecast_people` does (with summary tables and a
+    checkpoint), then call the callback with the year, territory_id, scenario and the year database engine."""
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        start_engine: Engine,
+        years_dsns: dict[int, str],
+        forecasted_ages: ForecastedAges,
+        base_year: int,
+        houses_ids: list[int] | None = None,
+        callback: Callable[[int, int, str, Engine]] | None = None,
+        batch_size: int = 50_000,
+    ):
+        self.start_engine = start_engine
+        self.years_dsns = years_dsns
+        self.forecasted_ages = forecasted_ages
+        self.base_year = base_year
+        self.houses_ids = houses_ids
+        self.callback = callback
+        self.batch_size = batch_size
+
+    def __call__(self, forecasted_year: ForecastYear) -> None:
+        year, territory_id, scenario = forecasted_year.year, forecasted_year.territory_id, forecasted_year.scenario
+        people = forecasted_year.people
+        if people is None:
+            raise ValueError("Population division is needed to save a year database")
+
+        year_engine = create_engine(self.years_dsns[year])
+        use_houses_subset(year_engine, self.houses_ids)
+        with year_engine.connect() as year_conn, self.start_engine.connect() as start_conn:
+            prepare_db(year_conn, start_conn)
+            delete_checkpoint(year_conn, scenario, territory_id, year)
+            year_conn.execute(
+                delete(t_population_divided).where(
+                    t_population_divided.c.year == year,
+                    t_population_divided.c.territory_id == territory_id,
+                    houses_filter(t_population_divided.c.house_id, self.houses_ids),
+                )
+            )
+            for i in range(0, len(people), self.batch_size):
+                batch = slice(i, i + self.batch_size)
+                year_conn.execute(
+                    insert(t_population_divided),
+                    [
+                        {
+                            "year": year,
+                            "territory_id": territory_id,
+                            "house_id": house_id,
+                            "social_group_id": sg_id,
+                            "age": age,
+                            "men": men,
+                            "women": women,
+                        }
+                        for house_id, sg_id, age, men, women in zip(
+                            people.house_id[batch].tolist(),
+                            people.social_group_id[batch].tolist(),
+                            people.age[batch].tolist(),
+                            people.men[batch].tolist(),
+                            people.women[batch].tolist(),
+                        )
+                    ],
+                )
+            write_year_summary(year_conn, scenario, territory_id, year, forecasted_year.summary)
+            year_conn.commit()
+            save_checkpoint(
+                year_conn,
+                scenario,
+                territory_id,
+                year,
+                year_targets_digest(self.forecasted_ages, year - self.base_year),
+                forecasted_year.rng_state,
+                self.houses_ids,
+            )
+            year_conn.commit()
+        logger.debug("Year {} is saved to its database", year)
+
+        if self.callback is not None:
+            self.callback(year, territory_id, scenario, year_engine)
+        year_engine.dispose()
+
+
+class ParquetSink:  # pylint: disable=too-few-public-methods
+    """Save population division of each of the years to a Parquet file `{directory}/year_{year}_terr_{id}_scen_
+    {scenario}.parquet`. Needs one of the pandas Parquet engines (pyarrow or fastparquet) to be installed."""
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+
+    def __call__(self, forecasted_year: ForecastYear) -> None:
+        if forecasted_year.people is None:
+            raise ValueError("Population division is needed to save a year to Parquet")
+        forecasted_year.people.to_frame().to_parquet(
+            self.directory
+            / (
+                f"year_{forecasted_year.year}_terr_{forecasted_year.territory_id}"
+                f"_scen_{forecasted_year.scenario}.parquet"
+            ),
+            index=False,
+        )
+
+
+class SummarySink:  # pylint: disable=too-few-public-methods
+    """Save summary tables of each of the years to the database of the given engine."""
+
+    def __init__(self, engine: Engine):
+        self.engine = engine
+
+    def __call__(self, forecasted_year: ForecastYear) -> None:
+        with self.engine.connect() as conn:
+            write_year_summary(
+                conn,
+                forecasted_year.scenario,
+                forecasted_year.territory_id,
+                forecasted_year.year,
+                forecasted_year.summary,
+            )
+            conn.commit()
+
+
+def write_behind(years: Iterator[ForecastYear], sinks: Iterable[YearSink], queue_size: int = 2) -> None:
+    """Consume the given forecast years writing each of them to all of the sinks in a background thread.
+
+    No more than `queue_size` finished years wait for the writer, so the forecast is paused if writing is slower.
+    Error of a sink stops the forecast and is raised after the writer has finished.
+    """
+    sinks = list(sinks)
+    years_queue: queue.Queue[ForecastYear | None] = queue.Queue(maxsize=queue_size)
+    errors: list[Exception] = []
+
+    def write() -> None:
+        while (forecasted_year := years_queue.get()) is not None:
+            if len(errors) > 0:
+                continue
+            try:
+                for sink in sinks:
+                    sink(forecasted_year)
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.error("Could not write the year {}: {!r}", forecasted_year.year, exc)
+                errors.append(exc)
+
+    writer = threading.Thread(target=write, name="forecast-writer", daemon=True)
+    writer.start()
+    try:
+        for forecasted_year in years:
+            if len(errors) > 0:
+                break
+            years_queue.put(forecasted_year)
+    finally:
+        years_queue.put(None)
+        writer.join()
+    if len(errors) > 0:
+        raise errors[0]
+
+
+def forecast_people_write_behind(  # pylint: disable=too-many-arguments,too-many-locals
+    start_engine: Engine,
+    territory_id: int,
+    scenario: Literal["NEGATIVE", "NEUTRAL", "POSITIVE"],
+    forecasted_ages: ForecastedAges,
+    years_dsns: Iterable[str],
+    base_year: int,
+    houses_ids: list[int] | None = None,
+    rng: np.random.Generator | None = None,
+    callback: Callable[[int, int, str, Engine]] | None = None,
+    threads: int = 1,
+    resume: bool = False,
+    sinks: Iterable[YearSink] = (),
+    queue_size: int = 2,
+) -> None:
+    """Forecast people the same way as `forecast_people` does (with the same result given the same random generator),
+    but balance years in memory and save them to their databases (and to the additional `sinks`) in a background
+    thread, so writing of a year is overlapped with balancing of the next one (see `write_behind`).
+
+    The callback is called from the writer thread after the year database is saved.
+    """
+    if rng is None:
+        rng = np.random.default_rng(seed=int(time.time()))
+
+    years_dsns = list(years_dsns)
+    done = 0
+    if resume:
+        done, rng_state = find_resume_point(years_dsns, territory_id, scenario, forecasted_ages, base_year, houses_ids)
+        if done > 0:
+            logger.info("Resuming forecast of territory_id {} after the year {}", territory_id, base_year + done)
+            rng.bit_generator.state = rng_state
+
+    # resumed forecast starts from the last finished year as if it was the base one
+    previous_engine = start_engine if done == 0 else create_engine(years_dsns[done - 1])
+    write_behind(
+        iter_forecast_people(
+            previous_engine,
+            territory_id,
+            scenario,
+            ForecastedAges(forecasted_ages.men.iloc[done:], forecasted_ages.women.iloc[done:]),
+            base_year + done,
+            houses_ids,
+            rng,
+            threads,
+            max_age=_get_max_age(start_engine, territory_id),
+        ),
+        [
+            YearDatabasesSink(
+                start_engine,
+                {base_year + i: year_dsn for i, year_dsn in enumerate(years_dsns, 1)},
+                forecasted_ages,
+                base_year,
+                houses_ids,
+                callback,
+            ),
+            *sinks,
+        ],
+        queue_size,
+    )
@@ -0,0 +1,59 @@
+"""Forecaster hot queries plans check is defined here."""
+from __future__ import annotations
+
+from sqlalchemy import Connection, Select, func, select
+
+from population_restorator.db.entities import t_population_divided
+from population_restorator.db.ops.cloning import aged_population_select
+from population_restorator.db.ops.query_plans import find_full_scans
+from population_restorator.db.ops.summary import summary_cells_select
+
+from .ages import base_population_select
+from .balancing.age_sex import houses_loads_select, primary_people_select, primary_totals_select
+from .balancing.ipf import age_shares, social_groups_people_select
+from .balancing.totals import houses_totals_select
+from .parallel import year_partitions_select
+
+
+def hot_queries(
+    conn: Connection, territory_id: int, year: int, age: int, houses_ids: list[int] | None = None
+) -> dict[str, Select]:
+    """Get statements executed for every forecasted year and age by their names."""
+    return {
+        "max_age": select(func.max(t_population_divided.c.age)).where(
+            t_population_divided.c.territory_id == territory_id
+        ),
+        "base_population": base_population_select(territory_id, houses_ids),
+        "clone_year": aged_population_select(t_population_divided, territory_id, year + 1, 100, houses_ids),
+        "year_partitions": year_partitions_select(territory_id, year, houses_ids),
+        "houses_loads": houses_loads_select(territory_id, year, True),
+        "summary_cells": summary_cells_select(territory_id, year, houses_ids),
+        "houses_totals": houses_totals_select(territory_id, year),
+        "primary_totals": primary_totals_select(territory_id, year, age, houses_ids),
+        "primary_people": primary_people_select(territory_id, year, age, True, houses_ids).order_by(
+            t_population_divided.c.house_id, t_population_divided.c.social_group_id
+        ),
+        "social_groups_people": social_groups_people_select(
+            territory_id, year, age, list(age_shares(conn, age)) + list(age_shares(conn, age, False)), houses_ids
+        ),
+    }
+
+
+def check_query_plans(
+    conn: Connection, territory_id: int, year: int, age: int = 0, houses_ids: list[int] | None = None
+) -> None:
+    """Check that none of the forecaster hot queries performs a full scan on the database prepared with `prepare_db`
+    (SQLite only). Raise RuntimeError listing offending queries and their plan steps otherwise.
+
+    If `houses_ids` is given, the subset must be registered on the connection (see `use_houses_subset`).
+    """
+    full_scans = {
+        name: scans
+        for name, statement in hot_queries(conn, territory_id, year, age, houses_ids).items()
+        if len(scans := find_full_scans(conn, statement)) > 0
+    }
+    if len(full_scans) > 0:
+        raise RuntimeError(
+            "Hot queries perform full scans: "
+            + "; ".join(f"{name}: {', '.join(scans)}" for name, scans in full_scans.items())
+        )
@@ -0,0 +1,179 @@
+"""Multi-territory forecast scheduler is defined here.
+
+Forecasts of different territories are independent, so each territory is forecasted by a worker process into its own
+scratch forecast store, and finished stores are merged into the common forecast store one by one. Territories are
+dispatched from the largest to the smallest one, so the largest territories do not become stragglers at the end.
+"""
+from __future__ import annotations
+
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Literal
+
+import numpy as np
+from loguru import logger
+from sqlalchemy import Connection, create_engine, func, select
+
+from population_restorator.db.entities import t_population_divided
+from population_restorator.db.ops import merge_forecast_store, prepare_store
+
+from .ages import ForecastedAges
+from .people import forecast_people_to_store
+
+
+func: Callable
+
+
+@dataclass
+class TerritoryForecast:
+    """Result of a single territory forecast: its size (number of population_divided entries of the base year), time
+    spent and the error description if the forecast has failed."""
+
+    territory_id: int
+    size: int
+    seconds: float
+    error: str | None = None
+
+    @property
+    def succeeded(self) -> bool:
+        """Check if the territory forecast has finished without an error."""
+        return self.error is None
+
+
+@dataclass
+class _TerritoryTask:  # pylint: disable=too-many-instance-attributes
+    """Forecast task of a single territory to be run in a worker process."""
+
+    start_dsn: str
+    territory_id: int
+    size: int
+    scenario: Literal["NEGATIVE", "NEUTRAL", "POSITIVE"]
+    forecasted_ages: ForecastedAges
+    base_year: int
+    scratch_path: Path
+    seed: np.random.SeedSequence
+
+
+def get_territories_sizes(conn: Connection, year: int, territories_ids: list[int] | None = None) -> dict[int, int]:
+    """Get numbers of population_divided entries of the given year of the given territories (or all of the territories
+    present) ordered from the largest territory to the smallest one."""
+    statement = (
+        select(t_population_divided.c.territory_id, func.count())
+        .where(t_population_divided.c.year == year)
+        .group_by(t_population_divided.c.territory_id)
+    )
+    if territories_ids is not None:
+        statement = statement.where(t_population_divided.c.territory_id.in_(territories_ids))
+    sizes = dict.fromkeys(territories_ids or [], 0) | dict(conn.execute(statement).all())
+    return dict(sorted(sizes.items(), key=lambda item: (-item[1], item[0])))
+
+
+def _forecast_territory(task: _TerritoryTask) -> TerritoryForecast:
+    """Forecast people of a single territory to its scratch forecast store. Errors are caught and returned as a part
+    of the result, so a failure of one territory does not affect the others."""
+    started = time.time()
+    start_engine = create_engine(task.start_dsn)
+    task.scratch_path.unlink(missing_ok=True)
+    try:
+        forecast_people_to_store(
+            start_engine,
+            create_engine(f"sqlite:///{task.scratch_path}"),
+            territory_id=task.territory_id,
+            scenario=task.scenario,
+            forecasted_ages=task.forecasted_ages,
+            base_year=task.base_year,
+            rng=np.random.default_rng(task.seed),
+        )
+    except Exception as exc:  # pylint: disable=broad-except
+        logger.opt(exception=exc).error("Forecast of territory_id {} has failed: {!r}", task.territory_id, exc)
+        return TerritoryForecast(task.territory_id, task.size, time.time() - started, repr(exc))
+    finally:
+        start_engine.dispose()
+    return TerritoryForecast(task.territory_id, task.size, time.time() - started)
+
+
+def forecast_territories(  # pylint: disable=too-many-arguments,too-many-locals
+    start_dsn: str,
+    store_dsn: str,
+    scenario: Literal["NEGATIVE", "NEUTRAL", "POSITIVE"],
+    forecasted_ages: dict[int, ForecastedAges],
+    base_year: int,
+    scratch_dir: Path,
+    rng: np.random.Generator | None = None,
+    progress: Callable[[int, int, TerritoryForecast], None] | None = None,
+    workers: int = 2,
+) -> list[TerritoryForecast]:
+    """Forecast people of each of the territories of `forecasted_ages` on a pool of `workers` processes and save them
+    to the forecast store file opened by `store_dsn`.
+
+    Each territory is forecasted to its own scratch store in `scratch_dir` with a random stream spawned from a single
+    seed drawn from `rng` (so the result does not depend on the number of workers), then the scratch store is merged
+    into the common one and removed. A failed territory is reported in its result (and its scratch store is kept for
+    inspection) without stopping the others. After each territory is finished, `progress` (if given) is called with
+    the number of finished territories, the total number of them and the territory result.
+
+    Returns results of the territories in the order of their completion.
+    """
+    if rng is None:
+        rng = np.random.default_rng(seed=int(time.time()))
+
+    start_engine, store_engine = create_engine(start_dsn), create_engine(store_dsn)
+    with start_engine.connect() as start_conn, store_engine.connect() as store_conn:
+        sizes = get_territories_sizes(start_conn, base_year, list(forecasted_ages))
+        prepare_store(store_conn, start_conn)
+        store_conn.commit()
+    start_engine.dispose()
+
+    seeds = dict(zip(sorted(sizes), np.random.SeedSequence(int(rng.integers(0, 2**63))).spawn(len(sizes))))
+    tasks = [
+        _TerritoryTask(
+            start_dsn,
+            territory_id,
+            size,
+            scenario,
+            forecasted_ages[territory_id],
+            base_year,
+            scratch_dir / f"scratch_store_terr_{territory_id}_scen_{scenario}.sqlite",
+            seeds[territory_id],
+        )
+        for territory_id, size in sizes.items()
+    ]
+    logger.info("Forecasting {} territories on {} workers", len(tasks), workers)
+
+    results: list[TerritoryForecast] = []
+
+    def finish(task: _TerritoryTask, result: TerritoryForecast) -> None:
+        if result.succeeded:
+            try:
+                with store_engine.connect() as store_conn:
+                    merge_forecast_store(store_conn, task.scratch_path.resolve(), scenario, task.territory_id)
+                task.scratch_path.unlink(missing_ok=True)
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.error("Could not merge forecast of territory_id {}: {!r}", task.territory_id, exc)
+                result.error = repr(exc)
+        results.append(result)
+        if progress is not None:
+            progress(len(results), len(tasks), result)
+
+    if workers == 1:
+        for task in tasks:
+            finish(task, _forecast_territory(task))
+    else:
+        with ProcessPoolExecutor(workers) as executor:
+            futures: dict[Future, _TerritoryTask] = {executor.submit(_forecast_territory, task): task for task in tasks}
+            for future in as_completed(futures):
+                task = futures[future]
+                try:
+                    result = future.result()
+                except Exception as exc:  # pylint: disable=broad-except
+                    logger.error("Worker forecasting territory_id {} has failed: {!r}", task.territory_id, exc)
+                    result = TerritoryForecast(task.territory_id, task.size, 0.0, repr(exc))
+                finish(task, result)
+
+    store_engine.dispose()
+    failed = [result.territory_id for result in results if not result.succeeded]
+    if len(failed) > 0:
+        logger.warning("Forecast has failed for {} of {} territories: {}", len(failed), len(results), sorted(failed))
+    return results
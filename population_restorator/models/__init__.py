@@ -3,6 +3,7 @@ Data models used by population balancer are defined here.
 """
 
 from .people_division import PeopleDivision
+from .scenario_parameters import ScenarioParameters
 from .sex_age import SexAgeDistribution
 from .social_groups import SocialGroupsDistribution, SocialGroupWithProbability
 from .survivability_coefficients import SurvivabilityCoefficients
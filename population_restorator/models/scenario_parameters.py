@@ -0,0 +1,15 @@
+"""Forecast scenario parameters class is defined here."""
+from dataclasses import dataclass
+
+from .survivability_coefficients import SurvivabilityCoefficients
+
+
+@dataclass
+class ScenarioParameters:
+    """Statistical parameters of a single forecast scenario (e.g. NEGATIVE, NEUTRAL or POSITIVE)."""
+
+    survivability_coefficients: SurvivabilityCoefficients
+    boys_to_girls: float
+    fertility_coefficient: float
+    fertility_begin: int
+    fertility_end: int
@@ -0,0 +1,3 @@
+"""Fast approximate previews on a stratified sample of houses are located here."""
+from .estimates import PreviewEstimate, estimate_population, log_estimate, read_houses_frame, read_houses_pyramids
+from .sampling import HousesSample, stratified_sample
@@ -0,0 +1,145 @@
+"""Population estimates from a stratified houses sample are defined here."""
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+from sqlalchemy import Connection, func, select, true
+
+from population_restorator.db.entities import t_houses_tmp, t_population_divided, t_social_groups_probabilities
+from population_restorator.db.ops import houses_filter
+
+from .sampling import HousesSample
+
+
+func: Callable
+
+CONFIDENCE_Z = 1.96
+"""Normal quantile used for error bounds (95% confidence)."""
+
+
+@dataclass
+class PreviewEstimate:  # pylint: disable=too-many-instance-attributes
+    """Estimated population of the whole set of houses from a stratified sample with error bounds (half-widths of
+    the confidence intervals).
+
+    `pyramid` is indexed by age and has 'men', 'men_error', 'women' and 'women_error' columns.
+    """
+
+    men: float
+    men_error: float
+    women: float
+    women_error: float
+    pyramid: pd.DataFrame
+
+
+def _stratified_totals(values: pd.DataFrame, sample: HousesSample) -> tuple[np.ndarray, np.ndarray]:
+    """Get estimated totals of the columns of [sampled houses, values] table and their standard errors."""
+    values = values.reindex(sample.houses_ids, fill_value=0)
+    strata_sizes = sample.strata_sizes
+    totals = np.zeros(values.shape[1])
+    variances = np.zeros(values.shape[1])
+    for stratum, stratum_values in values.groupby(sample.strata[values.index]):
+        population, sampled = strata_sizes[stratum], len(stratum_values)
+        totals += population * stratum_values.mean(axis=0).to_numpy()
+        if sampled > 1:
+            variances += (
+                population**2 * (1 - sampled / population) * stratum_values.var(axis=0, ddof=1).to_numpy() / sampled
+            )
+    return totals, np.sqrt(variances)
+
+
+def estimate_population(men: pd.DataFrame, women: pd.DataFrame, sample: HousesSample) -> PreviewEstimate:
+    """Estimate totals and ages pyramid of all of the houses from [sampled houses, ages] tables of men and women.
+
+    Stratified estimator is used: stratum means are scaled by strata sizes, and variance includes the finite
+    population correction.
+    """
+    ages = sorted(set(men.columns) | set(women.columns))
+    men, women = men.reindex(columns=ages, fill_value=0), women.reindex(columns=ages, fill_value=0)
+    men_ages, men_ages_se = _stratified_totals(men, sample)
+    women_ages, women_ages_se = _stratified_totals(women, sample)
+    men_total, men_total_se = _stratified_totals(men.sum(axis=1).to_frame(), sample)
+    women_total, women_total_se = _stratified_totals(women.sum(axis=1).to_frame(), sample)
+    return PreviewEstimate(
+        float(men_total[0]),
+        float(CONFIDENCE_Z * men_total_se[0]),
+        float(women_total[0]),
+        float(CONFIDENCE_Z * women_total_se[0]),
+        pd.DataFrame(
+            {
+                "men": men_ages,
+                "men_error": CONFIDENCE_Z * men_ages_se,
+                "women": women_ages,
+                "women_error": CONFIDENCE_Z * women_ages_se,
+            },
+            index=pd.Index(ages, name="age"),
+        ),
+    )
+
+
+def read_houses_frame(conn: Connection, territory_id: int, year: int) -> pd.DataFrame:
+    """Get houses of the territory which have people at the given year indexed by house identifier with their
+    'living_area' (houses capacity)."""
+    return pd.DataFrame(
+        conn.execute(
+            select(t_houses_tmp.c.id, t_houses_tmp.c.capacity)
+            .where(
+                t_houses_tmp.c.id.in_(
+                    select(t_population_divided.c.house_id).where(
+                        t_population_divided.c.territory_id == territory_id, t_population_divided.c.year == year
+                    )
+                )
+            )
+            .order_by(t_houses_tmp.c.id)
+        ).all(),
+        columns=["house_id", "living_area"],
+    ).set_index("house_id")
+
+
+def read_houses_pyramids(
+    conn: Connection, territory_id: int, year: int, houses_ids: list[int]
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Get [houses, ages] tables of men and women of primary social groups of the given houses and year."""
+    people = pd.DataFrame(
+        conn.execute(
+            select(
+                t_population_divided.c.house_id,
+                t_population_divided.c.age,
+                func.sum(t_population_divided.c.men),
+                func.sum(t_population_divided.c.women),
+            )
+            .select_from(t_population_divided)
+            .join(
+                t_social_groups_probabilities,
+                t_population_divided.c.social_group_id == t_social_groups_probabilities.c.id,
+            )
+            .where(
+                t_population_divided.c.year == year,
+                t_population_divided.c.territory_id == territory_id,
+                houses_filter(t_population_divided.c.house_id, houses_ids),
+                t_social_groups_probabilities.c.is_primary == true(),
+            )
+            .group_by(t_population_divided.c.house_id, t_population_divided.c.age)
+        ).all(),
+        columns=["house_id", "age", "men", "women"],
+    )
+    return (
+        people.pivot_table(index="house_id", columns="age", values="men", aggfunc="sum", fill_value=0),
+        people.pivot_table(index="house_id", columns="age", values="women", aggfunc="sum", fill_value=0),
+    )
+
+
+def log_estimate(year: int, estimate: PreviewEstimate) -> None:
+    """Send estimated totals in the logger info sink."""
+    logger.info(
+        "Year {} preview: men {:.0f} ± {:.0f}, women {:.0f} ± {:.0f}",
+        year,
+        estimate.men,
+        estimate.men_error,
+        estimate.women,
+        estimate.women_error,
+    )
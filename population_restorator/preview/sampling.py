@@ -0,0 +1,68 @@
+"""Stratified houses sampling is defined here."""
+from __future__ import annotations
+
+from dataclasses import dataclass
+from math import ceil
+
+import numpy as np
+import pandas as pd
+
+
+@dataclass
+class HousesSample:
+    """Stratified sample of houses.
+
+    `strata` maps every house of the population (sampled or not) to its stratum label, `houses_ids` are identifiers of
+    the sampled houses and `weights` map each of them to the number of population houses it represents.
+    """
+
+    strata: pd.Series
+    houses_ids: list[int]
+    weights: pd.Series
+
+    @property
+    def strata_sizes(self) -> pd.Series:
+        """Number of population houses in each stratum."""
+        return self.strata.value_counts()
+
+    @property
+    def sample_sizes(self) -> pd.Series:
+        """Number of sampled houses in each stratum."""
+        return self.strata[self.houses_ids].value_counts()
+
+
+def stratified_sample(  # pylint: disable=too-many-arguments
+    houses: pd.DataFrame,
+    fraction: float,
+    rng: np.random.Generator,
+    area_column: str = "living_area",
+    strata_columns: list[str] | None = None,
+    area_buckets: int = 4,
+) -> HousesSample:
+    """Sample a `fraction` of houses stratified by the given columns (e.g. territory) and living area quantile bucket.
+
+    `houses` must be indexed by house identifier. At least two houses are sampled from every stratum which has them
+    (so the stratum variance can be estimated), and each sampled house gets weight of the stratum size divided by the
+    number of houses sampled from it.
+    """
+    if not 0 < fraction <= 1:
+        raise ValueError(f"Sample fraction must be in (0, 1], got {fraction}")
+    buckets = pd.qcut(houses[area_column].rank(method="first"), min(area_buckets, len(houses)), labels=False)
+    strata = (
+        pd.Series(
+            list(zip(*(houses[column] for column in (strata_columns or [])), buckets)),
+            index=houses.index,
+        )
+        if len(houses) > 0
+        else pd.Series([], dtype=object)
+    )
+
+    houses_ids: list[int] = []
+    weights: dict[int, float] = {}
+    for _, stratum_houses in strata.groupby(strata).groups.items():
+        size = min(len(stratum_houses), max(2, ceil(fraction * len(stratum_houses))))
+        chosen = rng.choice(np.asarray(stratum_houses), size, replace=False)
+        houses_ids.extend(int(house_id) for house_id in chosen)
+        weights.update((int(house_id), len(stratum_houses) / size) for house_id in chosen)
+    houses_ids.sort()
+    return HousesSample(strata, houses_ids, pd.Series(weights).sort_index())
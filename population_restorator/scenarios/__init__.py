@@ -5,4 +5,8 @@ read_envfile()
 
 from .balancer import balance  # pylint: disable=wrong-import-position; isort: skip
 from .divider import divide  # pylint: disable=wrong-import-position; isort: skip
-from .forecaster import forecast  # pylint: disable=wrong-import-position; isort: skip
+from .forecaster import (  # pylint: disable=wrong-import-position; isort: skip
+    forecast,
+    forecast_all_territories,
+    forecast_scenarios,
+)
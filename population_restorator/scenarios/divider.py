@@ -3,13 +3,17 @@ from __future__ import annotations
 
 import datetime
 import sys
+from pathlib import Path
 
+import numpy as np
 import pandas as pd
 from loguru import logger
 from sqlalchemy import create_engine
 
+from population_restorator.db.ops import use_houses_subset
 from population_restorator.divider import divide_houses, save_houses_distribution_to_db
 from population_restorator.models.parse.social_groups import SocialGroupsDistribution
+from population_restorator.preview import estimate_population, log_estimate, read_houses_pyramids, stratified_sample
 
 def divide(  # pylint: disable=too-many-arguments,too-many-locals
     territory_id: int,
@@ -17,7 +21,9 @@ def divide(  # pylint: disable=too-many-arguments,too-many-locals
     distribution: SocialGroupsDistribution,
     year: int | None,
     verbose: bool,
-    working_db_path: str = ""
+    working_db_path: str = "",
+    preview_fraction: float | None = None,
+    seed: int | None = None,
 ) -> tuple[pd.DataFrame, pd.Series]:
     """Divide dwellings people by sex, age and social group
 
@@ -30,6 +36,13 @@ def divide(  # pylint: disable=too-many-arguments,too-many-locals
     total).
     'ages' list can the same way contain absolute or relative numbers, but absolute must sum up to 'total' if it is also
     set in absolute form.
+
+    With `preview_fraction` set, only a sample of the given fraction of houses stratified by territory (if houses have
+    'territory_id' column) and living area is divided, and estimated totals of men and women of all of the houses are
+    logged with error bounds. The sample division is saved to a disposable `preview_{name}` database next to the
+    `working_db_path` (overwritten on each preview), so the working database is left untouched.
+
+    `seed` initializes the random generator used for houses sampling and division, making results reproducible.
     """
 
     if not verbose:
@@ -40,9 +53,24 @@ def divide(  # pylint: disable=too-many-arguments,too-many-locals
         year = datetime.datetime.now().year
         logger.opt(colors=True).info("Using <cyan>{}</cyan> as a year to save a forecast", year)
 
+    rng = np.random.default_rng(seed)
+    sample = None
+    if preview_fraction is not None:
+        sample = stratified_sample(
+            houses_df.set_index("house_id", drop=False),
+            preview_fraction,
+            rng,
+            strata_columns=["territory_id"] if "territory_id" in houses_df.columns else None,
+        )
+        logger.info("Previewing division on {} of {} houses", len(sample.houses_ids), len(houses_df))
+        houses_df = houses_df[houses_df["house_id"].isin(sample.houses_ids)].copy()
+        working_db = Path(working_db_path)
+        working_db_path = str(working_db.with_name(f"preview_{working_db.name}"))
+        Path(working_db_path).unlink(missing_ok=True)
+
     logger.info("Dividing houses ({}) population", len(houses_df))
     distribution_series = pd.Series(
-        divide_houses(houses_df["population"].astype(int).to_list(), distribution), index=houses_df.house_id
+        divide_houses(houses_df["population"].astype(int).to_list(), distribution, rng), index=houses_df.house_id
     )
 
     logger.info("Saving results to {}", working_db_path)
@@ -58,4 +86,11 @@ def divide(  # pylint: disable=too-many-arguments,too-many-locals
         verbose,
     )
 
+    if sample is not None:
+        use_houses_subset(engine, sample.houses_ids)
+        with engine.connect() as conn:
+            log_estimate(
+                year, estimate_population(*read_houses_pyramids(conn, territory_id, year, sample.houses_ids), sample)
+            )
+
     return (houses_df, distribution_series)
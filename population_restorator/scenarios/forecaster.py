@@ -4,17 +4,41 @@ from __future__ import annotations
 import sys
 import traceback
 from pathlib import Path
+from typing import Callable, Literal
 
+import numpy as np
 import pandas as pd
-from typing import Literal
 from loguru import logger
 from rich.console import Console
-from sqlalchemy import create_engine
+from sqlalchemy import Engine, create_engine
 
-from population_restorator.forecaster import forecast_ages, forecast_people
+from population_restorator.db.ops import get_stored_years
+from population_restorator.forecaster import (
+    LazyForecast,
+    ScenarioRun,
+    TerritoryForecast,
+    forecast_ages,
+    forecast_ages_scenarios,
+    forecast_ages_territories,
+    forecast_people,
+    forecast_people_to_store,
+    forecast_people_write_behind,
+    forecast_scenarios_wavefront,
+    forecast_territories,
+)
+from population_restorator.forecaster.ages import ForecastedAges
+from population_restorator.models import ScenarioParameters
+from population_restorator.preview import (
+    PreviewEstimate,
+    estimate_population,
+    log_estimate,
+    read_houses_frame,
+    read_houses_pyramids,
+    stratified_sample,
+)
 
 
-def forecast(  # pylint: disable=too-many-arguments,too-many-locals
+def forecast(  # pylint: disable=too-many-arguments,too-many-locals,too-many-branches
     houses_db: str,
     territory_id: int,
     coeffs,
@@ -27,13 +51,57 @@ def forecast(  # pylint: disable=too-many-arguments,too-many-locals
     scenario: Literal["NEGATIVE", "NEUTRAL", "POSITIVE"],
     verbose: bool,
     working_dir: str = "",
-) -> None:
+    storage: Literal["files", "store"] = "files",
+    resume: bool = False,
+    lazy: bool = False,
+    preview_fraction: float | None = None,
+    write_behind: bool = False,
+    check_query_plans: bool = False,
+    seed: int | None = None,
+) -> LazyForecast | dict[int, PreviewEstimate] | None:
     """Forecast population change considering division.
 
     Model population change for the given number of years based on a given statistical parameters.
+
+    With "files" `storage` each year is saved to its own SQLite database `year_{year}_terr_{id}_scen_{scenario}.sqlite`,
+    with "store" all of the years of all scenarios and territories are saved to a single `forecast.sqlite` database.
+
+    With `resume` set, already existing years databases are not an error: the forecast continues after the last year
+    with a valid checkpoint, which also allows to extend the horizon of an existing forecast. Resuming is supported
+    only with "files" storage.
+
+    With `lazy` set, only the ages trajectory is forecasted and a `LazyForecast` is returned, which forecasts
+    house-level population of a year only when it is requested (with "files" storage only, years databases are
+    reused the same way as with `resume`).
+
+    With `preview_fraction` set, the forecast is run only on a stratified (by living area) sample of the given
+    fraction of houses, and estimated totals and ages pyramids of the whole territory with error bounds are logged and
+    returned for each year (see `_forecast_preview`).
+
+    `seed` initializes the random generator of the forecast (of the houses sampling too in case of a preview), making
+    the result reproducible.
+
+    With `write_behind` set ("files" storage only), years are balanced in memory and saved to their databases in a
+    background thread while the next year is balanced (see `forecast_people_write_behind`).
+
+    With `check_query_plans` set ("files" storage only), query plans of the balancing queries are checked on the first
+    forecasted year database and the forecast is aborted if any of them performs a full scan.
     """
     console = Console(highlight=False, emoji=False)
 
+    if check_query_plans and (storage != "files" or write_behind or lazy):
+        console.print(
+            "[red]Error: query plans check is supported only for a regular forecast with 'files' storage,"
+            " aborting[/red]"
+        )
+        sys.exit(1)
+
+    if (resume or lazy or write_behind) and storage != "files":
+        console.print(
+            "[red]Error: resuming, lazy or write-behind forecast is supported only with 'files' storage, aborting[/red]"
+        )
+        sys.exit(1)
+
     try:
         database = create_engine(f"sqlite:///{str(houses_db)}")
     except Exception as exc:  # pylint: disable=broad-except
@@ -42,6 +110,32 @@ def forecast(  # pylint: disable=too-many-arguments,too-many-locals
             traceback.print_exc()
         sys.exit(1)
 
+    if preview_fraction is not None:
+        return _forecast_preview(
+            database,
+            territory_id,
+            preview_fraction,
+            [
+                f"sqlite:///{working_dir}preview_year_{year}_terr_{territory_id}_scen_{scenario}.sqlite"
+                for year in range(year_begin + 1, year_begin + years + 1)
+            ],
+            scenario,
+            year_begin,
+            np.random.default_rng(seed),
+            lambda houses_ids: forecast_ages(
+                database=database,
+                territory_id=territory_id,
+                year_begin=year_begin,
+                year_end=year_begin + years,
+                boys_to_girls=boys_to_girls,
+                survivability_coefficients=coeffs,
+                fertility_coefficient=fertility_coefficient,
+                fertility_begin=fertility_begin,
+                fertility_end=fertility_end,
+                houses_ids=houses_ids,
+            ),
+        )
+
     forecasted_ages = forecast_ages(
         database=database,
         territory_id=territory_id,
@@ -66,23 +160,296 @@ def forecast(  # pylint: disable=too-many-arguments,too-many-locals
             )
         )
 
+    if storage == "store":
+        store_path = Path(working_dir + "forecast.sqlite")
+        store_engine = create_engine(f"sqlite:///{store_path}")
+        if store_path.exists():
+            with store_engine.connect() as store_conn:
+                stored_years = set(get_stored_years(store_conn, scenario, territory_id))
+            if len(stored_years & set(range(year_begin + 1, year_begin + years + 1))) != 0:
+                console.print(
+                    "[red]Error: forecasted years are already present in the forecast store"
+                    f" [b]'{store_path}'[/b], aborting[/red]"
+                )
+                sys.exit(1)
+        scratch_path = Path(working_dir + f"scratch_terr_{territory_id}_scen_{scenario}.sqlite")
+        scratch_path.unlink(missing_ok=True)
+        try:
+            forecast_people_to_store(
+                database,
+                store_engine,
+                territory_id=territory_id,
+                scenario=scenario,
+                forecasted_ages=forecasted_ages,
+                base_year=year_begin,
+                rng=np.random.default_rng(seed),
+                scratch_dsn=f"sqlite:///{scratch_path}",
+            )
+        finally:
+            scratch_path.unlink(missing_ok=True)
+        return None
+
     db_names = [
             str(working_dir + f"year_{year}_terr_{territory_id}_scen_{scenario}.sqlite") 
             for year in range(year_begin + 1, year_begin + years + 1)
     ]
-    if any(Path(db_name).exists() for db_name in db_names):
+    if lazy:
+        return LazyForecast(
+            database,
+            territory_id=territory_id,
+            scenario=scenario,
+            forecasted_ages=forecasted_ages,
+            years_dsns=[f"sqlite:///{db_name}" for db_name in db_names],
+            base_year=year_begin,
+            seed=seed,
+        )
+
+    if not resume and any(Path(db_name).exists() for db_name in db_names):
         console.print(
             "[red]Error: forecasted SQLite tables already exist in the diven directory"
-            f" [b]'{working_dir}'[/b], aborting[/red]"
+            f" [b]'{working_dir}'[/b], aborting (use resume to continue existing forecast)[/red]"
         )
         sys.exit(1)
 
     databases = (f"sqlite:///{db_name}" for db_name in db_names)
 
-    forecast_people(database,
+    if write_behind:
+        forecast_people_write_behind(
+            database,
+            territory_id=territory_id,
+            forecasted_ages=forecasted_ages,
+            years_dsns=databases,
+            scenario=scenario,
+            base_year=year_begin,
+            rng=np.random.default_rng(seed),
+            resume=resume,
+        )
+    else:
+        forecast_people(
+            database,
+            territory_id=territory_id,
+            forecasted_ages=forecasted_ages,
+            years_dsns=databases,
+            scenario=scenario,
+            base_year=year_begin,
+            rng=np.random.default_rng(seed),
+            resume=resume,
+            check_plans=check_query_plans,
+        )
+    return None
+
+
+def _forecast_preview(  # pylint: disable=too-many-arguments
+    database: Engine,
+    territory_id: int,
+    fraction: float,
+    years_dsns: list[str],
+    scenario: Literal["NEGATIVE", "NEUTRAL", "POSITIVE"],
+    year_begin: int,
+    rng: np.random.Generator,
+    forecast_sample_ages: Callable[[list[int]], ForecastedAges],
+) -> dict[int, PreviewEstimate]:
+    """Forecast people of a stratified sample of houses of the territory and estimate population of all of its houses.
+
+    Ages of the sample are forecasted with `forecast_sample_ages`, the sample is balanced with the regular forecaster
+    code restricted to its houses, and every year is scaled back with the sample weights. Years databases are
+    overwritten. `rng` is used both for the houses sampling and for the sample forecast.
+    """
+    with database.connect() as conn:
+        sample = stratified_sample(read_houses_frame(conn, territory_id, year_begin), fraction, rng)
+    logger.info(
+        "Previewing forecast on {} of {} houses ({} strata)",
+        len(sample.houses_ids),
+        len(sample.strata),
+        len(sample.strata_sizes),
+    )
+    for year_dsn in years_dsns:
+        Path(year_dsn.removeprefix("sqlite:///")).unlink(missing_ok=True)
+
+    estimates: dict[int, PreviewEstimate] = {}
+
+    def estimate_year(year: int, territory_id: int, _scenario: str, year_engine: Engine) -> None:
+        with year_engine.connect() as conn:
+            estimates[year] = estimate_population(
+                *read_houses_pyramids(conn, territory_id, year, sample.houses_ids), sample
+            )
+        log_estimate(year, estimates[year])
+
+    forecast_people(
+        database,
         territory_id=territory_id,
-        forecasted_ages=forecasted_ages,
-        years_dsns=databases,
         scenario=scenario,
-        base_year=year_begin
+        forecasted_ages=forecast_sample_ages(sample.houses_ids),
+        years_dsns=years_dsns,
+        base_year=year_begin,
+        houses_ids=sample.houses_ids,
+        rng=rng,
+        callback=estimate_year,
+    )
+    return estimates
+
+
+def forecast_scenarios(  # pylint: disable=too-many-arguments
+    houses_db: str,
+    territory_id: int,
+    scenarios: dict[str, ScenarioParameters],
+    year_begin: int,
+    years: int,
+    verbose: bool,
+    working_dir: str = "",
+    workers: int = 3,
+) -> None:
+    """Forecast population change for several scenarios (e.g. NEGATIVE, NEUTRAL and POSITIVE) at once.
+
+    Base year is read once, ages of all scenarios are forecasted in a single batched pass and people of all scenarios
+    are balanced concurrently on a shared pool of `workers` processes. Each year of each scenario is saved to its own
+    SQLite database `year_{year}_terr_{id}_scen_{scenario}.sqlite`.
+    """
+    console = Console(highlight=False, emoji=False)
+
+    try:
+        database = create_engine(f"sqlite:///{str(houses_db)}")
+    except Exception as exc:  # pylint: disable=broad-except
+        logger.critical("Exception on reading input data: {!r}", exc)
+        if verbose:
+            traceback.print_exc()
+        sys.exit(1)
+
+    forecasted_ages = forecast_ages_scenarios(
+        database=database,
+        territory_id=territory_id,
+        year_begin=year_begin,
+        year_end=year_begin + years,
+        scenarios=scenarios,
+    )
+
+    if verbose:
+        for scenario, scenario_ages in forecasted_ages.items():
+            console.print(
+                "[blue]{} men:\n{}[/blue]".format(  # pylint: disable=consider-using-f-string
+                    scenario, scenario_ages.men.join(pd.Series(scenario_ages.men.apply(sum, axis=1), name="sum"))
+                )
+            )
+            console.print(
+                "[bright_magenta]{} women:\n{}[/bright_magenta]".format(  # pylint: disable=consider-using-f-string
+                    scenario, scenario_ages.women.join(pd.Series(scenario_ages.women.apply(sum, axis=1), name="sum"))
+                )
+            )
+
+    db_names = {
+        scenario: [
+            str(working_dir + f"year_{year}_terr_{territory_id}_scen_{scenario}.sqlite")
+            for year in range(year_begin + 1, year_begin + years + 1)
+        ]
+        for scenario in scenarios
+    }
+    if any(Path(db_name).exists() for names in db_names.values() for db_name in names):
+        console.print(
+            "[red]Error: forecasted SQLite tables already exist in the diven directory"
+            f" [b]'{working_dir}'[/b], aborting[/red]"
+        )
+        sys.exit(1)
+
+    forecast_scenarios_wavefront(
+        database,
+        territory_id=territory_id,
+        runs=[
+            ScenarioRun(
+                scenario,
+                forecasted_ages[scenario],
+                [f"sqlite:///{db_name}" for db_name in db_names[scenario]],
+                params.fertility_begin,
+                params.fertility_end,
+            )
+            for scenario, params in scenarios.items()
+        ],
+        base_year=year_begin,
+        workers=workers,
+    )
+
+
+def forecast_all_territories(  # pylint: disable=too-many-arguments,too-many-locals
+    houses_db: str,
+    territories_ids: list[int] | None,
+    parameters: ScenarioParameters | dict[int, ScenarioParameters],
+    scenario: Literal["NEGATIVE", "NEUTRAL", "POSITIVE"],
+    year_begin: int,
+    years: int,
+    verbose: bool,
+    working_dir: str = "",
+    workers: int = 3,
+) -> list[TerritoryForecast]:
+    """Forecast population change of several territories (all of the territories of the houses database if
+    `territories_ids` is None) at once.
+
+    Ages of all territories are forecasted in a single batched pass with shared or per-territory `parameters`, then
+    territories are forecasted independently on a pool of `workers` processes, the largest ones first, and all of
+    them are saved to a single `forecast.sqlite` store. Progress is printed as territories finish, and failed
+    territories are reported without stopping the others.
+    """
+    console = Console(highlight=False, emoji=False)
+
+    try:
+        database = create_engine(f"sqlite:///{str(houses_db)}")
+    except Exception as exc:  # pylint: disable=broad-except
+        logger.critical("Exception on reading input data: {!r}", exc)
+        if verbose:
+            traceback.print_exc()
+        sys.exit(1)
+
+    forecasted = forecast_ages_territories(
+        database,
+        territories_ids,
+        year_begin=year_begin,
+        year_end=year_begin + years,
+        parameters=parameters,
+    )
+    forecasted_ages: dict[int, ForecastedAges] = {}
+    for territory_id, territory_frame in forecasted.groupby(level="territory_id"):
+        territory_frame = territory_frame.droplevel("territory_id")
+        forecasted_ages[territory_id] = ForecastedAges(
+            territory_frame["men"].unstack("age").astype(int), territory_frame["women"].unstack("age").astype(int)
+        )
+
+    store_path = Path(working_dir + "forecast.sqlite")
+    store_engine = create_engine(f"sqlite:///{store_path}")
+    if store_path.exists():
+        with store_engine.connect() as store_conn:
+            stored = [
+                territory_id
+                for territory_id in forecasted_ages
+                if len(
+                    set(get_stored_years(store_conn, scenario, territory_id))
+                    & set(range(year_begin + 1, year_begin + years + 1))
+                )
+                != 0
+            ]
+        if len(stored) != 0:
+            console.print(
+                f"[red]Error: forecasted years of territories {stored} are already present in the forecast store"
+                f" [b]'{store_path}'[/b], aborting[/red]"
+            )
+            sys.exit(1)
+    store_engine.dispose()
+
+    def print_progress(finished: int, total: int, result: TerritoryForecast) -> None:
+        if result.succeeded:
+            console.print(
+                f"[{finished}/{total}] territory_id [cyan]{result.territory_id}[/cyan] is forecasted"
+                f" in {result.seconds:.1f} seconds"
+            )
+        else:
+            console.print(
+                f"[{finished}/{total}] [red]territory_id {result.territory_id} has failed: {result.error}[/red]"
+            )
+
+    return forecast_territories(
+        f"sqlite:///{str(houses_db)}",
+        f"sqlite:///{store_path}",
+        scenario=scenario,
+        forecasted_ages=forecasted_ages,
+        base_year=year_begin,
+        scratch_dir=Path(working_dir or "."),
+        progress=print_progress,
+        workers=workers,
     )
@@ -0,0 +1,52 @@
+"""Common fixtures: a small divided territory built from the sample data."""
+from __future__ import annotations
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import Engine, create_engine
+
+from population_restorator.forecaster import forecast_ages
+from population_restorator.forecaster.ages import ForecastedAges
+from population_restorator.models.parse import read_coefficients
+from population_restorator.models.parse.social_groups import parse_distribution
+from population_restorator.scenarios import divide
+
+from .utils import BASE_YEAR, SAMPLE_DATA, TERRITORY_ID, YEARS
+
+
+@pytest.fixture(name="base_db", scope="session")
+def fixture_base_db(tmp_path_factory: pytest.TempPathFactory) -> Path:
+    """Base year database of a territory of 40 houses divided with the sample social groups distribution."""
+    path = tmp_path_factory.mktemp("base") / "base.sqlite"
+    rng = np.random.default_rng(1)
+    houses = pd.DataFrame(
+        {"house_id": range(1, 41), "population": rng.integers(10, 200, 40), "living_area": rng.uniform(50, 500, 40)}
+    )
+    distribution = parse_distribution(str(SAMPLE_DATA / "divider" / "social_groups.json"))
+    divide(TERRITORY_ID, houses, distribution, BASE_YEAR, False, str(path), seed=1)
+    return path
+
+
+@pytest.fixture(name="base_engine")
+def fixture_base_engine(base_db: Path) -> Engine:
+    """Engine of the base year database."""
+    return create_engine(f"sqlite:///{base_db}")
+
+
+@pytest.fixture(name="forecasted_ages", scope="session")
+def fixture_forecasted_ages(base_db: Path) -> ForecastedAges:
+    """Ages trajectory of the base territory for `YEARS` years."""
+    return forecast_ages(
+        create_engine(f"sqlite:///{base_db}"),
+        TERRITORY_ID,
+        BASE_YEAR,
+        BASE_YEAR + YEARS,
+        1.06,
+        read_coefficients(str(SAMPLE_DATA / "forecaster" / "survivability_coefficients.json")),
+        1.07,
+        1,
+        3,
+    )
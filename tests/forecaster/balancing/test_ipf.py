@@ -0,0 +1,93 @@
+"""Iterative proportional fitting and controlled rounding tests."""
+from __future__ import annotations
+
+import numpy as np
+import pytest
+from sqlalchemy import Engine
+
+from population_restorator.forecaster.balancing import (
+    age_shares,
+    balance_year_additional_social_groups,
+    balance_year_age_primary_social_groups,
+    fit_social_groups,
+    fit_table,
+    round_controlled,
+)
+from population_restorator.forecaster.balancing.ipf import read_social_groups_tables
+
+from ...utils import BASE_YEAR, TERRITORY_ID
+
+
+AGES = (0, 1, 2, 3)
+"""Ages of the sample social groups distribution."""
+
+
+def _normalized(shares: dict[int, tuple[float, float]], sex_idx: int) -> np.ndarray:
+    values = np.array([share[sex_idx] for share in shares.values()], dtype=float)
+    return values / values.sum()
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_round_controlled_keeps_margins(seed: int):
+    """Controlled rounding keeps both rows and columns totals and moves every cell by less than one."""
+    rng = np.random.default_rng(seed)
+    rows_totals = rng.integers(0, 30, 25)
+    columns_totals = np.bincount(rng.choice(6, rows_totals.sum(), p=rng.dirichlet(np.ones(6))), minlength=6)
+    fitted, _, _ = fit_table(
+        rng.uniform(0, 5, (25, 6)), rows_totals.astype(float), columns_totals.astype(float), 1e-9, 1000
+    )
+    rounded = round_controlled(fitted, rows_totals, columns_totals, rng)
+    assert (rounded.sum(axis=1) == rows_totals).all()
+    assert (rounded.sum(axis=0) == columns_totals).all()
+    assert (np.abs(rounded - fitted) < 1).all()
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_fit_social_groups_marginals(seed: int):
+    """Fitted table keeps houses totals, and social groups totals are the rounded shares of their sum."""
+    rng = np.random.default_rng(seed)
+    current = rng.integers(0, 10, (30, 5))
+    houses_totals = current.sum(axis=1) + rng.integers(0, 5, 30)
+    shares = rng.dirichlet(np.ones(5))
+    fitted = fit_social_groups(current, houses_totals, shares, rng)
+    assert (fitted >= 0).all()
+    assert (fitted.sum(axis=1) == houses_totals).all()
+    assert (np.abs(fitted.sum(axis=0) - houses_totals.sum() * shares) < 1).all()
+
+
+@pytest.mark.parametrize("age", AGES)
+def test_primary_social_groups_marginals(base_engine: Engine, age: int):
+    """Primary social groups balancing keeps people of every house and matches the social groups shares."""
+    with base_engine.connect() as conn:
+        shares = age_shares(conn, age)
+        sgs_ids = list(shares)
+        _, men, women = read_social_groups_tables(conn, TERRITORY_ID, BASE_YEAR, age, sgs_ids, None)
+        balance_year_age_primary_social_groups(conn, TERRITORY_ID, BASE_YEAR, age, None, np.random.default_rng(3))
+        _, new_men, new_women = read_social_groups_tables(conn, TERRITORY_ID, BASE_YEAR, age, sgs_ids, None)
+        conn.rollback()
+    for sex_idx, (before, after) in enumerate(((men, new_men), (women, new_women))):
+        assert before.sum() > 0
+        assert (after.sum(axis=1) == before.sum(axis=1)).all()
+        assert (np.abs(after.sum(axis=0) - before.sum() * _normalized(shares, sex_idx)) < 1).all()
+
+
+@pytest.mark.parametrize("age", AGES)
+def test_additional_social_groups_marginals(base_engine: Engine, age: int):
+    """Additional social groups balancing keeps memberships of each sex, spreads them between houses proportionally
+    to their people and matches the social groups shares."""
+    with base_engine.connect() as conn:
+        primary_ids = list(age_shares(conn, age))
+        shares = age_shares(conn, age, is_primary=False)
+        sgs_ids = primary_ids + list(shares)
+        _, men, women = read_social_groups_tables(conn, TERRITORY_ID, BASE_YEAR, age, sgs_ids, None)
+        balance_year_additional_social_groups(conn, TERRITORY_ID, BASE_YEAR, age, None, np.random.default_rng(3))
+        _, new_men, new_women = read_social_groups_tables(conn, TERRITORY_ID, BASE_YEAR, age, sgs_ids, None)
+        conn.rollback()
+    for sex_idx, (before, after) in enumerate(((men, new_men), (women, new_women))):
+        people, memberships = after[:, : len(primary_ids)].sum(axis=1), after[:, len(primary_ids) :]
+        assert (people == before[:, : len(primary_ids)].sum(axis=1)).all()
+        assert memberships.sum() == before[:, len(primary_ids) :].sum()
+        if memberships.sum() == 0:
+            continue
+        assert (np.abs(memberships.sum(axis=1) - people * memberships.sum() / people.sum()) < 1).all()
+        assert (np.abs(memberships.sum(axis=0) - memberships.sum() * _normalized(shares, sex_idx)) < 1).all()
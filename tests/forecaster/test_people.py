@@ -0,0 +1,91 @@
+"""Houses population forecast tests."""
+from __future__ import annotations
+
+from pathlib import Path
+
+import numpy as np
+import pytest
+from sqlalchemy import Engine, create_engine, func, select, true
+
+from population_restorator.db.entities import t_population_divided, t_social_groups_probabilities
+from population_restorator.forecaster import forecast_people
+from population_restorator.forecaster.ages import ForecastedAges
+
+from ..utils import BASE_YEAR, TERRITORY_ID, YEARS, read_population, years_dsns
+
+
+def _forecast(
+    base_engine: Engine, forecasted_ages: ForecastedAges, directory: Path, seed: int, **kwargs
+) -> list[list[tuple]]:
+    directory.mkdir()
+    dsns = years_dsns(directory, forecasted_ages.men.shape[0] - 1)
+    forecast_people(
+        base_engine,
+        TERRITORY_ID,
+        "NEUTRAL",
+        forecasted_ages,
+        dsns,
+        BASE_YEAR,
+        rng=np.random.default_rng(seed),
+        **kwargs,
+    )
+    return [read_population(dsn) for dsn in dsns]
+
+
+def test_forecast_matches_forecasted_ages(base_engine: Engine, forecasted_ages: ForecastedAges, tmp_path: Path):
+    """Numbers of people of primary social groups of every forecasted year and age are the forecasted ones."""
+    _forecast(base_engine, forecasted_ages, tmp_path / "forecast", 5)
+    for year_idx, dsn in enumerate(years_dsns(tmp_path / "forecast"), 1):
+        with create_engine(dsn).connect() as conn:
+            totals = dict(
+                (age, (men, women))
+                for age, men, women in conn.execute(
+                    select(
+                        t_population_divided.c.age,
+                        func.sum(t_population_divided.c.men),
+                        func.sum(t_population_divided.c.women),
+                    )
+                    .join(
+                        t_social_groups_probabilities,
+                        t_population_divided.c.social_group_id == t_social_groups_probabilities.c.id,
+                    )
+                    .where(t_social_groups_probabilities.c.is_primary == true())
+                    .group_by(t_population_divided.c.age)
+                )
+            )
+        for age in forecasted_ages.men.columns:
+            assert totals.get(age, (0, 0)) == (
+                forecasted_ages.men.iloc[year_idx][age],
+                forecasted_ages.women.iloc[year_idx][age],
+            )
+
+
+@pytest.mark.parametrize("threads", [2, 3])
+def test_result_does_not_depend_on_threads(
+    base_engine: Engine, forecasted_ages: ForecastedAges, tmp_path: Path, threads: int
+):
+    """Forecast with the same seed gives the same result for any number of threads."""
+    single = _forecast(base_engine, forecasted_ages, tmp_path / "single", 5)
+    parallel = _forecast(base_engine, forecasted_ages, tmp_path / "parallel", 5, threads=threads)
+    assert single == parallel
+    assert single != _forecast(base_engine, forecasted_ages, tmp_path / "other", 6)
+
+
+def test_resumed_forecast_equals_uninterrupted(base_engine: Engine, forecasted_ages: ForecastedAges, tmp_path: Path):
+    """Forecast interrupted after two years and resumed (with another generator) gives the uninterrupted result."""
+    uninterrupted = _forecast(base_engine, forecasted_ages, tmp_path / "uninterrupted", 5)
+    interrupted = ForecastedAges(forecasted_ages.men.iloc[:3], forecasted_ages.women.iloc[:3])
+    _forecast(base_engine, interrupted, tmp_path / "resumed", 5)
+    dsns = years_dsns(tmp_path / "resumed")
+    forecast_people(
+        base_engine,
+        TERRITORY_ID,
+        "NEUTRAL",
+        forecasted_ages,
+        dsns,
+        BASE_YEAR,
+        rng=np.random.default_rng(99),
+        resume=True,
+    )
+    assert [read_population(dsn) for dsn in dsns] == uninterrupted
+    assert len(uninterrupted) == YEARS
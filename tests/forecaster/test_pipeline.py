@@ -0,0 +1,51 @@
+"""Write-behind forecast pipeline tests."""
+from __future__ import annotations
+
+from pathlib import Path
+
+import numpy as np
+from sqlalchemy import Engine
+
+from population_restorator.forecaster import forecast_people, forecast_people_write_behind
+from population_restorator.forecaster.ages import ForecastedAges
+
+from ..utils import BASE_YEAR, TERRITORY_ID, read_population, years_dsns
+
+
+def test_write_behind_equals_serial(base_engine: Engine, forecasted_ages: ForecastedAges, tmp_path: Path):
+    """Write-behind forecast gives the same result as the serial one given the same random generator."""
+    (tmp_path / "serial").mkdir()
+    (tmp_path / "write_behind").mkdir()
+    serial, write_behind = years_dsns(tmp_path / "serial"), years_dsns(tmp_path / "write_behind")
+    forecast_people(
+        base_engine, TERRITORY_ID, "NEUTRAL", forecasted_ages, serial, BASE_YEAR, rng=np.random.default_rng(5)
+    )
+    forecast_people_write_behind(
+        base_engine, TERRITORY_ID, "NEUTRAL", forecasted_ages, write_behind, BASE_YEAR, rng=np.random.default_rng(5)
+    )
+    assert [read_population(dsn) for dsn in serial] == [read_population(dsn) for dsn in write_behind]
+
+
+def test_write_behind_resume_equals_serial(base_engine: Engine, forecasted_ages: ForecastedAges, tmp_path: Path):
+    """Write-behind forecast interrupted after two years and resumed gives the uninterrupted serial result."""
+    (tmp_path / "serial").mkdir()
+    (tmp_path / "write_behind").mkdir()
+    serial, write_behind = years_dsns(tmp_path / "serial"), years_dsns(tmp_path / "write_behind")
+    forecast_people(
+        base_engine, TERRITORY_ID, "NEUTRAL", forecasted_ages, serial, BASE_YEAR, rng=np.random.default_rng(5)
+    )
+    interrupted = ForecastedAges(forecasted_ages.men.iloc[:3], forecasted_ages.women.iloc[:3])
+    forecast_people_write_behind(
+        base_engine, TERRITORY_ID, "NEUTRAL", interrupted, write_behind[:2], BASE_YEAR, rng=np.random.default_rng(5)
+    )
+    forecast_people_write_behind(
+        base_engine,
+        TERRITORY_ID,
+        "NEUTRAL",
+        forecasted_ages,
+        write_behind,
+        BASE_YEAR,
+        rng=np.random.default_rng(99),
+        resume=True,
+    )
+    assert [read_population(dsn) for dsn in serial] == [read_population(dsn) for dsn in write_behind]
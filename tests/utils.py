@@ -0,0 +1,29 @@
+"""Constants and helpers shared by the tests."""
+from __future__ import annotations
+
+from pathlib import Path
+
+from sqlalchemy import create_engine, select
+
+from population_restorator.db.entities import t_population_divided
+
+
+SAMPLE_DATA = Path(__file__).parent.parent / "sample_data"
+
+TERRITORY_ID = 7
+BASE_YEAR = 2020
+YEARS = 4
+
+
+def years_dsns(directory: Path, years: int = YEARS) -> list[str]:
+    """Get forecasted years databases DSNs in the given directory."""
+    return [f"sqlite:///{directory / f'year_{BASE_YEAR + i}.sqlite'}" for i in range(1, years + 1)]
+
+
+def read_population(dsn: str) -> list[tuple]:
+    """Get all of the population_divided entries of the database ordered by the primary key."""
+    with create_engine(dsn).connect() as conn:
+        return [
+            tuple(row)
+            for row in conn.execute(select(t_population_divided).order_by(*t_population_divided.primary_key.columns))
+        ]